@@ -0,0 +1,88 @@
+# AGGREGATE TABLES
+# rollups of songplays answering the most common analytics queries without scanning and joining
+# the final tables. Each one is grouped on a time bucket (DATE_TRUNC of start_time), so that a
+# batch of NextSong events only affects the buckets of its events and only those are recomputed
+
+aggregate_songplays_daily = {
+    "table": "song_plays_daily",
+    "bucket": "day",
+    "unit": "day",
+    "create": """CREATE TABLE IF NOT EXISTS song_plays_daily (
+    day TIMESTAMP NOT NULL,
+    song_id VARCHAR NOT NULL,
+    plays BIGINT NOT NULL
+);""",
+    "select": """SELECT DATE_TRUNC('day', start_time) AS day, song_id, COUNT(*) AS plays
+FROM songplays
+{where}
+GROUP BY 1, 2""",
+}
+
+aggregate_active_users_hourly = {
+    "table": "active_users_hourly",
+    "bucket": "hour",
+    "unit": "hour",
+    "create": """CREATE TABLE IF NOT EXISTS active_users_hourly (
+    hour TIMESTAMP NOT NULL,
+    level VARCHAR(10),
+    active_users BIGINT NOT NULL
+);""",
+    # distinct users are not additive, hence a bucket is always recomputed as a whole
+    "select": """SELECT DATE_TRUNC('hour', start_time) AS hour, level, COUNT(DISTINCT user_id) AS active_users
+FROM songplays
+{where}
+GROUP BY 1, 2""",
+}
+
+aggregate_artist_plays_weekly = {
+    "table": "artist_plays_weekly",
+    "bucket": "week",
+    "unit": "week",
+    "create": """CREATE TABLE IF NOT EXISTS artist_plays_weekly (
+    week TIMESTAMP NOT NULL,
+    artist_id VARCHAR NOT NULL,
+    plays BIGINT NOT NULL
+);""",
+    "select": """SELECT DATE_TRUNC('week', start_time) AS week, artist_id, COUNT(*) AS plays
+FROM songplays
+{where}
+GROUP BY 1, 2""",
+}
+
+aggregates = [
+    aggregate_songplays_daily,
+    aggregate_active_users_hourly,
+    aggregate_artist_plays_weekly,
+]
+
+# buckets touched by the batch of events in nextsong_events
+batch_buckets_template = "SELECT DISTINCT DATE_TRUNC('{unit}', ts) FROM nextsong_events"
+
+aggregate_batch_where_template = "WHERE DATE_TRUNC('{unit}', start_time) IN ({buckets})"
+
+aggregate_batch_delete_template = "DELETE FROM {table} WHERE {bucket} IN ({buckets});"
+
+aggregate_clear_template = "DELETE FROM {table};"
+
+aggregate_insert_template = "INSERT INTO {table} {select};"
+
+# rows of the aggregate differing from a full recomputation, in either direction
+aggregate_check_template = """SELECT COUNT(*) FROM (
+    (SELECT * FROM {table} EXCEPT {select})
+    UNION ALL
+    ({select} EXCEPT SELECT * FROM {table})
+) differences;"""
+
+aggregate_table_create_queries = [aggregate["create"] for aggregate in aggregates]
+aggregate_table_drop_queries = [
+    f"DROP TABLE IF EXISTS {aggregate['table']};" for aggregate in aggregates
+]
+
+# e.g. the ten artists played the most in each week
+top_artists_weekly_select = """SELECT week, artist_id, plays FROM (
+    SELECT week, artist_id, plays,
+    RANK() OVER (PARTITION BY week ORDER BY plays DESC) AS plays_rank
+    FROM artist_plays_weekly
+) ranked
+WHERE plays_rank <= %s
+ORDER BY week, plays_rank;"""
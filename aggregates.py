@@ -0,0 +1,130 @@
+import argparse
+import configparser
+import logging
+import psycopg2
+from db import get_connection
+from instrumentation import execute
+from aggregate_queries import (
+    aggregates,
+    batch_buckets_template,
+    aggregate_batch_where_template,
+    aggregate_batch_delete_template,
+    aggregate_clear_template,
+    aggregate_insert_template,
+    aggregate_check_template,
+)
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def refresh_queries(aggregate, full=False):
+    """
+    Build the queries refreshing an aggregate: all of it, or only the buckets of the events in nextsong_events
+
+    Parameters
+    ----------
+    aggregate : dict
+        table, bucket, unit and select of the aggregate (see aggregate_queries.py)
+    full : bool
+
+    Returns
+    -------
+    queries : list of str
+        delete and insert
+
+    """
+    table = aggregate["table"]
+    if full:
+        return [
+            aggregate_clear_template.format(table=table),
+            aggregate_insert_template.format(
+                table=table, select=aggregate["select"].format(where="")
+            ),
+        ]
+
+    buckets = batch_buckets_template.format(unit=aggregate["unit"])
+    where = aggregate_batch_where_template.format(unit=aggregate["unit"], buckets=buckets)
+    return [
+        aggregate_batch_delete_template.format(
+            table=table, bucket=aggregate["bucket"], buckets=buckets
+        ),
+        aggregate_insert_template.format(table=table, select=aggregate["select"].format(where=where)),
+    ]
+
+
+def refresh_aggregates(cur, full=False):
+    """
+    Refresh the aggregate tables after songplays has been filled from the events in nextsong_events.
+    The caller commits, so that e.g. an incremental partition and its aggregates are committed together
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    full : bool
+        recompute the aggregates as a whole, e.g. after a full load
+
+    """
+    for aggregate in aggregates:
+        for query in refresh_queries(aggregate, full):
+            execute(cur, query, "aggregates")
+
+
+def check_aggregates(cur):
+    """
+    Compare each aggregate table with its full recomputation from songplays
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+
+    Returns
+    -------
+    differences : dict
+        table -> rows differing from the recomputation, 0 when the aggregate is correct
+
+    """
+    differences = {}
+    for aggregate in aggregates:
+        execute(
+            cur,
+            aggregate_check_template.format(
+                table=aggregate["table"], select=aggregate["select"].format(where="")
+            ),
+            "aggregates",
+        )
+        differences[aggregate["table"]] = cur.fetchone()[0]
+    return differences
+
+
+def main(argv=None):
+    """
+    Check the aggregate tables against their full recomputation, or recompute them with --refresh
+
+    """
+    parser = argparse.ArgumentParser(description="Aggregate tables of songplays")
+    parser.add_argument("--refresh", action="store_true", help="recompute the aggregates as a whole")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+
+    try:
+        conn = get_connection(config)
+        cur = conn.cursor()
+        if args.refresh:
+            refresh_aggregates(cur, full=True)
+            conn.commit()
+        for table, count in check_aggregates(cur).items():
+            if count:
+                logger.error(f"{table}: {count} rows differ from the recomputation")
+            else:
+                logger.info(f"{table}: correct")
+        conn.close()
+    except psycopg2.Error:
+        logger.exception("Issue while checking the aggregates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import argparse
+import configparser
+import json
+import logging
+import os
+import platform
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import datagen
+import local_loader
+from create_tables import create_tables, drop_tables
+from db import get_backend, get_connection
+from etl import run_insert, run_post_copy
+from physical_design import load_profile
+from sql_queries import insert_table_graph, post_copy_queries
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# a phase or query slower than the baseline by more than this ratio is a regression
+DEFAULT_TOLERANCE = 0.2
+
+COUNT_TABLES = [
+    "staging_events",
+    "staging_songs",
+    "nextsong_events",
+    "keyed_songs",
+    "users",
+    "songs",
+    "artists",
+    "time",
+    "songplays",
+]
+
+
+class Phase:
+    """
+    Context manager measuring the wall time of a phase and, with trace_memory, its peak Python memory.
+    tracemalloc slows down every allocation, hence the timings of a traced run are not comparable
+    with the ones of an untraced run
+    """
+
+    def __init__(self, results, name, trace_memory=False):
+        self.results = results
+        self.name = name
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        self.results["phases"][self.name] = {"seconds": duration}
+        if not self.trace_memory:
+            logger.info(f"Phase {self.name} took {duration:.2f}s")
+            return False
+
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.results["phases"][self.name]["peak_python_bytes"] = peak
+        logger.info(f"Phase {self.name} took {duration:.2f}s (peak {peak / 2 ** 20:.1f} MiB)")
+        return False
+
+
+def count_rows(cur):
+    """Count the rows of the staging and final tables"""
+    counts = {}
+    for table in COUNT_TABLES:
+        cur.execute(f"SELECT COUNT(*) FROM {table};")
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+
+def run_benchmark(config, trace_memory=False):
+    """
+    Run create, staging and insert against the local PostgreSQL database of the configuration,
+    measuring each phase and each insert query
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        with BACKEND = postgres
+    trace_memory : bool
+        measure the peak Python memory of each phase with tracemalloc, which slows the phases down
+
+    Returns
+    -------
+    results : dict
+
+    """
+    if get_backend(config) != "postgres":
+        raise ValueError("The benchmark runs on the postgres backend only")
+
+    results = {"phases": {}, "queries": {}, "trace_memory": trace_memory}
+    conn = get_connection(config)
+    cur = conn.cursor()
+    try:
+        with Phase(results, "create", trace_memory):
+            drop_tables(cur, conn)
+            create_tables(cur, conn, load_profile(config))
+
+        with Phase(results, "staging", trace_memory):
+            staged = local_loader.load_staging_tables(cur, conn, config)
+            for table in post_copy_queries:
+                run_post_copy(cur, table)
+            conn.commit()
+        staged_rows = sum(staged.values())
+        results["phases"]["staging"]["rows"] = staged_rows
+        results["phases"]["staging"]["rows_per_second"] = staged_rows / max(
+            results["phases"]["staging"]["seconds"], 1e-9
+        )
+
+        with Phase(results, "insert", trace_memory):
+            for node in insert_table_graph:
+                start = time.perf_counter()
+                run_insert(cur, node)
+                conn.commit()
+                results["queries"][node["name"]] = {"seconds": time.perf_counter() - start}
+
+        results["rows"] = count_rows(cur)
+        inserted = sum(results["rows"][table] for table in ("users", "songs", "artists", "time", "songplays"))
+        results["phases"]["insert"]["rows"] = inserted
+        results["phases"]["insert"]["rows_per_second"] = inserted / max(
+            results["phases"]["insert"]["seconds"], 1e-9
+        )
+    finally:
+        conn.close()
+
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the timings of a run against a baseline run
+
+    Parameters
+    ----------
+    results : dict
+    baseline : dict
+    tolerance : float
+        ratio above which a slower phase or query is a regression
+
+    Returns
+    -------
+    regressions : list of str
+
+    """
+    regressions = []
+    for section, label in (("phases", "phase"), ("queries", "query")):
+        for name, timing in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous or not previous["seconds"]:
+                continue
+            ratio = timing["seconds"] / previous["seconds"]
+            logger.info(f"{label} {name}: {timing['seconds']:.3f}s vs {previous['seconds']:.3f}s ({ratio:.2f}x)")
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} is {ratio:.2f}x slower than the baseline")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ETL pipeline on a local PostgreSQL database")
+    parser.add_argument("--config", default="dwh.cfg")
+    parser.add_argument("--generate", type=int, metavar="EVENTS", help="generate this many events first (see datagen.py)")
+    parser.add_argument("--match-rate", type=float, default=0.9)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--null-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file where the results are saved")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="measure the peak Python memory of each phase, slowing the phases down",
+    )
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "data": None,
+    }
+    if args.generate:
+        # song_data and log_data are generated under the parent directory of LOG_DATA
+        root = os.path.dirname(config["LOCAL"]["LOG_DATA"].rstrip("/")) or "."
+        results["data"] = datagen.generate(
+            root,
+            args.generate,
+            match_rate=args.match_rate,
+            skew=args.skew,
+            null_rate=args.null_rate,
+            seed=args.seed,
+        )
+
+    results.update(run_benchmark(config, args.trace_memory))
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    logger.info(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("trace_memory", False) != args.trace_memory:
+            logger.warning("Only one of the run and the baseline traced the memory, their timings are not comparable")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
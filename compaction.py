@@ -0,0 +1,374 @@
+import argparse
+import configparser
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+import boto3
+from botocore.exceptions import ClientError
+from manifests import EXTENSIONS, slice_count
+from s3_utils import list_objects, split_s3_url
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# chunks uploaded and keys of the source objects they hold are stored in this folder, next to the
+# target prefix but outside of it, otherwise COPY would load the state along with the chunks
+STATE_FOLDER = "_compaction_state"
+
+
+def iter_records(text):
+    """
+    Yield the JSON objects of a file, either a single (possibly indented) object as in
+    song_data or one object per line as in log_data
+
+    Parameters
+    ----------
+    text : str
+
+    Yields
+    ------
+    record : dict
+
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+
+class ChunkWriter:
+    """
+    Write line-delimited JSON records into compressed chunks of about chunk_bytes (before compression),
+    spooling each chunk to a temporary file and uploading it to S3 on flush. The caller flushes
+    between two source objects, so that every object lies in a single chunk
+    """
+
+    def __init__(self, client, target_url, name, chunk_bytes, codec="gzip"):
+        if codec not in EXTENSIONS:
+            raise ValueError(f"Unknown codec {codec}")
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.client = client
+        self.bucket, self.prefix = split_s3_url(target_url)
+        self.name = name
+        self.chunk_bytes = chunk_bytes
+        self.codec = codec
+        self.chunks = []
+        self._file = None
+        self._stream = None
+        self._written = 0
+
+    def _open(self):
+        self._file = tempfile.NamedTemporaryFile(delete=False)
+        if self.codec == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._file, mode="wb")
+        else:
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+        self._written = 0
+
+    def write(self, record):
+        """
+        Append a record to the current chunk
+
+        Parameters
+        ----------
+        record : dict
+
+        """
+        if self._stream is None:
+            self._open()
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self._stream.write(line)
+        self._written += len(line)
+
+    def flush(self):
+        """
+        Upload the current chunk, if any
+
+        Returns
+        -------
+        url : str
+            url of the chunk uploaded, None if there was no chunk
+
+        """
+        if self._stream is None:
+            return None
+        self._stream.close()
+        self._file.close()
+        key = "/".join(
+            part
+            for part in (
+                self.prefix.rstrip("/"),
+                f"{self.name}-{len(self.chunks):05d}{EXTENSIONS[self.codec]}",
+            )
+            if part
+        )
+        try:
+            self.client.upload_file(self._file.name, self.bucket, key)
+        finally:
+            os.remove(self._file.name)
+        self.chunks.append(f"s3://{self.bucket}/{key}")
+        logger.info(f"Chunk s3://{self.bucket}/{key} uploaded ({self._written} bytes uncompressed)")
+        self._stream = None
+        self._file = None
+        return self.chunks[-1]
+
+
+def read_state(client, target_url):
+    """
+    Read the chunks uploaded under the target prefix and the keys of the source objects they hold
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    target_url : str
+
+    Returns
+    -------
+    state : dict
+        chunk url -> list of source keys
+
+    """
+    bucket, prefix = split_s3_url(target_url)
+    try:
+        response = client.get_object(Bucket=bucket, Key=_state_key(prefix))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return {}
+        raise
+    return json.loads(gzip.decompress(response["Body"].read()))
+
+
+def write_state(client, target_url, state):
+    """
+    Record the chunks uploaded under the target prefix and the keys of the source objects they hold
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    target_url : str
+    state : dict
+        chunk url -> list of source keys
+
+    """
+    bucket, prefix = split_s3_url(target_url)
+    body = gzip.compress(json.dumps(state, sort_keys=True).encode("utf-8"))
+    client.put_object(Bucket=bucket, Key=_state_key(prefix), Body=body)
+
+
+def _state_key(prefix):
+    parent, _, name = prefix.rstrip("/").rpartition("/")
+    return "/".join(part for part in (parent, STATE_FOLDER, f"{name or 'root'}.json.gz") if part)
+
+
+def remove_chunks(client, target_url, keep=()):
+    """
+    Delete the chunks under the target prefix, except the given ones
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    target_url : str
+    keep : iterable of str
+        urls of the chunks to keep
+
+    Returns
+    -------
+    deleted : int
+        number of chunks deleted
+
+    """
+    bucket, prefix = split_s3_url(target_url)
+    keep = set(keep)
+    keys = [
+        key
+        for key, _ in list_objects(client, f"s3://{bucket}/{prefix.rstrip('/')}/")
+        if f"s3://{bucket}/{key}" not in keep
+    ]
+    # DeleteObjects takes at most 1000 keys
+    for start in range(0, len(keys), 1000):
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]], "Quiet": True},
+        )
+    if keys:
+        logger.info(f"{len(keys)} chunks deleted from {target_url}")
+    return len(keys)
+
+
+def record_chunk(client, target_url, state, chunk, keys):
+    """Record in the state a chunk just uploaded and the keys of the source objects it holds"""
+    if chunk is not None:
+        state[chunk] = keys
+        write_state(client, target_url, state)
+
+
+def plan_rounds(objects, chunk_bytes, slices):
+    """
+    Group the objects into rounds of about slices * chunk_bytes and spread the objects of every round
+    over slices chunks, largest first into the chunk holding the fewest bytes, so that every round
+    writes as many chunks as the cluster has slices, of similar sizes
+
+    Parameters
+    ----------
+    objects : list of (key, size) tuples
+    chunk_bytes : int
+    slices : int
+
+    Returns
+    -------
+    rounds : list of list
+        for every round, the keys of each of its slices chunks (some empty if the round has
+        fewer objects than slices)
+
+    """
+    rounds, current, total = [], [], 0
+    for key, size in objects:
+        current.append((key, size))
+        total += size
+        if total >= slices * chunk_bytes:
+            rounds.append(current)
+            current, total = [], 0
+    if current:
+        rounds.append(current)
+
+    planned = []
+    for round_objects in rounds:
+        chunks = [[] for _ in range(slices)]
+        loads = [0] * slices
+        for key, size in sorted(round_objects, key=lambda item: (-item[1], item[0])):
+            index = loads.index(min(loads))
+            chunks[index].append(key)
+            loads[index] += size
+        planned.append(chunks)
+    return planned
+
+
+def compact(client, source_url, target_url, chunk_bytes, codec="gzip", incremental=True, slices=1):
+    """
+    Stream the JSON objects under the source prefix into compressed line-delimited chunks
+    under the target prefix. Only one source object and one round of chunks are held at a time.
+    Every round writes slices chunks (see plan_rounds), so that the chunks under the target prefix
+    are a multiple of the slices of the cluster and COPY gives each slice the same number of chunks.
+    Every chunk holds whole source objects and is recorded in the state as soon as it is uploaded;
+    the chunks missing from the state, e.g. uploaded by a run failing right after, are deleted first,
+    so that a failed run is run again without compacting twice any object.
+    In incremental mode the objects compacted by previous runs are skipped and the new ones are
+    written to new chunks, otherwise all the chunks of previous runs are deleted first
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    source_url : str
+    target_url : str
+    chunk_bytes : int
+        size of a chunk before compression
+    codec : str
+        gzip or zstd
+    incremental : bool
+    slices : int
+        slices of the cluster, see manifests.slice_count
+
+    Returns
+    -------
+    report : dict
+        number of objects and records compacted and the urls of the chunks written
+
+    """
+    if incremental:
+        state = read_state(client, target_url)
+    else:
+        # the previous chunks are forgotten before being deleted, a failure in between leaves them unrecorded
+        state = {}
+        write_state(client, target_url, state)
+    # COPY loads everything under the target prefix, the chunks not recorded would be loaded twice
+    remove_chunks(client, target_url, keep=state)
+    done = {key for keys in state.values() for key in keys}
+    source_bucket, _ = split_s3_url(source_url)
+    # chunks of different runs must not overwrite each other, even when started within the same second
+    name = f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    writers = [
+        ChunkWriter(client, target_url, f"{name}-{index:03d}", chunk_bytes, codec)
+        for index in range(slices)
+    ]
+
+    objects = [
+        (key, size)
+        for key, size in list_objects(client, source_url)
+        if key not in done and key.endswith(".json")
+    ]
+    records = 0
+    for round_chunks in plan_rounds(objects, chunk_bytes, slices):
+        for writer, keys in zip(writers, round_chunks):
+            for key in keys:
+                body = client.get_object(Bucket=source_bucket, Key=key)["Body"].read()
+                for record in iter_records(body.decode("utf-8")):
+                    writer.write(record)
+                    records += 1
+        for writer, keys in zip(writers, round_chunks):
+            record_chunk(client, target_url, state, writer.flush(), keys)
+        if not all(round_chunks):
+            logger.warning(
+                f"{sum(map(len, round_chunks))} objects for {slices} slices: "
+                "the chunks are not a multiple of the slices"
+            )
+
+    chunks = [chunk for writer in writers for chunk in writer.chunks]
+    logger.info(f"{len(objects)} objects ({records} records) compacted into {len(chunks)} chunks")
+    return {"objects": len(objects), "records": records, "chunks": chunks}
+
+
+def main(argv=None):
+    """
+    Compact log_data and song_data into LOG_TARGET and SONG_TARGET of the COMPACTION section
+
+    """
+    parser = argparse.ArgumentParser(description="Compact small JSON files into large compressed chunks")
+    parser.add_argument("--config", default="dwh.cfg")
+    parser.add_argument(
+        "--full", action="store_true", help="delete the chunks and compact again all the source files"
+    )
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    chunk_bytes = config.getint("COMPACTION", "CHUNK_MB", fallback=128) * 1024 * 1024
+    codec = config.get("COMPACTION", "CODEC", fallback="gzip").lower()
+    slices = slice_count(
+        config.get("HW", "NODE_TYPE", fallback="dc2.large"),
+        config.getint("HW", "NUMBER_OF_NODES", fallback=4),
+    )
+
+    client = boto3.client("s3")
+    for source, target in (("LOG_DATA", "LOG_TARGET"), ("SONG_DATA", "SONG_TARGET")):
+        if not config.get("COMPACTION", target, fallback=""):
+            logger.info(f"{target} not set, skipping {source}")
+            continue
+        compact(
+            client,
+            config["S3"][source],
+            config["COMPACTION"][target],
+            chunk_bytes,
+            codec,
+            incremental=not args.full,
+            slices=slices,
+        )
+
+
+if __name__ == "__main__":
+    main()
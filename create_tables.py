@@ -2,6 +2,10 @@ import configparser
 import psycopg2
 import logging
 from sql_queries import create_table_queries, drop_table_queries
+from physical_design import apply_profile, load_profile
+from db import get_connection
+from instrumentation import execute, start_run, finish_run
+from query_client import bump_load_generation
 
 
 FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
@@ -20,24 +24,27 @@ def drop_tables(cur, conn):
     """
     try:
         for query in drop_table_queries:
-            cur.execute(query)
+            execute(cur, query, "drop")
             conn.commit()
     except psycopg2.Error:
         logger.exception("Issue while dropping the tables")
 
 
-def create_tables(cur, conn):
-    """Create all the tables in sparkifydb if they do not exist
+def create_tables(cur, conn, profile=None):
+    """Create all the tables in sparkifydb if they do not exist, applying the distribution
+    style, sort keys and column encodings of the physical design profile
     
     Parameters
     ----------
     cur : psycopg2 Cursor
     conn : psycopg2 Connection
+    profile : dict, see physical_design.DEFAULT_PROFILE (None for no physical design)
     
     """
     try:
         for query in create_table_queries:
-            cur.execute(query)
+            query = apply_profile(query, profile or {})
+            execute(cur, query, "create")
             logger.info(f"Executing query {query}")
             conn.commit()
     except psycopg2.Error:
@@ -45,21 +52,21 @@ def create_tables(cur, conn):
 
 
 def main():
-    """Connect to the Redshift cluster reading the configuration file (dwh.cfg), drop the tables, and create them"""
+    """Connect to the Redshift cluster (or the local PostgreSQL database) reading the configuration file (dwh.cfg), drop the tables, and create them"""
 
     try:
         config = configparser.ConfigParser()
         config.read("dwh.cfg")
 
-        conn = psycopg2.connect(
-            "host={} dbname={} user={} password={} port={}".format(
-                *config["CLUSTER"].values()
-            )
-        )
+        conn = get_connection(config)
         cur = conn.cursor()
 
+        start_run(config, "create_tables")
         drop_tables(cur, conn)
-        create_tables(cur, conn)
+        create_tables(cur, conn, load_profile(config))
+        # the tables are empty now, the results cached before are stale
+        bump_load_generation(cur, conn)
+        finish_run(config, conn)
 
         conn.close()
     except psycopg2.Error:
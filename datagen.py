@@ -0,0 +1,337 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import string
+from datetime import datetime, timezone
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# pages of the non NextSong events, which carry no song, artist and length
+OTHER_PAGES = ["Home", "Login", "Logout", "Settings", "Help", "About", "Upgrade", "Downgrade"]
+
+NEXT_SONG_RATE = 0.8
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"
+
+LOCATIONS = [
+    "Houston-The Woodlands-Sugar Land, TX",
+    "London, England",
+    "New York-Newark-Jersey City, NY-NJ-PA",
+    "San Francisco-Oakland-Hayward, CA",
+    "Chicago-Naperville-Elgin, IL-IN-WI",
+]
+
+FIRST_NAMES = ["Theodore", "Jacqueline", "Kevin", "Lily", "Chloe", "Ryan", "Aleena", "Jayden"]
+LAST_NAMES = ["Smith", "Lynch", "Arellano", "Koch", "Cuevas", "Smith", "Kirby", "Fox"]
+
+
+def random_id(rng, prefix, length=16):
+    """Random identifier in the style of song_data, e.g. SONHOTT12A8C13493C"""
+    return prefix + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def zipf_cum_weights(count, skew):
+    """
+    Cumulative weights of a Zipf distribution over count items, i.e. item i has weight 1 / (i + 1) ** skew.
+    A skew of 0 gives a uniform distribution
+
+    Parameters
+    ----------
+    count : int
+    skew : float
+
+    Returns
+    -------
+    cum_weights : list of float
+
+    """
+    return list(itertools.accumulate(1 / (i + 1) ** skew for i in range(count)))
+
+
+def maybe_null(rng, value, null_rate):
+    """Return None with probability null_rate, the value otherwise"""
+    return None if rng.random() < null_rate else value
+
+
+def generate_songs(rng, count, null_rate):
+    """
+    Generate the songs of the catalogue, as in song_data
+
+    Parameters
+    ----------
+    rng : random.Random
+    count : int
+    null_rate : float
+        probability of a NULL in the optional fields (artist location, latitude, longitude and year)
+
+    Returns
+    -------
+    songs : list of dict
+
+    """
+    artists = [
+        {
+            "artist_id": random_id(rng, "AR"),
+            "artist_name": f"Artist {i}",
+            "artist_location": maybe_null(rng, rng.choice(LOCATIONS), null_rate),
+            "artist_latitude": maybe_null(rng, round(rng.uniform(-90, 90), 5), null_rate),
+            "artist_longitude": maybe_null(rng, round(rng.uniform(-180, 180), 5), null_rate),
+        }
+        for i in range(max(1, count // 4))
+    ]
+    songs = []
+    for i in range(count):
+        song = {"num_songs": 1}
+        song.update(rng.choice(artists))
+        song.update(
+            {
+                "song_id": random_id(rng, "SO"),
+                "title": f"Song {i}",
+                "duration": round(rng.uniform(60, 600), 5),
+                # song_data uses 0 for an unknown year
+                "year": 0 if rng.random() < null_rate else rng.randint(1960, 2018),
+            }
+        )
+        songs.append(song)
+    return songs
+
+
+def write_songs(root, songs, rng):
+    """
+    Write one file per song under song_data/X/Y/Z/, as in song_data/A/A/A/TRAAAEF128F4273421.json
+
+    Parameters
+    ----------
+    root : str
+    songs : list of dict
+    rng : random.Random
+
+    """
+    for song in songs:
+        track_id = random_id(rng, "TR")
+        directory = os.path.join(root, "song_data", *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{track_id}.json"), "w") as song_file:
+            json.dump(song, song_file)
+
+
+def generate_users(rng, count, null_rate):
+    """Generate the users of the app, with the fields repeated in their events"""
+    return [
+        {
+            "userId": str(i + 1),
+            "firstName": rng.choice(FIRST_NAMES),
+            "lastName": rng.choice(LAST_NAMES),
+            "gender": maybe_null(rng, rng.choice("MF"), null_rate),
+            "level": rng.choice(["free", "paid"]),
+            "location": maybe_null(rng, rng.choice(LOCATIONS), null_rate),
+            "registration": 1540000000000.0 + rng.randint(0, 10 ** 9),
+        }
+        for i in range(count)
+    ]
+
+
+def generate_events(rng, count, songs, users, days, start, match_rate, skew):
+    """
+    Generate the events of log_data in chronological order, one at a time
+
+    Parameters
+    ----------
+    rng : random.Random
+    count : int
+    songs : list of dict
+    users : list of dict
+    days : int
+    start : datetime
+    match_rate : float
+        probability that a NextSong event matches a song of the catalogue
+    skew : float
+        Zipf skew of the popularity of songs and users
+
+    Yields
+    ------
+    event : dict
+
+    """
+    song_weights = zipf_cum_weights(len(songs), skew)
+    user_weights = zipf_cum_weights(len(users), skew)
+    step = days * 86400 * 1000 / max(count, 1)
+    origin = int(start.timestamp() * 1000)
+    sessions = {}
+
+    for i in range(count):
+        user = rng.choices(users, cum_weights=user_weights)[0]
+        session = sessions.setdefault(user["userId"], [rng.randint(1, 10 ** 6), 0])
+        if rng.random() < 0.01:
+            session[0], session[1] = rng.randint(1, 10 ** 6), 0
+            # users move from free to paid and back from time to time
+            user["level"] = "paid" if user["level"] == "free" else "free"
+        session[1] += 1
+
+        event = {
+            "artist": None,
+            "auth": "Logged In",
+            "firstName": user["firstName"],
+            "gender": user["gender"],
+            "itemInSession": session[1],
+            "lastName": user["lastName"],
+            "length": None,
+            "level": user["level"],
+            "location": user["location"],
+            "method": "PUT",
+            "page": rng.choice(OTHER_PAGES),
+            "registration": user["registration"],
+            "sessionId": session[0],
+            "song": None,
+            "status": 200,
+            "ts": origin + int(i * step),
+            "userAgent": USER_AGENT,
+            "userId": user["userId"],
+        }
+        if rng.random() < NEXT_SONG_RATE:
+            song = rng.choices(songs, cum_weights=song_weights)[0]
+            event.update(
+                {
+                    "page": "NextSong",
+                    "artist": song["artist_name"],
+                    "song": song["title"],
+                    "length": song["duration"],
+                }
+            )
+            if rng.random() >= match_rate:
+                # a song missing from the catalogue
+                event["song"] = f"Unknown {rng.randint(0, 10 ** 9)}"
+        yield event
+
+
+def write_events(root, events):
+    """
+    Write the events into one file per day, as in log_data/2018/11/2018-11-04-events.json,
+    keeping a single file open at a time
+
+    Parameters
+    ----------
+    root : str
+    events : iterable of dict
+        in chronological order
+
+    Returns
+    -------
+    files : int
+
+    """
+    files = 0
+    for day, day_events in itertools.groupby(
+        events,
+        key=lambda event: datetime.fromtimestamp(event["ts"] / 1000, tz=timezone.utc).date(),
+    ):
+        directory = os.path.join(root, "log_data", f"{day.year:04d}", f"{day.month:02d}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{day.isoformat()}-events.json"), "w") as log_file:
+            for event in day_events:
+                log_file.write(json.dumps(event) + "\n")
+        files += 1
+    return files
+
+
+def generate(
+    root,
+    events,
+    songs=None,
+    users=None,
+    days=30,
+    match_rate=0.9,
+    skew=1.0,
+    null_rate=0.1,
+    seed=0,
+    start=datetime(2018, 11, 1, tzinfo=timezone.utc),
+):
+    """
+    Generate song_data and log_data under root, in the formats described in the README
+
+    Parameters
+    ----------
+    root : str
+    events : int
+    songs : int
+        by default one song every 20 events
+    users : int
+        by default one user every 100 events
+    days : int
+        number of days of log_data
+    match_rate : float
+        probability that a NextSong event matches a song of the catalogue
+    skew : float
+        Zipf skew of the popularity of songs and users, 0 for uniform
+    null_rate : float
+        probability of a NULL in the optional fields
+    seed : int
+    start : datetime
+        first day of log_data
+
+    Returns
+    -------
+    summary : dict
+
+    """
+    rng = random.Random(seed)
+    songs = songs or max(1, events // 20)
+    users = users or max(1, events // 100)
+
+    catalogue = generate_songs(rng, songs, null_rate)
+    write_songs(root, catalogue, rng)
+    logger.info(f"{songs} songs written")
+
+    files = write_events(
+        root,
+        generate_events(
+            rng, events, catalogue, generate_users(rng, users, null_rate), days, start, match_rate, skew
+        ),
+    )
+    logger.info(f"{events} events written into {files} files")
+
+    return {
+        "events": events,
+        "songs": songs,
+        "users": users,
+        "days": days,
+        "match_rate": match_rate,
+        "skew": skew,
+        "null_rate": null_rate,
+        "seed": seed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song_data and log_data")
+    parser.add_argument("output", help="directory where song_data and log_data are written")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--songs", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--match-rate", type=float, default=0.9)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--null-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    generate(
+        args.output,
+        args.events,
+        songs=args.songs,
+        users=args.users,
+        days=args.days,
+        match_rate=args.match_rate,
+        skew=args.skew,
+        null_rate=args.null_rate,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
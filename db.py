@@ -0,0 +1,269 @@
+import contextlib
+import logging
+import re
+import threading
+import psycopg2
+import psycopg2.extensions
+from sql_queries import query_group_set, slot_count_set
+
+logger = logging.getLogger(__name__)
+
+
+def get_backend(config):
+    """
+    Return the backend the ETL runs on: redshift (default) or postgres for a local PostgreSQL
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    backend : str
+
+    """
+    backend = config.get("ETL", "BACKEND", fallback="redshift").strip().lower()
+    if backend not in ("redshift", "postgres"):
+        raise ValueError(f"Unknown backend {backend}")
+    return backend
+
+
+def connection_params(config):
+    """
+    Return the parameters of psycopg2.connect for the cluster described in the CLUSTER section or,
+    with the postgres backend, for the database described in the LOCAL section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    (dsn, options) : tuple
+        connection string and keyword arguments, e.g. the cursor_factory
+
+    """
+    if get_backend(config) == "postgres":
+        local = config["LOCAL"]
+        dsn = "host={} dbname={} user={} password={} port={}".format(
+            local["HOST"],
+            local["DB_NAME"],
+            local["DB_USER"],
+            local["DB_PASSWORD"],
+            local["DB_PORT"],
+        )
+        return dsn, {"cursor_factory": PostgresCursor}
+
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config["CLUSTER"].values())
+    return dsn, {}
+
+
+def get_connection(config, query_group=None):
+    """
+    Open a new connection to the cluster described in the CLUSTER section or, with the postgres
+    backend, to the database described in the LOCAL section. The cursors of the latter translate
+    the Redshift dialect of sql_queries.py (see to_postgres).
+    On Redshift the queries of the connection are routed to QUERY_GROUP of the WLM section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    query_group : str
+        query group instead of QUERY_GROUP, e.g. the one of the analysts
+
+    Returns
+    -------
+    conn : psycopg2 Connection
+
+    """
+    dsn, options = connection_params(config)
+    conn = psycopg2.connect(dsn, **options)
+    if query_group is None:
+        query_group = config.get("WLM", "QUERY_GROUP", fallback="")
+    if query_group and get_backend(config) == "redshift":
+        set_query_group(conn, query_group)
+    return conn
+
+
+def set_query_group(conn, query_group):
+    """
+    Route the following queries of a connection to the WLM queue of a query group
+
+    Parameters
+    ----------
+    conn : psycopg2 Connection
+    query_group : str
+
+    """
+    with conn.cursor() as cur:
+        cur.execute(query_group_set, (query_group,))
+    conn.commit()
+
+
+def slot_count(config, *names):
+    """
+    Return the WLM slots taken by the queries of a stage or of an insert node: SLOTS_<NAME> of the WLM
+    section for the first name set, e.g. SLOTS_SONGPLAYS before SLOTS_INSERT, otherwise SLOTS
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    names : str
+        e.g. songplays, insert
+
+    Returns
+    -------
+    slots : int
+        None when the backend has no WLM
+
+    """
+    if config is None or get_backend(config) != "redshift" or not config.has_section("WLM"):
+        return None
+    for name in names:
+        option = f"SLOTS_{name.upper()}"
+        if config.has_option("WLM", option):
+            return config.getint("WLM", option)
+    return config.getint("WLM", "SLOTS", fallback=1)
+
+
+def check_slots(config, stage, workers, slots):
+    """
+    Warn when the workers of a stage may take more WLM slots at once than the ETL queue has
+    (ETL_CONCURRENCY of the WLM section): the queries beyond it wait in the queue
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    stage : str
+        e.g. staging, for the warning
+    workers : int
+    slots : list of int
+        slots of every query the workers run, see slot_count
+
+    Returns
+    -------
+    demand : int
+        most slots taken at once, None when the backend has no WLM
+
+    """
+    if not slots or None in slots:
+        return None
+    concurrency = config.getint("WLM", "ETL_CONCURRENCY", fallback=3)
+    demand = sum(sorted(slots, reverse=True)[:workers])
+    if demand > concurrency:
+        logger.warning(
+            f"{workers} {stage} workers may take {demand} WLM slots, more than the {concurrency} "
+            "of ETL_CONCURRENCY: lower the workers or the slots, or raise ETL_CONCURRENCY"
+        )
+    return demand
+
+
+@contextlib.contextmanager
+def query_slots(cur, config, *names):
+    """
+    Run the queries of the block with the WLM slots of a stage or node (see slot_count),
+    giving back the default slots at the end
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    config : configparser.ConfigParser
+        None to leave the slots unchanged
+    names : str
+
+    """
+    slots = slot_count(config, *names)
+    default = config.getint("WLM", "SLOTS", fallback=1) if slots is not None else None
+    if slots is None or slots == default:
+        yield
+        return
+
+    cur.execute(slot_count_set, (slots,))
+    try:
+        yield
+    finally:
+        # after a failure the rollback of the caller also undoes the SET
+        if cur.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            cur.execute(slot_count_set, (default,))
+
+
+# Redshift constructs and their PostgreSQL equivalent
+POSTGRES_SHIMS = [
+    # IDENTITY(seed, step)
+    (
+        re.compile(r"IDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)", re.IGNORECASE),
+        r"GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)",
+    ),
+    # foreign keys are not enforced by Redshift, while PostgreSQL would reject the merges
+    (re.compile(r"\s+REFERENCES\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\bGETDATE\(\)", re.IGNORECASE), "NOW()"),
+    # PostgreSQL has no sort order to restore, its VACUUM only reclaims the deleted rows
+    (re.compile(r"\bVACUUM\s+(?:SORT\s+ONLY|DELETE\s+ONLY|FULL)\b", re.IGNORECASE), "VACUUM"),
+    # STRTOL of the 8 hex digits of a hash, e.g. the export fingerprints
+    (
+        re.compile(r"\bSTRTOL\((.+?),\s*16\)", re.IGNORECASE),
+        r"('x' || \1)::bit(32)::bigint",
+    ),
+]
+
+
+def to_postgres(query):
+    """
+    Translate the Redshift specific parts of a query to PostgreSQL
+
+    Parameters
+    ----------
+    query : str
+
+    Returns
+    -------
+    query : str
+
+    """
+    for pattern, replacement in POSTGRES_SHIMS:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+class PostgresCursor(psycopg2.extensions.cursor):
+    """Cursor translating the Redshift dialect to PostgreSQL before executing a query"""
+
+    def execute(self, query, vars=None):
+        # the statements composed by psycopg2.extras, e.g. execute_values, are bytes holding the values already
+        if isinstance(query, str):
+            query = to_postgres(query)
+        return super().execute(query, vars)
+
+
+class WorkerConnections:
+    """
+    Lazily open one connection per worker thread and keep track of them to close them all at the end
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self):
+        """
+        Return the connection of the calling thread, opening it on first use
+
+        Returns
+        -------
+        conn : psycopg2 Connection
+
+        """
+        if not hasattr(self._local, "conn"):
+            self._local.conn = get_connection(self.config)
+            with self._lock:
+                self._connections.append(self._local.conn)
+        return self._local.conn
+
+    def close(self):
+        """Close all the connections opened by the workers"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
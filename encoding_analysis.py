@@ -0,0 +1,218 @@
+import argparse
+import configparser
+import copy
+import json
+import logging
+import os
+import psycopg2
+from db import get_backend, get_connection
+from instrumentation import execute
+from physical_design import load_profile
+from sql_queries import analyze_compression_template, table_sizes_select
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def analyze_compression(cur, table, comprows=100000):
+    """
+    Run ANALYZE COMPRESSION on a sample of the rows of a table
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    table : str
+    comprows : int
+        rows sampled
+
+    Returns
+    -------
+    recommendations : dict
+        column -> (encoding, estimated reduction in percent)
+
+    """
+    execute(cur, analyze_compression_template.format(table=table, comprows=comprows), "encoding")
+    return {
+        column: (encoding.upper(), float(reduction or 0))
+        for _, column, encoding, reduction in cur.fetchall()
+    }
+
+
+def encoding_profile(base, recommendations):
+    """
+    Build a physical design profile with the recommended encodings, keeping distribution and
+    sort keys of the base profile. The first sort key column stays RAW, as in DEFAULT_PROFILE
+
+    Parameters
+    ----------
+    base : dict
+        physical design profile, see physical_design.DEFAULT_PROFILE
+    recommendations : dict
+        table -> column -> (encoding, reduction), see analyze_compression
+
+    Returns
+    -------
+    profile : dict
+
+    """
+    profile = copy.deepcopy(base)
+    for table, columns in recommendations.items():
+        design = profile.setdefault(table, {})
+        sortkey = design.get("sortkey", [])[:1]
+        encode = design.setdefault("encode", {})
+        for column, (encoding, _) in columns.items():
+            encode[column] = "RAW" if column in sortkey else encoding
+    return profile
+
+
+def table_sizes(cur, tables):
+    """
+    Read the size of the tables from svv_table_info
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    tables : list of str
+
+    Returns
+    -------
+    sizes : dict
+        table -> size in MB
+
+    """
+    if not tables:
+        return {}
+    execute(cur, table_sizes_select, "encoding", (tuple(tables),))
+    return {table: size for table, size in cur.fetchall()}
+
+
+def compare_sizes(before, after):
+    """
+    Compare the size of the tables before and after applying a profile
+
+    Parameters
+    ----------
+    before : dict
+        table -> size in MB
+    after : dict
+        table -> size in MB
+
+    Returns
+    -------
+    comparison : dict
+        table -> before, after and change in percent (None when a size is missing)
+
+    """
+    comparison = {}
+    for table in sorted(set(before) | set(after)):
+        old, new = before.get(table), after.get(table)
+        change = 100.0 * (new - old) / old if old and new is not None else None
+        comparison[table] = {"before_mb": old, "after_mb": new, "change_pct": change}
+    return comparison
+
+
+def analyze(config, conn, profile_path, report_path):
+    """
+    Analyze the compression of the tables of the current profile, write the profile with the
+    recommended encodings and record the current table sizes for the report
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    conn : psycopg2 Connection
+    profile_path : str
+    report_path : str
+
+    """
+    base = load_profile(config)
+    comprows = config.getint("ENCODING", "COMPROWS", fallback=100000)
+    recommendations = {}
+    with conn.cursor() as cur:
+        for table in base:
+            recommendations[table] = analyze_compression(cur, table, comprows)
+            summary = ", ".join(
+                f"{column} {encoding} (-{reduction:.0f}%)"
+                for column, (encoding, reduction) in recommendations[table].items()
+            )
+            logger.info(f"{table}: {summary}")
+        sizes = table_sizes(cur, list(base))
+
+    with open(profile_path, "w") as profile_file:
+        json.dump(encoding_profile(base, recommendations), profile_file, indent=2)
+    with open(report_path, "w") as report_file:
+        json.dump({"profile": profile_path, "before_mb": sizes}, report_file, indent=2)
+    logger.info(
+        f"Profile written to {profile_path}: set PROFILE = {profile_path} in the DESIGN section, "
+        "run create_tables.py and etl.py, then encoding_analysis.py report"
+    )
+
+
+def report(conn, report_path):
+    """
+    Compare the current table sizes with the ones recorded by analyze and add them to the report
+
+    Parameters
+    ----------
+    conn : psycopg2 Connection
+    report_path : str
+
+    Returns
+    -------
+    comparison : dict
+        see compare_sizes
+
+    """
+    with open(report_path) as report_file:
+        saved = json.load(report_file)
+    with conn.cursor() as cur:
+        after = table_sizes(cur, list(saved["before_mb"]))
+    comparison = compare_sizes(saved["before_mb"], after)
+
+    saved["comparison"] = comparison
+    with open(report_path, "w") as report_file:
+        json.dump(saved, report_file, indent=2)
+    for table, sizes in comparison.items():
+        change = "" if sizes["change_pct"] is None else f" ({sizes['change_pct']:+.1f}%)"
+        logger.info(f"{table}: {sizes['before_mb']} MB -> {sizes['after_mb']} MB{change}")
+    return comparison
+
+
+def main(argv=None):
+    """
+    analyze: write an encoding profile from ANALYZE COMPRESSION on the loaded tables;
+    report: compare the table sizes once the tables have been loaded again with it
+
+    """
+    parser = argparse.ArgumentParser(description="Encoding profile from ANALYZE COMPRESSION")
+    parser.add_argument("action", choices=["analyze", "report"])
+    parser.add_argument("--config", default="dwh.cfg")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if get_backend(config) == "postgres":
+        logger.error("ANALYZE COMPRESSION is not supported by the postgres backend")
+        return
+
+    profile_path = config.get("ENCODING", "PROFILE_OUTPUT", fallback="encoding_profile.json")
+    report_path = config.get("ENCODING", "REPORT", fallback="encoding_report.json")
+    if args.action == "report" and not os.path.exists(report_path):
+        logger.error(f"{report_path} not found, run encoding_analysis.py analyze first")
+        return
+
+    try:
+        conn = get_connection(config)
+        # ANALYZE COMPRESSION cannot run inside a transaction block
+        conn.autocommit = True
+        if args.action == "analyze":
+            analyze(config, conn, profile_path, report_path)
+        else:
+            report(conn, report_path)
+        conn.close()
+    except psycopg2.Error:
+        logger.exception("Issue while analyzing the compression of the tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,39 @@
+import argparse
 import configparser
+import boto3
 import psycopg2
+from botocore.exceptions import ClientError
 import logging
-from sql_queries import copy_table_queries, insert_table_queries
+import re
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import copy_table_queries, post_copy_queries, insert_table_graph
+from merge import merge_dimension
+from scheduler import run_dag, critical_path
+from db import get_backend, get_connection, check_slots, query_slots, slot_count, WorkerConnections
+from instrumentation import execute, start_run, finish_run
+from create_tables import create_tables
+from physical_design import load_profile
+import incremental
+import partitioned
+import local_loader
+import validate
+import shadow
+from resources import record_load, restored_snapshot
+from manage_cluster import resize_resources
+import sizing
+from maintenance import run_maintenance
+from aggregates import refresh_aggregates, check_aggregates
+from query_client import bump_load_generation
+from export import run_export
 
 FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_staging_tables(cur, conn):
+
+def load_staging_tables(cur, conn, queries=copy_table_queries):
     """
     Load data into staging tables by means of COPY queries
 
@@ -15,61 +41,709 @@ def load_staging_tables(cur, conn):
     ----------
     cur : psycopg2 Cursor
     conn : psycopg2 Connection
+    queries : list of str
+        COPY queries, e.g. tolerating the bad records found by validate.py
+
+    Returns
+    -------
+    success : bool
 
     """
     try:
 
-        for query in copy_table_queries:
+        for query in queries:
             logger.info(f"Executing query {query}")
-            cur.execute(query)
+            execute(cur, query, "staging")
+            run_post_copy(cur, copy_table_name(query))
             conn.commit()
+        return True
 
     except psycopg2.Error:
+        conn.rollback()
         logger.exception("Issue while loading data into staging tables")
     except Exception:
         logger.exception(f"Issue while preparing query {query}")
+    return False
+
+
+def load_staging_tables_parallel(config, workers=2, queries=copy_table_queries):
+    """
+    Load data into staging tables running the COPY queries concurrently,
+    each worker using its own connection to the cluster
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    workers : int
+    queries : list of str
+
+    Returns
+    -------
+    results : dict
+        staging table name -> None if the COPY succeeded, the error message otherwise
+
+    """
+    check_slots(config, "staging", workers, [slot_count(config, "staging") for _ in queries])
+    connections = WorkerConnections(config)
+
+    def copy(query):
+        conn = connections.get()
+        logger.info(f"Executing query {query}")
+        try:
+            with conn.cursor() as cur, query_slots(cur, config, "staging"):
+                execute(cur, query, "staging")
+                run_post_copy(cur, copy_table_name(query))
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            return str(e).strip()
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                copy_table_name(query): executor.submit(copy, query)
+                for query in queries
+            }
+            results = {}
+            for table, future in futures.items():
+                try:
+                    results[table] = future.result()
+                except Exception as e:
+                    # e.g. the worker could not connect to the cluster
+                    results[table] = str(e).strip()
+    finally:
+        connections.close()
+
+    for table, error in results.items():
+        if error is None:
+            logger.info(f"COPY into {table} succeeded")
+        else:
+            logger.error(f"COPY into {table} failed: {error}")
+
+    return results
+
+
+def copy_table_name(query):
+    """
+    Return the name of the table a COPY query loads into
+
+    Parameters
+    ----------
+    query : str
 
+    Returns
+    -------
+    table : str
 
-def insert_tables(cur, conn):
     """
-    Execute INSERT queries to load data from staging tables to redshift database
+    return re.match(r"\s*COPY\s+(\w+)", query, re.IGNORECASE).group(1)
+
+
+def run_post_copy(cur, table):
+    """
+    Run the queries preparing a staging table after its COPY, e.g. computing the match key
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    table : str
+
+    """
+    for query in post_copy_queries.get(table, []):
+        logger.info(f"Executing query {query}")
+        execute(cur, query, "staging")
+
+
+def insert_tables(cur, conn, graph=insert_table_graph, config=None):
+    """
+    Execute INSERT queries to load data from staging tables to redshift database,
+    merging the dimension tables before filling songplays. Every node is committed with a bump
+    of the load generation, so the cached results expire even if a later node fails
 
     Parameters
     ----------
     cur : psycopg2 Cursor
     conn : psycopg2 Connection
+    graph : list of dict
+        insert graph, see sql_queries.insert_table_graph
+    config : configparser.ConfigParser
+        WLM slots of the inserts (see db.slot_count), None to leave them unchanged
+
+    Returns
+    -------
+    success : bool
 
     """
     try:
-        for query in insert_table_queries:
-            logger.info(f"Executing query {query}")
-            cur.execute(query)
+        for node in graph:
+            with query_slots(cur, config, node["name"], "insert"):
+                run_insert(cur, node)
+            bump_load_generation(cur)
             conn.commit()
+        return True
 
     except psycopg2.Error:
+        conn.rollback()
         logger.exception("Issue while inserting data into redshift database")
+        return False
 
 
-def main():
+def run_insert(cur, node):
     """
-    Connect to Redshift database, load data into staging tables and then execute insert queries
+    Run a node of insert_table_graph: either merge a dimension or execute its queries
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    node : dict
+
+    Returns
+    -------
+    counts : dict
+        rows inserted, updated and unchanged for merges, None for queries
 
     """
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
+    if "merge" in node:
+        return merge_dimension(cur, node["merge"])
 
-    conn = psycopg2.connect(
-        "host={} dbname={} user={} password={} port={}".format(
-            *config["CLUSTER"].values()
-        )
+    for query in node.get("queries", [node.get("query")]):
+        logger.info(f"Executing query {query}")
+        execute(cur, query, "insert")
+    return None
+
+
+def insert_tables_parallel(config, workers=4, graph=insert_table_graph):
+    """
+    Execute INSERT queries following the dependencies declared in insert_table_graph,
+    running independent queries concurrently, each worker using its own connection.
+    The load generation is bumped after the commit of every node, in a transaction of its own:
+    concurrent transactions updating it would fail with a serializable isolation violation on Redshift
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    workers : int
+    graph : list of dict
+        insert graph, see sql_queries.insert_table_graph
+
+    Returns
+    -------
+    timings : dict
+        insert name -> status, start, end, duration and error (see scheduler.run_dag)
+
+    """
+    check_slots(
+        config, "insert", workers, [slot_count(config, node["name"], "insert") for node in graph]
     )
-    cur = conn.cursor()
-    load_staging_tables(cur, conn)
+    connections = WorkerConnections(config)
+    generation_lock = threading.Lock()
+
+    def insert(node):
+        conn = connections.get()
+        try:
+            with conn.cursor() as cur:
+                with query_slots(cur, config, node["name"], "insert"):
+                    run_insert(cur, node)
+                conn.commit()
+                with generation_lock:
+                    bump_load_generation(cur, conn)
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+
+    try:
+        timings = run_dag(graph, insert, workers)
+    finally:
+        connections.close()
+
+    for name, timing in timings.items():
+        if timing["status"] == "skipped":
+            logger.info(f"{name}: skipped")
+        else:
+            logger.info(
+                f"{name}: {timing['status']} "
+                f"(start {timing['start']:.2f}s, duration {timing['duration']:.2f}s)"
+            )
+    path, duration = critical_path(graph, timings)
+    logger.info(f"Critical path: {' -> '.join(path)} ({duration:.2f}s)")
+
+    return timings
+
+
+def load_full(config, cur, conn):
+    """
+    Load the whole of log_data and song_data into the staging tables and fill the final tables
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    success : bool
+
+    """
+    loaded_at = datetime.now(timezone.utc)
+    return (
+        load_staging(config, cur, conn)
+        and fill_tables(config, cur, conn)
+        and finish_full_load(cur, conn, loaded_at)
+    )
+
+
+def finish_full_load(cur, conn, loaded_at):
+    """
+    Recompute the aggregate tables, bumping the load generation in the same transaction,
+    and move the watermarks to the last partition loaded and to the start of the load for song_data
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    loaded_at : datetime
+        start of the load (UTC)
+
+    Returns
+    -------
+    success : bool
+
+    """
+    try:
+        refresh_aggregates(cur, full=True)
+        bump_load_generation(cur)
+        conn.commit()
+        incremental.advance_watermark(cur, conn)
+        incremental.advance_song_watermark(cur, conn, loaded_at)
+        return True
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while refreshing the aggregates and the watermark")
+        return False
+
+
+def validate_sources(config):
+    """
+    Validate the source files before loading them (see validate.py)
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    report : dict
+        see validate.validate_staging_sources, None if the files could not be validated
+        or a table has more than MAX_BAD_RATIO bad records
+
+    """
+    try:
+        report = validate.validate_staging_sources(config)
+    except (ClientError, OSError, ValueError):
+        logger.exception("Issue while validating the source files")
+        return None
+
+    max_ratio = config.getfloat("VALIDATION", "MAX_BAD_RATIO", fallback=0.001)
+    if get_backend(config) == "postgres":
+        # local_loader.py has no MAXERROR, a single bad record fails the load
+        max_ratio = 0.0
+    for table, summary in report.items():
+        if validate.bad_ratio(summary) > max_ratio:
+            logger.error(
+                f"{table}: {summary['bad_records']} bad records out of {summary['records']}, "
+                "staging tables not loaded"
+            )
+            return None
+    return report
+
+
+def report_load_errors(config, cur, conn, report, since):
+    """
+    Add the rows rejected by the COPY queries to the validation report and write it to REPORT
+    of the VALIDATION section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    report : dict
+    since : datetime
+        start of the COPY queries (UTC)
+
+    """
+    if get_backend(config) == "redshift":
+        try:
+            report["load_errors"] = validate.load_errors(cur, since)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Issue while reading the load errors")
+        for error in report.get("load_errors", [])[:10]:
+            logger.warning(
+                f"{error['table']} rejected {error['file']} line {error['line']} "
+                f"({error['column']}): {error['reason']}"
+            )
+
+    path = config.get("VALIDATION", "REPORT", fallback="validation_report.json")
+    validate.write_report(path, report)
+    logger.info(f"Validation report written to {path}")
+
+
+def load_staging(config, cur, conn):
+    """
+    Load the whole of log_data and song_data into the staging tables.
+    With the postgres backend the staging tables are loaded from local directories (see local_loader.py).
+    With validation enabled the source files are validated first and the COPY queries tolerate
+    the bad records found
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    success : bool
+
+    """
+    workers = config.getint("ETL", "STAGING_WORKERS", fallback=1)
+    report = None
+    if config.getboolean("VALIDATION", "ENABLED", fallback=False):
+        report = validate_sources(config)
+        if report is None:
+            return False
+    queries = validate.copy_queries(report) if report else copy_table_queries
+    since = validate.utc_now()
+
+    success = True
+    if get_backend(config) == "postgres":
+        try:
+            local_loader.load_staging_tables(cur, conn, config)
+            for table in post_copy_queries:
+                run_post_copy(cur, table)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Issue while loading data into staging tables")
+            success = False
+    elif workers > 1:
+        results = load_staging_tables_parallel(config, workers, queries)
+        success = all(error is None for error in results.values())
+    else:
+        with query_slots(cur, config, "staging"):
+            success = load_staging_tables(cur, conn, queries)
+
+    if report:
+        report_load_errors(config, cur, conn, report, since)
+    if not success:
+        logger.error("Staging tables not loaded, skipping final tables")
+        return False
     logger.info("Staging tables loaded successfully")
-    insert_tables(cur, conn)
+    return True
+
+
+def fill_tables(config, cur, conn, graph=insert_table_graph):
+    """
+    Fill the final tables from the staging tables
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    graph : list of dict
+        insert graph, see sql_queries.insert_table_graph
+
+    Returns
+    -------
+    success : bool
+
+    """
+    insert_workers = config.getint("ETL", "INSERT_WORKERS", fallback=1)
+    if insert_workers > 1:
+        timings = insert_tables_parallel(config, insert_workers, graph)
+        if any(timing["status"] != "succeeded" for timing in timings.values()):
+            logger.error("Final tables not loaded")
+            return False
+    elif not insert_tables(cur, conn, graph, config):
+        return False
     logger.info("Final tables loaded successfully")
+    return True
+
+
+def load_shadow(config, cur, conn):
+    """
+    Load the whole of log_data and song_data into shadow copies of the final tables, which stay
+    queryable meanwhile, then validate the shadow tables and swap them in
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    success : bool
+
+    """
+    profile = load_profile(config)
+    # the tables are created only if missing, nothing is dropped
+    create_tables(cur, conn, profile)
+    try:
+        shadow.prepare_shadow_tables(cur, conn, profile)
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while creating the shadow tables")
+        return False
+
+    loaded_at = datetime.now(timezone.utc)
+    if not (load_staging(config, cur, conn) and fill_tables(config, cur, conn, shadow.shadow_graph())):
+        logger.error("Shadow tables not loaded, the final tables are unchanged")
+        return False
+
+    problems = shadow.validate_shadow_tables(
+        cur, config.getfloat("SHADOW", "MIN_ROW_RATIO", fallback=0.9)
+    )
+    if problems:
+        for problem in problems:
+            logger.error(problem)
+        logger.error("Shadow tables not swapped in, the final tables are unchanged")
+        return False
+
+    try:
+        shadow.swap(cur, conn)
+    except psycopg2.Error:
+        logger.exception("Issue while swapping the shadow tables")
+        return False
+    return finish_full_load(cur, conn, loaded_at)
+
+
+def rollback_shadow(cur, conn):
+    """
+    Restore the final tables replaced by the last shadow load and recompute the aggregate tables
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    success : bool
+
+    """
+    try:
+        if not shadow.rollback(cur, conn):
+            return False
+        refresh_aggregates(cur, full=True)
+        bump_load_generation(cur)
+        conn.commit()
+        return True
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while restoring the previous tables")
+        return False
+
+
+def load_incremental(config, cur, conn, partitions=()):
+    """
+    Load only the log_data partitions after the watermark (plus the given ones) and merge them
+    into the existing final tables
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    partitions : iterable of str
+        dates of partitions to load again, e.g. 2018-11-04
+
+    Returns
+    -------
+    success : bool
+
+    """
+    if get_backend(config) == "postgres":
+        logger.error("Incremental loads read log_data from S3, they are not supported by the postgres backend")
+        return False
+
+    # the tables are created only if missing, nothing is dropped
+    create_tables(cur, conn, load_profile(config))
+    try:
+        loaded, failed = incremental.load_incremental(
+            cur,
+            conn,
+            boto3.client("s3"),
+            config["S3"]["LOG_DATA"],
+            config["S3"]["SONG_DATA"],
+            partitions,
+            config["S3"].get("NEW_SONG_MANIFEST") or None,
+        )
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while loading song_data, no log_data partition loaded")
+        return False
+    logger.info(f"Partitions loaded: {', '.join(loaded) or 'none'}")
+    if failed is not None:
+        logger.error(f"Partition {failed} not loaded, the next run will start from it")
+        return False
+    return True
+
+
+def load_partitioned(config, cur, conn, resume=False):
+    """
+    Load log_data one month per worker in parallel, checkpointing every month, and resume
+    the months not completed by the last run with resume
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    resume : bool
+
+    Returns
+    -------
+    success : bool
+
+    """
+    if get_backend(config) == "postgres":
+        logger.error("Partitioned loads read log_data from S3, they are not supported by the postgres backend")
+        return False
+
+    profile = load_profile(config)
+    create_tables(cur, conn, profile)
+    try:
+        loaded, failed = partitioned.load_partitioned(
+            config, cur, conn, boto3.client("s3"), config["S3"]["LOG_DATA"], profile, resume
+        )
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while preparing the partitioned load, no partition loaded")
+        return False
+    logger.info(f"Partitions loaded: {', '.join(loaded) or 'none'}")
+    if failed:
+        logger.error(f"Partitions {', '.join(failed)} not loaded, run again with --resume")
+        return False
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sparkify ETL pipeline")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="load only the log_data partitions after the last one loaded",
+    )
+    parser.add_argument(
+        "--partition",
+        action="append",
+        default=[],
+        metavar="YYYY-MM-DD",
+        help="load again a log_data partition in incremental mode (can be repeated)",
+    )
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="load shadow copies of the final tables and swap them in once validated",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="restore the final tables replaced by the last shadow load",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="load log_data one month per worker in parallel, checkpointing every month",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="load again the months not completed by the last partitioned load",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="load everything again even if the cluster was restored from a loaded snapshot",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Connect to Redshift database, load data into staging tables and then execute insert queries
+
+    """
+    args = parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+
+    # elastic resize up for the ETL window, the connections are opened once it is done
+    etl_nodes = config.getint("SIZING", "ETL_NODES", fallback=0)
+    resized_from = None
+    if etl_nodes and get_backend(config) == "redshift":
+        resized_from = resize_resources(etl_nodes)
+
+    # the cluster is resized back even if the load fails
+    try:
+        conn = get_connection(config)
+        cur = conn.cursor()
+        start_run(config, "etl")
+        snapshot_id = None if args.full else restored_snapshot()
+        if snapshot_id:
+            logger.info(f"Cluster restored from {snapshot_id}, loading only the new partitions")
+
+        loaded = False
+        if args.rollback:
+            rollback_shadow(cur, conn)
+        elif args.shadow:
+            loaded = load_shadow(config, cur, conn)
+        elif args.partitioned or args.resume:
+            loaded = load_partitioned(config, cur, conn, args.resume)
+        elif args.incremental or args.partition or snapshot_id:
+            loaded = load_incremental(config, cur, conn, args.partition)
+        else:
+            loaded = load_full(config, cur, conn)
+        if loaded:
+            record_load()
+            if config.getboolean("AGGREGATES", "CHECK", fallback=False):
+                try:
+                    for table, count in check_aggregates(cur).items():
+                        if count:
+                            logger.error(f"{table}: {count} rows differ from the recomputation")
+                except psycopg2.Error:
+                    conn.rollback()
+                    logger.exception("Issue while checking the aggregates")
+            if config.getboolean("EXPORT", "ENABLED", fallback=False):
+                try:
+                    run_export(config, conn)
+                except (psycopg2.Error, ClientError, OSError):
+                    conn.rollback()
+                    logger.exception("Issue while exporting the final tables")
+            if config.getboolean("MAINTENANCE", "ENABLED", fallback=True):
+                try:
+                    run_maintenance(config, conn)
+                except psycopg2.Error:
+                    logger.exception("Issue while checking the tables to maintain")
+            if get_backend(config) == "redshift":
+                try:
+                    sizing.record_run(config, cur)
+                except (psycopg2.Error, ClientError):
+                    conn.rollback()
+                    logger.exception("Issue while recording the sizes of the run")
+        finish_run(config, conn)
 
-    conn.close()
+        conn.close()
+    finally:
+        if resized_from:
+            resize_resources(resized_from)
 
 
 if __name__ == "__main__":
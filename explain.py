@@ -0,0 +1,299 @@
+import argparse
+import collections
+import configparser
+import json
+import logging
+import re
+import psycopg2
+from db import get_connection
+from instrumentation import execute
+from merge import merge_queries
+from sql_queries import insert_table_graph, explain_template
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# e.g. "->  XN Hash Join DS_BCAST_INNER  (cost=0.00..52.21 rows=100 width=94)"
+STEP_PATTERN = re.compile(
+    r"^(?P<indent>\s*(?:->\s*)?)(?P<label>.*?)\s*"
+    r"\(cost=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+) rows=(?P<rows>\d+) width=(?P<width>\d+)\)"
+)
+
+DISTRIBUTION_PATTERN = re.compile(r"\b(DS_[A-Z_]+)\b")
+
+# e.g. "XN Seq Scan on nextsong_events ne"
+TABLE_PATTERN = re.compile(r"\bon (\w+)")
+
+# joins moving a whole table to every node or redistributing one or both tables between the nodes, see
+# https://docs.aws.amazon.com/redshift/latest/dg/c_data_redistribution.html
+FLAGGED_DISTRIBUTIONS = {
+    "DS_BCAST_INNER",
+    "DS_DIST_ALL_INNER",
+    "DS_DIST_BOTH",
+    "DS_DIST_INNER",
+    "DS_DIST_OUTER",
+}
+
+FLAGGED_OPERATORS = {"Nested Loop"}
+
+
+def parse_plan(plan):
+    """
+    Parse the text of an EXPLAIN output into its steps. Detail lines, e.g. the join conditions,
+    are kept with the step they belong to
+
+    Parameters
+    ----------
+    plan : str or list of str
+        EXPLAIN output, one line per row
+
+    Returns
+    -------
+    steps : list of dict
+        depth, operator, distribution (None when not a join of Redshift), table, startup_cost,
+        total_cost, rows, width and details of each step, in the order of the plan
+
+    """
+    lines = plan.splitlines() if isinstance(plan, str) else plan
+    steps = []
+    for line in lines:
+        match = STEP_PATTERN.match(line)
+        if match is None:
+            if steps and line.strip():
+                steps[-1]["details"].append(line.strip())
+            continue
+
+        label = match.group("label")
+        distribution = DISTRIBUTION_PATTERN.search(label)
+        table = TABLE_PATTERN.search(label)
+        operator = DISTRIBUTION_PATTERN.sub("", TABLE_PATTERN.split(label)[0])
+        operator = re.sub(r"^XN\s+", "", operator.strip())
+        steps.append(
+            {
+                "depth": len(match.group("indent")),
+                "operator": " ".join(operator.split()),
+                "distribution": distribution.group(1) if distribution else None,
+                "table": table.group(1) if table else None,
+                "startup_cost": float(match.group("startup")),
+                "total_cost": float(match.group("total")),
+                "rows": int(match.group("rows")),
+                "width": int(match.group("width")),
+                "details": [],
+            }
+        )
+    return steps
+
+
+def flag_steps(steps):
+    """
+    Return the steps broadcasting or redistributing data and the nested loops
+
+    Parameters
+    ----------
+    steps : list of dict
+        see parse_plan
+
+    Returns
+    -------
+    flags : list of str
+        e.g. DS_BCAST_INNER or Nested Loop, one per flagged step
+
+    """
+    flags = []
+    for step in steps:
+        if step["distribution"] in FLAGGED_DISTRIBUTIONS:
+            flags.append(step["distribution"])
+        if step["operator"] in FLAGGED_OPERATORS:
+            flags.append(step["operator"])
+    return flags
+
+
+def summarize_plan(steps):
+    """
+    Summarize a parsed plan for the baseline
+
+    Parameters
+    ----------
+    steps : list of dict
+        see parse_plan
+
+    Returns
+    -------
+    summary : dict
+        total cost, distribution of the joins and flags of the plan
+
+    """
+    return {
+        "cost": steps[0]["total_cost"] if steps else 0.0,
+        "distributions": [step["distribution"] for step in steps if step["distribution"]],
+        "flags": flag_steps(steps),
+    }
+
+
+def compare_plans(baseline, current, max_cost_ratio=2.0):
+    """
+    Find the regressions of the plans from the baseline: new flagged steps, any change of the
+    distribution of the joins and cost growing more than max_cost_ratio times.
+    Queries missing from the baseline only get their flags reported
+
+    Parameters
+    ----------
+    baseline : dict
+        query name -> summary, see summarize_plan
+    current : dict
+        query name -> summary
+    max_cost_ratio : float
+
+    Returns
+    -------
+    regressions : dict
+        query name -> list of str describing the regressions of the query
+
+    """
+    regressions = {}
+    for name, summary in current.items():
+        problems = []
+        before = baseline.get(name)
+        if before is None:
+            problems.extend(f"{flag} (no baseline)" for flag in summary["flags"])
+        else:
+            new_flags = collections.Counter(summary["flags"]) - collections.Counter(before["flags"])
+            problems.extend(f"new {flag}" for flag in sorted(new_flags.elements()))
+            if summary["distributions"] != before.get("distributions", []):
+                problems.append(
+                    f"distributions {', '.join(before.get('distributions', [])) or 'none'} -> "
+                    f"{', '.join(summary['distributions']) or 'none'}"
+                )
+            if before["cost"] and summary["cost"] > max_cost_ratio * before["cost"]:
+                problems.append(f"cost {before['cost']:.2f} -> {summary['cost']:.2f}")
+        if problems:
+            regressions[name] = problems
+    return regressions
+
+
+def node_queries(node):
+    """
+    Name the statements of a node of insert_table_graph: the node name for a single query, else the node name
+    followed by the first keyword of each query (e.g. nextsong_events delete) or the step of the merge
+    (e.g. users stage, users delete and users insert)
+
+    Parameters
+    ----------
+    node : dict
+
+    Returns
+    -------
+    queries : list of tuple
+        name and query of each statement, in the order they run
+
+    """
+    if "merge" in node:
+        queries = merge_queries(node["merge"])
+        return [(f"{node['name']} {step}", queries[step]) for step in ("stage", "delete", "insert")]
+    queries = node.get("queries", [node.get("query")])
+    if len(queries) == 1:
+        return [(node["name"], queries[0])]
+    return [(f"{node['name']} {query.split()[0].lower()}", query) for query in queries]
+
+
+def explain(cur, query):
+    """
+    Run EXPLAIN on a query, which is planned but not executed
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    query : str
+
+    Returns
+    -------
+    plan : list of str
+
+    """
+    execute(cur, explain_template.format(query=query.strip().rstrip(";")), "explain")
+    return [row[0] for row in cur.fetchall()]
+
+
+def explain_queries(conn, graph=insert_table_graph):
+    """
+    Explain the statements of the insert graph and summarize their plans, logging the flagged steps.
+    The stage statement of a merge is also executed, to create the staged rows its DELETE and INSERT read,
+    and rolled back at the end
+
+    Parameters
+    ----------
+    conn : psycopg2 Connection
+    graph : list of dict
+        insert graph, see sql_queries.insert_table_graph
+
+    Returns
+    -------
+    summaries : dict
+        statement name -> summary, see summarize_plan (names in node_queries)
+
+    """
+    summaries = {}
+    with conn.cursor() as cur:
+        for node in graph:
+            for name, query in node_queries(node):
+                summaries[name] = summarize_plan(parse_plan(explain(cur, query)))
+                flags = ", ".join(summaries[name]["flags"]) or "none"
+                logger.info(f"{name}: cost {summaries[name]['cost']:.2f}, flagged steps: {flags}")
+                if "merge" in node and name.endswith(" stage"):
+                    # the DELETE and INSERT of the merge read the staged rows
+                    execute(cur, query, "explain")
+    conn.rollback()
+    return summaries
+
+
+def main(argv=None):
+    """
+    record: write the plans of the insert queries as the baseline;
+    check: compare them with the baseline, failing when a plan regresses
+
+    """
+    parser = argparse.ArgumentParser(description="EXPLAIN plans of the insert queries")
+    parser.add_argument("action", choices=["record", "check"])
+    parser.add_argument("--config", default="dwh.cfg")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    baseline_path = config.get("EXPLAIN", "BASELINE", fallback="plan_baseline.json")
+
+    try:
+        conn = get_connection(config)
+        summaries = explain_queries(conn)
+        conn.close()
+    except psycopg2.Error as e:
+        logger.exception("Issue while explaining the insert queries")
+        raise SystemExit(1) from e
+
+    if args.action == "record":
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(summaries, baseline_file, indent=2)
+        logger.info(f"Baseline written to {baseline_path}")
+        return
+
+    try:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        logger.warning(f"{baseline_path} not found, only the flagged steps are checked")
+        baseline = {}
+
+    regressions = compare_plans(
+        baseline,
+        summaries,
+        max_cost_ratio=config.getfloat("EXPLAIN", "MAX_COST_RATIO", fallback=2.0),
+    )
+    for name, problems in regressions.items():
+        logger.error(f"{name}: {', '.join(problems)}")
+    if regressions:
+        raise SystemExit(1)
+    logger.info("No plan regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+import argparse
+import configparser
+import decimal
+import json
+import logging
+import os
+import shutil
+import boto3
+import psycopg2
+from botocore.exceptions import ClientError
+from db import get_backend, get_connection
+from instrumentation import execute
+from manifests import build_manifest
+from s3_utils import list_objects, split_s3_url
+from sql_queries import (
+    export_tables,
+    export_row_column_template,
+    export_fingerprint_template,
+    export_select_template,
+    unload_template,
+)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# fingerprints of the partitions exported, next to the exported tables
+STATE_NAME = "_export_state.json"
+
+# manifests of the exported tables, outside of their prefixes so that readers of a table only find Parquet files
+MANIFEST_FOLDER = "_manifests"
+
+
+def partition_key(partition_by, values):
+    """
+    Name of a partition as its Hive style path, e.g. year=2018/month=11, empty for unpartitioned tables
+
+    Parameters
+    ----------
+    partition_by : list of str
+    values : tuple
+
+    Returns
+    -------
+    key : str
+
+    """
+    return "/".join(f"{column}={value}" for column, value in zip(partition_by, values))
+
+
+def partition_values(key):
+    """
+    Values of the partition columns of a partition key, see partition_key
+
+    Parameters
+    ----------
+    key : str
+
+    Returns
+    -------
+    values : dict
+        column -> int
+
+    """
+    return {
+        column: int(value) for column, value in (part.split("=") for part in key.split("/") if part)
+    }
+
+
+def partition_filter(keys):
+    """
+    Build the WHERE clause selecting the rows of some partitions
+
+    Parameters
+    ----------
+    keys : list of str
+        partition keys, see partition_key
+
+    Returns
+    -------
+    where : str
+        empty when a key is empty, i.e. the table is unpartitioned
+
+    """
+    conditions = []
+    for key in keys:
+        values = partition_values(key)
+        if not values:
+            return ""
+        conditions.append(
+            "(" + " AND ".join(f"{column} = {value}" for column, value in values.items()) + ")"
+        )
+    return f" WHERE {' OR '.join(conditions)}" if conditions else ""
+
+
+def fingerprint_query(export):
+    """
+    Build the query computing the rows and the hash of every partition of a table
+
+    Parameters
+    ----------
+    export : dict
+        table, columns, select and partition_by, see sql_queries.export_tables
+
+    Returns
+    -------
+    query : str
+
+    """
+    partition_by = export["partition_by"]
+    row = " || '|' || ".join(
+        export_row_column_template.format(column=column) for column in export["columns"]
+    )
+    return export_fingerprint_template.format(
+        keys="".join(f"{column}, " for column in partition_by),
+        row=row,
+        select=export["select"],
+        group_by=f" GROUP BY {', '.join(partition_by)}" if partition_by else "",
+    )
+
+
+def partition_fingerprints(cur, export):
+    """
+    Read the fingerprint of every partition of a table
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    export : dict
+
+    Returns
+    -------
+    fingerprints : dict
+        partition key -> [rows, hash]
+
+    """
+    execute(cur, fingerprint_query(export), "export")
+    width = len(export["partition_by"])
+    fingerprints = {}
+    for row in cur.fetchall():
+        if row[width] == 0:
+            # an empty unpartitioned table
+            continue
+        values = tuple(int(value) for value in row[:width])
+        fingerprints[partition_key(export["partition_by"], values)] = [int(row[width]), int(row[width + 1])]
+    return fingerprints
+
+
+def changed_partitions(previous, current):
+    """
+    Compare the fingerprints of the partitions with the ones of the last export
+
+    Parameters
+    ----------
+    previous : dict
+        partition key -> fingerprint, as exported last time
+    current : dict
+        partition key -> fingerprint
+
+    Returns
+    -------
+    (changed, removed) : tuple
+        partitions new or changed, and partitions exported last time that no longer exist
+
+    """
+    changed = sorted(key for key, fingerprint in current.items() if previous.get(key) != fingerprint)
+    removed = sorted(key for key in previous if key not in current)
+    return changed, removed
+
+
+def join_path(base, *parts):
+    return "/".join([base.rstrip("/")] + [part for part in parts if part])
+
+
+class Target:
+    """
+    Where the tables are exported: an S3 prefix (UNLOAD) or a local directory (postgres backend)
+    """
+
+    def __init__(self, url, client=None):
+        self.url = url
+        self.client = client
+        self.s3 = url.startswith("s3://")
+
+    def read_state(self):
+        """Fingerprints of the last export, table -> partition key -> fingerprint"""
+        location = join_path(self.url, STATE_NAME)
+        try:
+            if self.s3:
+                bucket, key = split_s3_url(location)
+                body = self.client.get_object(Bucket=bucket, Key=key)["Body"].read()
+                return json.loads(body.decode("utf-8"))
+            with open(location) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return {}
+            raise
+
+    def write_state(self, state):
+        self.write(join_path(self.url, STATE_NAME), json.dumps(state, indent=2))
+
+    def write(self, location, text):
+        if self.s3:
+            bucket, key = split_s3_url(location)
+            self.client.put_object(Bucket=bucket, Key=key, Body=text.encode("utf-8"))
+            return
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, "w") as target_file:
+            target_file.write(text)
+
+    def remove(self, location):
+        """Remove the files under a prefix or directory"""
+        if self.s3:
+            bucket, _ = split_s3_url(location)
+            keys = [key for key, _ in list_objects(self.client, location.rstrip("/") + "/")]
+            for start in range(0, len(keys), 1000):
+                self.client.delete_objects(
+                    Bucket=bucket,
+                    Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]]},
+                )
+        elif os.path.isdir(location):
+            shutil.rmtree(location)
+
+    def files(self, location):
+        """Files under a prefix or directory, as (url, size) tuples"""
+        if self.s3:
+            bucket, _ = split_s3_url(location)
+            return [
+                (f"s3://{bucket}/{key}", size)
+                for key, size in list_objects(self.client, location.rstrip("/") + "/")
+            ]
+        return [
+            (os.path.join(directory, name), os.path.getsize(os.path.join(directory, name)))
+            for directory, _, names in sorted(os.walk(location))
+            for name in sorted(names)
+        ]
+
+    def write_manifest(self, table):
+        """
+        Write the manifest listing all the files of an exported table, in the format of the COPY manifests
+
+        Parameters
+        ----------
+        table : str
+
+        Returns
+        -------
+        manifest : dict
+
+        """
+        files = self.files(join_path(self.url, table))
+        if self.s3:
+            bucket, _ = split_s3_url(self.url)
+            manifest = build_manifest(bucket, [(split_s3_url(url)[1], size) for url, size in files])
+        else:
+            manifest = {
+                "entries": [
+                    {"url": path, "mandatory": True, "meta": {"content_length": size}}
+                    for path, size in files
+                ]
+            }
+        self.write(join_path(self.url, MANIFEST_FOLDER, f"{table}.json"), json.dumps(manifest))
+        return manifest
+
+
+def unload_query(export, target, role, partitions, maxfilesize=256):
+    """
+    Build the UNLOAD query exporting some partitions of a table to Parquet, in parallel from every slice
+
+    Parameters
+    ----------
+    export : dict
+    target : str
+        S3 prefix of the table
+    role : str
+        ARN of the IAM role writing to S3
+    partitions : list of str
+        partition keys to export, all the table when unpartitioned
+    maxfilesize : int
+        MB
+
+    Returns
+    -------
+    query : str
+
+    """
+    select = export_select_template.format(
+        select=export["select"], where=partition_filter(partitions)
+    )
+    partition_by = export["partition_by"]
+    return unload_template.format(
+        select=select.replace("'", "''"),
+        target=target.rstrip("/") + "/",
+        role=role,
+        partition_by=f" PARTITION BY ({', '.join(partition_by)})" if partition_by else "",
+        maxfilesize=maxfilesize,
+    )
+
+
+# psycopg2 type codes of the exported columns and their Parquet type
+PARQUET_TYPES = {
+    16: "bool",
+    20: "int64",
+    21: "int16",
+    23: "int32",
+    700: "float32",
+    701: "float64",
+    1700: "float64",
+    1082: "date32",
+    1114: "timestamp",
+}
+
+
+def parquet_schema(description, skip=()):
+    """
+    Parquet schema of the columns of a query result, strings for the types not in PARQUET_TYPES
+
+    Parameters
+    ----------
+    description : sequence
+        cursor.description
+    skip : iterable of str
+        columns left out, e.g. the partition columns
+
+    Returns
+    -------
+    schema : pyarrow.Schema
+
+    """
+    fields = []
+    for column in description:
+        if column.name in skip:
+            continue
+        name = PARQUET_TYPES.get(column.type_code, "string")
+        parquet_type = pyarrow.timestamp("us") if name == "timestamp" else getattr(pyarrow, name)()
+        fields.append(pyarrow.field(column.name, parquet_type))
+    return pyarrow.schema(fields)
+
+
+def write_partitions(cur, export, directory, batch_rows=100000):
+    """
+    Stream the rows of a query ordered by partition into one Parquet file per partition,
+    holding at most batch_rows rows in memory, each batch being written as a row group
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+        named cursor, executed
+    export : dict
+    directory : str
+        local directory of the table
+    batch_rows : int
+
+    Returns
+    -------
+    rows : int
+
+    """
+    partition_by = export["partition_by"]
+    rows = 0
+    batch = cur.fetchmany(batch_rows)
+    if not batch:
+        return rows
+
+    names = [column.name for column in cur.description]
+    positions = [names.index(column) for column in partition_by]
+    kept = [i for i, name in enumerate(names) if name not in partition_by]
+    schema = parquet_schema(cur.description, skip=partition_by)
+
+    writer, current = None, None
+    try:
+        while batch:
+            start = 0
+            for end in range(1, len(batch) + 1):
+                values = tuple(batch[start][i] for i in positions)
+                if end < len(batch) and tuple(batch[end][i] for i in positions) == values:
+                    continue
+                if writer is None or values != current:
+                    if writer is not None:
+                        writer.close()
+                    path = os.path.join(directory, partition_key(partition_by, values), "part-00000.parquet")
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    writer = pyarrow.parquet.ParquetWriter(path, schema)
+                    current = values
+                columns = list(zip(*(tuple(row[i] for i in kept) for row in batch[start:end])))
+                writer.write_table(
+                    pyarrow.table(
+                        [
+                            pyarrow.array(
+                                [float(v) if isinstance(v, decimal.Decimal) else v for v in column],
+                                type=field.type,
+                            )
+                            for column, field in zip(columns, schema)
+                        ],
+                        schema=schema,
+                    )
+                )
+                rows += end - start
+                start = end
+            batch = cur.fetchmany(batch_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def export_table(conn, target, export, state, config):
+    """
+    Export the partitions of a table changed since the last export, removing the ones that no longer exist,
+    then write the manifest of the table. The fingerprints and the rows exported are read in the same transaction
+
+    Parameters
+    ----------
+    conn : psycopg2 Connection
+    target : Target
+    export : dict
+    state : dict
+        partition key -> fingerprint of the last export of the table, updated
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    partitions : list of str
+        partitions exported
+
+    """
+    table = export["table"]
+    location = join_path(target.url, table)
+    with conn.cursor() as cur:
+        fingerprints = partition_fingerprints(cur, export)
+    changed, removed = changed_partitions(state, fingerprints)
+    if not changed and not removed:
+        conn.rollback()
+        logger.info(f"{table}: no partition changed")
+        return []
+
+    for key in changed + removed:
+        target.remove(join_path(location, key))
+
+    if changed:
+        if target.s3:
+            with conn.cursor() as cur:
+                execute(
+                    cur,
+                    unload_query(
+                        export,
+                        location,
+                        config["IAM_ROLE"]["ARN"],
+                        changed,
+                        config.getint("EXPORT", "MAXFILESIZE_MB", fallback=256),
+                    ),
+                    "export",
+                )
+        else:
+            order_by = f" ORDER BY {', '.join(export['partition_by'])}" if export["partition_by"] else ""
+            # a named cursor streams the rows from the server instead of fetching them all
+            with conn.cursor(name=f"export_{table}") as cur:
+                cur.execute(
+                    export_select_template.format(
+                        select=export["select"], where=partition_filter(changed)
+                    )
+                    + order_by
+                )
+                rows = write_partitions(
+                    cur, export, location, config.getint("EXPORT", "BATCH_ROWS", fallback=100000)
+                )
+            logger.info(f"{table}: {rows} rows written")
+    conn.commit()
+
+    state.clear()
+    state.update(fingerprints)
+    target.write_manifest(table)
+    logger.info(f"{table}: {len(changed)} partitions exported, {len(removed)} removed")
+    return changed
+
+
+def run_export(config, conn):
+    """
+    Export the final tables to Parquet under TARGET of the EXPORT section: UNLOAD to an S3 prefix or,
+    with the postgres backend, streaming to a local directory. Only the partitions changed since the
+    last export are exported again
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    exported : dict
+        table -> partitions exported
+
+    """
+    url = config.get("EXPORT", "TARGET", fallback="")
+    if not url:
+        logger.error("TARGET of the EXPORT section is not set")
+        return {}
+    if get_backend(config) == "redshift" and not url.startswith("s3://"):
+        logger.error("UNLOAD exports to S3, TARGET must be an S3 prefix")
+        return {}
+    if not url.startswith("s3://") and pyarrow is None:
+        logger.error("Exporting to a local directory requires the pyarrow package")
+        return {}
+
+    target = Target(url, boto3.client("s3") if url.startswith("s3://") else None)
+    state = target.read_state()
+    exported = {}
+    for export in export_tables:
+        table_state = state.setdefault(export["table"], {})
+        try:
+            exported[export["table"]] = export_table(conn, target, export, table_state, config)
+        except (psycopg2.Error, ClientError, OSError):
+            conn.rollback()
+            logger.exception(f"Issue while exporting {export['table']}")
+            # exported again by the next run
+            state.pop(export["table"], None)
+        # written after every table, a failed export starts again from the tables not exported
+        target.write_state(state)
+    return exported
+
+
+def main(argv=None):
+    """
+    Export the final tables to Parquet
+
+    """
+    parser = argparse.ArgumentParser(description="Export the final tables to Parquet")
+    parser.add_argument("--config", default="dwh.cfg")
+    parser.add_argument("--full", action="store_true", help="export again all the partitions")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    try:
+        conn = get_connection(config)
+        if args.full and config.get("EXPORT", "TARGET", fallback=""):
+            url = config["EXPORT"]["TARGET"]
+            Target(url, boto3.client("s3") if url.startswith("s3://") else None).write_state({})
+        run_export(config, conn)
+        conn.close()
+    except psycopg2.Error:
+        logger.exception("Issue while exporting the final tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import logging
+import re
+from datetime import datetime, timezone
+import psycopg2
+from instrumentation import execute
+from merge import merge_dimension
+from aggregates import refresh_aggregates
+from manifests import build_manifest, write_manifest
+from query_client import bump_load_generation
+from s3_utils import list_objects, list_objects_modified, split_s3_url
+from sql_queries import (
+    staging_events_copy_template,
+    staging_events_clear,
+    staging_songs_source,
+    staging_songs_options,
+    nextsong_events_clear,
+    nextsong_events_insert,
+    new_songs_table_create,
+    new_songs_copy_template,
+    staging_songs_replace_delete,
+    staging_songs_replace_insert,
+    keyed_songs_replace_delete,
+    keyed_songs_replace_insert,
+    new_songs_table_drop,
+    unmatched_events_insert,
+    match_rate_insert,
+    event_table_merges,
+    song_table_merges,
+    songplay_table_merge_delete,
+    songplay_table_insert,
+    watermark_select,
+    watermark_delete,
+    watermark_insert,
+    nextsong_events_last_date,
+)
+
+logger = logging.getLogger(__name__)
+
+LOG_DATA_SOURCE = "log_data"
+
+# the watermark of song_data is the last modification (ISO 8601, UTC) of the newest file loaded
+SONG_DATA_SOURCE = "song_data"
+
+# e.g. log_data/2018/11/2018-11-04-events.json
+PARTITION_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})-events\.json$")
+
+
+def list_log_partitions(client, log_data):
+    """
+    List the daily partitions available under the log_data prefix
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    log_data : str
+        S3 url of the log_data prefix
+
+    Returns
+    -------
+    partitions : list of (date, url) tuples
+        sorted by date, e.g. ("2018-11-04", "s3://udacity-dend/log_data/2018/11/2018-11-04-events.json")
+
+    """
+    bucket, _ = split_s3_url(log_data)
+    partitions = []
+    for key, _ in list_objects(client, log_data):
+        match = PARTITION_PATTERN.search(key)
+        if match:
+            partitions.append((match.group(1), f"s3://{bucket}/{key}"))
+    return sorted(partitions)
+
+
+def get_watermark(cur, source=LOG_DATA_SOURCE):
+    """
+    Return the watermark of a source, i.e. the last partition loaded, or None if never loaded
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    source : str
+
+    Returns
+    -------
+    watermark : str
+
+    """
+    execute(cur, watermark_select, "incremental", (source,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(cur, watermark, source=LOG_DATA_SOURCE):
+    """
+    Record the watermark of a source
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    watermark : str
+    source : str
+
+    """
+    execute(cur, watermark_delete, "incremental", (source,))
+    execute(cur, watermark_insert, "incremental", (source, watermark))
+
+
+def advance_watermark(cur, conn):
+    """
+    Move the watermark to the last partition held by nextsong_events after a full load,
+    so that the following incremental loads start after it
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    """
+    execute(cur, nextsong_events_last_date, "incremental")
+    last_date = cur.fetchone()[0]
+    watermark = get_watermark(cur)
+    if last_date is not None and (watermark is None or last_date > watermark):
+        set_watermark(cur, last_date)
+    conn.commit()
+
+
+def pending_partitions(partitions, watermark, forced=()):
+    """
+    Select the partitions to load: the ones after the watermark and the forced ones
+
+    Parameters
+    ----------
+    partitions : list of (date, url) tuples
+    watermark : str
+        None if nothing has been loaded yet
+    forced : iterable of str
+        dates to load again even if they are not after the watermark
+
+    Returns
+    -------
+    partitions : list of (date, url) tuples
+
+    """
+    forced = set(forced)
+    return [
+        (date, url)
+        for date, url in partitions
+        if watermark is None or date > watermark or date in forced
+    ]
+
+
+def parse_timestamp(watermark):
+    """Parse a song_data watermark, None if never loaded"""
+    if watermark is None:
+        return None
+    timestamp = datetime.fromisoformat(watermark)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def advance_song_watermark(cur, conn, loaded_at):
+    """
+    Move the watermark of song_data to the start of a full load, so that the following incremental
+    loads copy only the song_data files added or modified after it
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    loaded_at : datetime
+        start of the COPY of song_data (UTC)
+
+    """
+    watermark = parse_timestamp(get_watermark(cur, SONG_DATA_SOURCE))
+    if watermark is None or loaded_at > watermark:
+        set_watermark(cur, loaded_at.isoformat(), SONG_DATA_SOURCE)
+    conn.commit()
+
+
+def new_song_files(client, song_data, watermark):
+    """
+    List the song_data files modified after the watermark
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    song_data : str
+        S3 url of the song_data prefix
+    watermark : datetime
+        None if song_data has never been loaded
+
+    Returns
+    -------
+    files : list of (key, size, last_modified) tuples
+        sorted by key
+
+    """
+    return sorted(
+        (key, size, modified)
+        for key, size, modified in list_objects_modified(client, song_data)
+        if key.endswith(".json") and (watermark is None or modified > watermark)
+    )
+
+
+def load_songs(cur, conn, client, song_data, manifest_url=None):
+    """
+    Load the song_data files added since the last load into staging_songs and merge them into songs.
+    The files are copied into a temporary table whose songs replace their rows in staging_songs and keyed_songs,
+    then the watermark of song_data moves to the newest file loaded, all in one transaction.
+    When song_data has never been loaded the whole of it is copied. The new files are listed in a
+    manifest written to manifest_url and copied at once, or copied one by one without manifest_url
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    client : boto3.session.Session.client
+        S3 client
+    song_data : str
+        S3 url of the song_data prefix
+    manifest_url : str, optional
+        S3 url the manifest of the new files is written to
+
+    """
+    watermark = parse_timestamp(get_watermark(cur, SONG_DATA_SOURCE))
+    files = new_song_files(client, song_data, watermark)
+    if not files:
+        logger.info("No new song_data files, skipping song_data")
+        return
+
+    if watermark is None:
+        sources = [(staging_songs_source, staging_songs_options)]
+    elif manifest_url:
+        bucket, _ = split_s3_url(song_data)
+        write_manifest(client, manifest_url, build_manifest(bucket, [(key, size) for key, size, _ in files]))
+        sources = [(manifest_url, " MANIFEST")]
+    else:
+        bucket, _ = split_s3_url(song_data)
+        sources = [(f"s3://{bucket}/{key}", "") for key, _, _ in files]
+    logger.info(f"Loading {len(files)} song_data files modified after {watermark or 'never'}")
+
+    try:
+        execute(cur, new_songs_table_create, "incremental")
+        for source, options in sources:
+            execute(cur, new_songs_copy_template.format(source=source, options=options), "incremental")
+        execute(cur, staging_songs_replace_delete, "incremental")
+        execute(cur, staging_songs_replace_insert, "incremental")
+        execute(cur, keyed_songs_replace_delete, "incremental")
+        execute(cur, keyed_songs_replace_insert, "incremental")
+        execute(cur, new_songs_table_drop, "incremental")
+        for merge in song_table_merges:
+            merge_dimension(cur, merge, "incremental")
+        set_watermark(cur, max(modified for _, _, modified in files).isoformat(), SONG_DATA_SOURCE)
+        bump_load_generation(cur)
+        conn.commit()
+
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+
+def load_partition(cur, conn, date, url):
+    """
+    Load a single log_data partition and merge it into the final tables in one transaction,
+    moving the watermark forward. Loading twice the same partition is idempotent
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    date : str
+    url : str
+
+    """
+    try:
+        execute(cur, staging_events_clear, "incremental")
+        execute(cur, staging_events_copy_template.format(source=url, options=""), "incremental")
+        execute(cur, nextsong_events_clear, "incremental")
+        execute(cur, nextsong_events_insert, "incremental")
+        for merge in event_table_merges:
+            merge_dimension(cur, merge, "incremental")
+        execute(cur, songplay_table_merge_delete, "incremental")
+        execute(cur, songplay_table_insert, "incremental")
+        refresh_aggregates(cur)
+        execute(cur, unmatched_events_insert, "incremental")
+        execute(cur, match_rate_insert, "incremental")
+
+        watermark = get_watermark(cur)
+        if watermark is None or date > watermark:
+            set_watermark(cur, date)
+        bump_load_generation(cur)
+        conn.commit()
+        logger.info(f"Partition {date} loaded")
+
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+
+def load_incremental(cur, conn, client, log_data, song_data, forced=(), song_manifest=None):
+    """
+    Load the log_data partitions after the watermark (and the forced ones) one by one,
+    stopping at the first failure so that the watermark never skips a partition
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    client : boto3.session.Session.client
+        S3 client
+    log_data : str
+        S3 url of the log_data prefix
+    song_data : str
+        S3 url of the song_data prefix, its new files are loaded first (see load_songs)
+    forced : iterable of str
+        dates to load again
+    song_manifest : str, optional
+        S3 url the manifest of the new song_data files is written to
+
+    Returns
+    -------
+    (loaded, failed) : tuple
+        dates of the partitions loaded and date of the partition that failed (None if none)
+
+    """
+    load_songs(cur, conn, client, song_data, song_manifest)
+
+    partitions = pending_partitions(
+        list_log_partitions(client, log_data), get_watermark(cur), forced
+    )
+    logger.info(f"{len(partitions)} partitions to load")
+
+    loaded = []
+    for date, url in partitions:
+        try:
+            load_partition(cur, conn, date, url)
+            loaded.append(date)
+        except psycopg2.Error:
+            logger.exception(f"Issue while loading partition {date}")
+            return loaded, date
+
+    return loaded, None
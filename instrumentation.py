@@ -0,0 +1,404 @@
+import importlib
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from db import get_backend
+from sql_queries import (
+    run_metrics_insert,
+    run_metrics_template,
+    session_queries_select,
+    scanned_bytes_select,
+    returned_bytes_select,
+    wlm_query_select,
+)
+
+logger = logging.getLogger(__name__)
+
+# the run being measured, None when no run has been started (e.g. functions called from a notebook)
+_current_run = None
+
+
+class RunMetrics:
+    """
+    Metrics of the queries executed during a run of create_tables.py or etl.py: wall time, row count,
+    status and, on Redshift, query ID and bytes scanned and returned
+    """
+
+    def __init__(self, script, redshift=True, hooks=()):
+        self.run_id = str(uuid.uuid4())
+        self.script = script
+        self.redshift = redshift
+        self.started_at = datetime.now(timezone.utc)
+        self.records = []
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        """
+        Store the metrics of a query and pass them to the hooks
+
+        Parameters
+        ----------
+        record : dict
+
+        """
+        with self._lock:
+            self.records.append(record)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                logger.exception(f"Issue while exporting metrics with {hook}")
+
+    def report(self):
+        """
+        Summarize the run: its queries and the total time, rows, failures and time waiting in the
+        WLM queues of each stage
+
+        Returns
+        -------
+        report : dict
+
+        """
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(
+                record["stage"],
+                {"queries": 0, "seconds": 0.0, "rows": 0, "failed": 0, "queue_seconds": 0.0},
+            )
+            stage["queries"] += 1
+            stage["seconds"] += record["seconds"]
+            stage["rows"] += max(record["row_count"] or 0, 0)
+            stage["failed"] += record["status"] == "failed"
+            stage["queue_seconds"] += record["queue_seconds"] or 0.0
+        return {
+            "run_id": self.run_id,
+            "script": self.script,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "stages": stages,
+            "queries": self.records,
+        }
+
+
+def describe(query):
+    """
+    Short name of a query, e.g. INSERT INTO songplays or CREATE TABLE IF NOT EXISTS users
+
+    Parameters
+    ----------
+    query : str
+
+    Returns
+    -------
+    name : str
+
+    """
+    first_line = query.strip().split("\n", 1)[0]
+    return " ".join(first_line.split("(", 1)[0].split())[:80]
+
+
+def load_hook(path):
+    """
+    Import a hook given as module:function, e.g. my_exporter:send
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    hook : callable
+        called with the metrics of every query
+
+    """
+    module, _, function = path.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def start_run(config, script):
+    """
+    Start measuring the queries executed through execute. The hooks of HOOKS in the METRICS
+    section (comma separated module:function) are called with the metrics of every query
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    script : str
+
+    Returns
+    -------
+    run : RunMetrics
+
+    """
+    global _current_run
+    hooks = [
+        load_hook(path.strip())
+        for path in config.get("METRICS", "HOOKS", fallback="").split(",")
+        if path.strip()
+    ]
+    _current_run = RunMetrics(script, get_backend(config) == "redshift", hooks)
+    logger.info(f"Run {_current_run.run_id} of {script} started")
+    return _current_run
+
+
+def current_run():
+    """Return the run being measured, None if no run has been started"""
+    return _current_run
+
+
+def new_record(stage, name):
+    """Empty metrics of a query"""
+    return {
+        "stage": stage,
+        "name": name,
+        "started_at": datetime.now(timezone.utc).replace(tzinfo=None),
+        "seconds": None,
+        "row_count": None,
+        "query_id": None,
+        "pid": None,
+        "scanned_bytes": None,
+        "returned_bytes": None,
+        "service_class": None,
+        "queue_seconds": None,
+        "status": "succeeded",
+        "error": None,
+    }
+
+
+def record_operation(stage, name, seconds, row_count):
+    """
+    Record in the current run, if any, an operation not executed through execute, e.g. a COPY FROM STDIN
+
+    Parameters
+    ----------
+    stage : str
+    name : str
+    seconds : float
+    row_count : int
+
+    """
+    if _current_run is None:
+        return
+    record = new_record(stage, name)
+    record["seconds"] = seconds
+    record["row_count"] = row_count
+    _current_run.add(record)
+
+
+def record_skipped(stage, name):
+    """
+    Record in the current run, if any, a query that was planned but not executed, e.g. out of time budget
+
+    Parameters
+    ----------
+    stage : str
+    name : str
+
+    """
+    if _current_run is None:
+        return
+    record = new_record(stage, name)
+    record["seconds"] = 0.0
+    record["status"] = "skipped"
+    _current_run.add(record)
+
+
+def execute(cur, query, stage, vars=None):
+    """
+    Execute a query, recording its metrics in the current run if any
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    query : str
+    stage : str
+        e.g. create or insert
+    vars : tuple
+        parameters of the query
+
+    Returns
+    -------
+    record : dict
+        metrics of the query, None if no run has been started
+
+    """
+    run = _current_run
+    if run is None:
+        cur.execute(query, vars)
+        return None
+
+    record = new_record(stage, describe(query))
+    if run.redshift:
+        # read by libpq without a round trip, the query ID is found from it in STL_QUERY at the end of the run
+        record["pid"] = cur.connection.get_backend_pid()
+    start = time.perf_counter()
+    try:
+        cur.execute(query, vars)
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = str(e).strip()
+        raise
+    else:
+        # -1 for statements without a row count, e.g. CREATE TABLE
+        record["row_count"] = cur.rowcount if cur.rowcount >= 0 else None
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        run.add(record)
+    return record
+
+
+def collect_query_ids(cur, run):
+    """
+    Fill the query ID of the Redshift queries of the run from STL_QUERY. The statements of each session are
+    matched in order with its queries by their short name, skipping the internal queries (e.g. the
+    compression analysis of a COPY) and the statements not logged there (e.g. SET or CREATE TABLE).
+    Done once at the end of the run rather than with PG_LAST_QUERY_ID after every query
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    run : RunMetrics
+
+    """
+    pids = {record["pid"] for record in run.records if record["pid"]}
+    if not pids:
+        return
+    cur.execute(session_queries_select, (tuple(pids), run.started_at.replace(tzinfo=None)))
+    sessions = {}
+    for pid, query, text in cur.fetchall():
+        # the new lines of the text may be logged escaped
+        sessions.setdefault(pid, []).append((query, describe(text.replace("\\n", "\n"))))
+    positions = dict.fromkeys(sessions, 0)
+    # the records of a session are added in the order its statements were executed
+    for record in run.records:
+        queries = sessions.get(record["pid"], [])
+        for position in range(positions.get(record["pid"], 0), len(queries)):
+            query, name = queries[position]
+            if name == record["name"]:
+                positions[record["pid"]] = position + 1
+                if record["status"] == "succeeded":
+                    record["query_id"] = query
+                break
+
+
+def collect_bytes(cur, run):
+    """
+    Fill the bytes scanned and returned by the Redshift queries of the run from the system tables.
+    Done once at the end of the run rather than after every query
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    run : RunMetrics
+
+    """
+    query_ids = [record["query_id"] for record in run.records if record["query_id"]]
+    if not query_ids:
+        return
+    for select, field in ((scanned_bytes_select, "scanned_bytes"), (returned_bytes_select, "returned_bytes")):
+        cur.execute(select, (tuple(query_ids),))
+        values = dict(cur.fetchall())
+        for record in run.records:
+            if record["query_id"] in values:
+                record[field] = values[record["query_id"]]
+
+
+def collect_queue_times(cur, run):
+    """
+    Fill the WLM queue (service class) of the Redshift queries of the run and the time they waited
+    in it from STL_WLM_QUERY, e.g. to tune the slots of the WLM section
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    run : RunMetrics
+
+    """
+    query_ids = [record["query_id"] for record in run.records if record["query_id"]]
+    if not query_ids:
+        return
+    cur.execute(wlm_query_select, (tuple(query_ids),))
+    queues = {query: (service_class, queue_time) for query, service_class, queue_time, _ in cur.fetchall()}
+    for record in run.records:
+        if record["query_id"] in queues:
+            service_class, queue_time = queues[record["query_id"]]
+            record["service_class"] = service_class
+            record["queue_seconds"] = queue_time / 1e6
+
+
+def finish_run(config, conn):
+    """
+    End the current run: collect the query IDs, bytes and queue times from the Redshift system tables, store the metrics
+    in etl_run_metrics and write the JSON run report to REPORT of the METRICS section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    report : dict
+
+    """
+    global _current_run
+    run, _current_run = _current_run, None
+    if run is None:
+        return None
+
+    if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        conn.rollback()
+    try:
+        with conn.cursor() as cur:
+            if run.redshift:
+                collect_query_ids(cur, run)
+                collect_bytes(cur, run)
+                collect_queue_times(cur, run)
+            rows = [
+                (
+                    run.run_id,
+                    run.script,
+                    record["stage"],
+                    record["name"],
+                    record["started_at"],
+                    record["seconds"],
+                    record["row_count"],
+                    record["query_id"],
+                    record["scanned_bytes"],
+                    record["returned_bytes"],
+                    record["status"],
+                    record["error"],
+                )
+                for record in run.records
+            ]
+            if rows:
+                # a single multi-row insert rather than a round trip per query
+                psycopg2.extras.execute_values(
+                    cur, run_metrics_insert, rows, template=run_metrics_template, page_size=len(rows)
+                )
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Issue while storing the run metrics")
+
+    report = run.report()
+    path = config.get("METRICS", "REPORT", fallback="run_report.json")
+    if path:
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+        logger.info(f"Run report written to {path}")
+
+    for stage, summary in report["stages"].items():
+        logger.info(
+            f"{stage}: {summary['queries']} queries, {summary['seconds']:.2f}s, "
+            f"{summary['rows']} rows, {summary['failed']} failed, "
+            f"{summary['queue_seconds']:.2f}s queued"
+        )
+    return report
@@ -0,0 +1,319 @@
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+from compaction import iter_records
+from instrumentation import record_operation
+from sql_queries import staging_events_columns, staging_songs_columns
+
+logger = logging.getLogger(__name__)
+
+# same mapping as s3://udacity-dend/log_json_path.json, used when LOG_JSONPATH of the LOCAL section is not set
+DEFAULT_EVENTS_JSONPATHS = [
+    "$['artist']",
+    "$['auth']",
+    "$['firstName']",
+    "$['gender']",
+    "$['itemInSession']",
+    "$['lastName']",
+    "$['length']",
+    "$['level']",
+    "$['location']",
+    "$['method']",
+    "$['page']",
+    "$['registration']",
+    "$['sessionId']",
+    "$['song']",
+    "$['status']",
+    "$['ts']",
+    "$['userAgent']",
+    "$['userId']",
+]
+
+# columns loaded with TIMEFORMAT AS 'epochmillisecs' by the Redshift COPY
+EPOCH_MILLISECONDS_COLUMNS = {"registration", "ts"}
+
+JSONPATH_PATTERN = re.compile(r"^\$(?:\['([^']+)'\]|\[\"([^\"]+)\"\]|\.(\w+))$")
+
+
+def parse_columns(columns):
+    """
+    Split a comma separated list of columns, e.g. sql_queries.staging_events_columns
+
+    Parameters
+    ----------
+    columns : str
+
+    Returns
+    -------
+    columns : list of str
+
+    """
+    return [column.strip() for column in columns.split(",")]
+
+
+def jsonpath_field(jsonpath):
+    """
+    Return the field selected by a jsonpath expression, e.g. firstName for $['firstName'].
+    Only top-level fields are supported, as in log_json_path.json
+
+    Parameters
+    ----------
+    jsonpath : str
+
+    Returns
+    -------
+    field : str
+
+    """
+    match = JSONPATH_PATTERN.match(jsonpath.strip())
+    if match is None:
+        raise ValueError(f"Unsupported jsonpath {jsonpath}")
+    return next(group for group in match.groups() if group is not None)
+
+
+def load_jsonpaths(path=None):
+    """
+    Read the jsonpaths of a JSONPaths file, or the default mapping of log_data
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    jsonpaths : list of str
+
+    """
+    if not path:
+        return DEFAULT_EVENTS_JSONPATHS
+    with open(path) as jsonpaths_file:
+        return json.load(jsonpaths_file)["jsonpaths"]
+
+
+def iter_json_files(root):
+    """
+    Walk a directory tree, e.g. data/song_data/A/A/A/, yielding the JSON files in a stable order
+
+    Parameters
+    ----------
+    root : str
+
+    Yields
+    ------
+    path : str
+
+    """
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.endswith(".json"):
+                yield os.path.join(directory, name)
+
+
+def iter_file_records(root):
+    """
+    Yield the JSON objects of all the files under a directory, one file at a time
+
+    Parameters
+    ----------
+    root : str
+
+    Yields
+    ------
+    record : dict
+
+    """
+    for path in iter_json_files(root):
+        with open(path, encoding="utf-8") as json_file:
+            yield from iter_records(json_file.read())
+
+
+def epoch_milliseconds(value):
+    """
+    Convert an epoch in milliseconds to a UTC timestamp, as COPY TIMEFORMAT AS 'epochmillisecs'
+
+    Parameters
+    ----------
+    value : int or float
+
+    Returns
+    -------
+    timestamp : str
+
+    """
+    if value is None or value == "":
+        return None
+    moment = datetime.fromtimestamp(float(value) / 1000, tz=timezone.utc)
+    return moment.replace(tzinfo=None).isoformat(sep=" ")
+
+
+def event_rows(records, columns, jsonpaths):
+    """
+    Map log_data records to staging_events rows applying the jsonpaths, as COPY JSON 'jsonpaths_file'
+
+    Parameters
+    ----------
+    records : iterable of dict
+    columns : list of str
+    jsonpaths : list of str
+
+    Yields
+    ------
+    row : tuple
+
+    """
+    if len(columns) != len(jsonpaths):
+        raise ValueError(f"{len(jsonpaths)} jsonpaths for {len(columns)} columns")
+    fields = [jsonpath_field(jsonpath) for jsonpath in jsonpaths]
+    for record in records:
+        yield tuple(
+            epoch_milliseconds(record.get(field))
+            if column in EPOCH_MILLISECONDS_COLUMNS
+            else record.get(field)
+            for column, field in zip(columns, fields)
+        )
+
+
+def song_rows(records, columns):
+    """
+    Map song_data records to staging_songs rows by column name, as COPY JSON 'auto'
+
+    Parameters
+    ----------
+    records : iterable of dict
+    columns : list of str
+
+    Yields
+    ------
+    row : tuple
+
+    """
+    for record in records:
+        lowered = {key.lower(): value for key, value in record.items()}
+        yield tuple(lowered.get(column) for column in columns)
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of COPY FROM STDIN
+
+    Parameters
+    ----------
+    value : object
+
+    Returns
+    -------
+    text : str
+
+    """
+    if value is None:
+        return "\\N"
+    text = str(value)
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class RowsFile(io.TextIOBase):
+    """Read-only file object streaming rows in the text format of COPY, as required by copy_expert"""
+
+    def __init__(self, rows):
+        self._lines = ("\t".join(copy_value(value) for value in row) + "\n" for row in rows)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_rows(cur, table, columns, rows, batch_size=10000):
+    """
+    Stream rows into a table with COPY FROM STDIN, in batches of batch_size rows,
+    so that memory does not depend on the number of rows
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    table : str
+    columns : list of str
+    rows : iterable of tuple
+    batch_size : int
+
+    Returns
+    -------
+    count : int
+        number of rows copied
+
+    """
+    query = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    rows = iter(rows)
+    count = 0
+    start = time.perf_counter()
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            record_operation("staging", f"COPY {table} FROM STDIN", time.perf_counter() - start, count)
+            return count
+        cur.copy_expert(query, RowsFile(batch))
+        count += len(batch)
+        logger.debug(f"{count} rows copied into {table}")
+
+
+def load_staging_tables(cur, conn, config):
+    """
+    Load the local song_data and log_data directories of the LOCAL section into the staging tables
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    counts : dict
+        staging table name -> number of rows loaded
+
+    """
+    local = config["LOCAL"]
+    batch_size = config.getint("LOCAL", "BATCH_SIZE", fallback=10000)
+
+    events_columns = parse_columns(staging_events_columns)
+    events = event_rows(
+        iter_file_records(local["LOG_DATA"]),
+        events_columns,
+        load_jsonpaths(local.get("LOG_JSONPATH")),
+    )
+    songs_columns = parse_columns(staging_songs_columns)
+    songs = song_rows(iter_file_records(local["SONG_DATA"]), songs_columns)
+
+    counts = {
+        "staging_events": copy_rows(cur, "staging_events", events_columns, events, batch_size),
+        "staging_songs": copy_rows(cur, "staging_songs", songs_columns, songs, batch_size),
+    }
+    conn.commit()
+    for table, count in counts.items():
+        logger.info(f"{count} rows loaded into {table}")
+    return counts
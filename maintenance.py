@@ -0,0 +1,141 @@
+import logging
+import time
+import psycopg2
+from db import get_backend
+from instrumentation import execute, record_skipped
+from shadow import FINAL_TABLES
+from sql_queries import (
+    table_health_select,
+    postgres_table_health_select,
+    statement_timeout_set,
+    vacuum_template,
+    analyze_template,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def table_health(cur, backend="redshift", tables=FINAL_TABLES):
+    """
+    Read the stats off, unsorted and deleted percentages of the tables
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    backend : str
+    tables : list of str
+
+    Returns
+    -------
+    health : dict
+        table -> dict with stats_off, unsorted, deleted (percentages) and size (MB)
+
+    """
+    select = postgres_table_health_select if backend == "postgres" else table_health_select
+    execute(cur, select, "maintenance", (tuple(tables),))
+    return {
+        table: {
+            "stats_off": float(stats_off),
+            "unsorted": float(unsorted),
+            "deleted": float(deleted),
+            "size": int(size or 0),
+        }
+        for table, stats_off, unsorted, deleted, size in cur.fetchall()
+    }
+
+
+def plan_maintenance(health, stats_off_pct=10, unsorted_pct=5, deleted_pct=5):
+    """
+    Choose the VACUUM and ANALYZE queries of the tables past the thresholds, largest tables first.
+    A table both unsorted and with deleted rows gets a VACUUM FULL, and is analyzed after being vacuumed
+
+    Parameters
+    ----------
+    health : dict
+        see table_health
+    stats_off_pct : float
+    unsorted_pct : float
+    deleted_pct : float
+
+    Returns
+    -------
+    queries : list of (table, query, reason) tuples
+
+    """
+    queries = []
+    for table, stats in sorted(health.items(), key=lambda item: item[1]["size"], reverse=True):
+        unsorted = stats["unsorted"] > unsorted_pct
+        deleted = stats["deleted"] > deleted_pct
+        if unsorted or deleted:
+            mode = "FULL" if unsorted and deleted else "SORT ONLY" if unsorted else "DELETE ONLY"
+            queries.append(
+                (
+                    table,
+                    vacuum_template.format(mode=mode, table=table),
+                    f"{stats['unsorted']:.1f}% unsorted, {stats['deleted']:.1f}% deleted",
+                )
+            )
+        if stats["stats_off"] > stats_off_pct:
+            queries.append(
+                (
+                    table,
+                    analyze_template.format(table=table),
+                    f"{stats['stats_off']:.1f}% stats off",
+                )
+            )
+    return queries
+
+
+def run_maintenance(config, conn):
+    """
+    Vacuum and analyze the final tables past the thresholds of the MAINTENANCE section within
+    its time budget: a query is stopped by statement_timeout when the budget runs out and the
+    following ones are skipped. Each query is recorded in the run metrics, skipped ones included
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    done : list of str
+        queries executed successfully
+
+    """
+    section = "MAINTENANCE"
+    budget = config.getfloat(section, "BUDGET_SECONDS", fallback=600)
+    backend = get_backend(config)
+
+    # VACUUM cannot run inside a transaction block
+    conn.commit()
+    conn.autocommit = True
+    done = []
+    try:
+        with conn.cursor() as cur:
+            queries = plan_maintenance(
+                table_health(cur, backend),
+                stats_off_pct=config.getfloat(section, "STATS_OFF_PCT", fallback=10),
+                unsorted_pct=config.getfloat(section, "UNSORTED_PCT", fallback=5),
+                deleted_pct=config.getfloat(section, "DELETED_PCT", fallback=5),
+            )
+            start = time.perf_counter()
+            for table, query, reason in queries:
+                left = budget - (time.perf_counter() - start)
+                if left <= 0:
+                    logger.warning(f"Out of time budget, skipping {query}")
+                    record_skipped("maintenance", query.rstrip(";"))
+                    continue
+                logger.info(f"{query} ({reason})")
+                try:
+                    execute(cur, statement_timeout_set, "maintenance", (int(left * 1000),))
+                    execute(cur, query, "maintenance")
+                    done.append(query)
+                except psycopg2.Error:
+                    logger.exception(f"Issue while maintaining {table}")
+            execute(cur, statement_timeout_set, "maintenance", (0,))
+    finally:
+        conn.autocommit = False
+
+    logger.info(f"Maintenance: {len(done)} of {len(queries)} queries done")
+    return done
@@ -7,6 +7,9 @@ from botocore.exceptions import ClientError
 import json
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from resources import read_resources, write_resources, set_resources
+from sizing import cluster_nodes, elastic_target
 
 FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
 logging.basicConfig(format=FORMAT, level=logging.INFO)
@@ -14,10 +17,18 @@ logger = logging.getLogger(__name__)
 
 
 def create_redshift_cluster(
-    client, role_arn, user, password, cluster_id="sparkify-redshift-cluster-1"
+    client,
+    role_arn,
+    user,
+    password,
+    cluster_id="sparkify-redshift-cluster-1",
+    security_group_ids=(),
+    node_type="dc2.large",
+    number_of_nodes=4,
+    parameter_group=None,
 ):
     """
-    Create a new Redshift cluster composed of four dc2.large nodes
+    Create a new Redshift cluster, by default composed of four dc2.large nodes
 
     Parameters
     ----------
@@ -26,14 +37,30 @@ def create_redshift_cluster(
     user : str
     password : str
     cluster_id : str
+    security_group_ids : iterable of str
+        VPC security groups attached at creation instead of the default one
+    node_type : str
+    number_of_nodes : int
+    parameter_group : str
+        cluster parameter group, e.g. with the WLM queues (see create_wlm_parameter_group)
+
+    Returns
+    -------
+    success : bool
 
     """
     try:
+        options = {}
+        if security_group_ids:
+            options["VpcSecurityGroupIds"] = list(security_group_ids)
+        if parameter_group:
+            options["ClusterParameterGroupName"] = parameter_group
+        if number_of_nodes > 1:
+            options["NumberOfNodes"] = number_of_nodes
         client.create_cluster(
             # HW
-            ClusterType="multi-node",
-            NodeType="dc2.large",
-            NumberOfNodes=4,
+            ClusterType="multi-node" if number_of_nodes > 1 else "single-node",
+            NodeType=node_type,
             # Identifiers & Credentials
             DBName="sparkifydb",
             ClusterIdentifier=cluster_id,
@@ -41,12 +68,15 @@ def create_redshift_cluster(
             MasterUserPassword=password,
             # Roles for S3
             IamRoles=[role_arn],
+            **options,
         )
 
         logger.info(f"{cluster_id} initialization started...")
+        return True
 
     except ClientError:
         logger.exception("Issue while creating the cluster (see below)")
+        return False
 
 
 def check_cluster(client, cluster_id="sparkify-redshift-cluster-1", deleted=False):
@@ -84,6 +114,233 @@ def check_cluster(client, cluster_id="sparkify-redshift-cluster-1", deleted=Fals
             logger.exception("Issue while describing cluster (see below)")
 
 
+def poll(check, name, delay=10, max_delay=60, timeout=3600, sleep=time.sleep):
+    """
+    Call check until it reports done, doubling the delay between two calls up to max_delay,
+    so that short transitions are noticed early and long ones polled sparingly
+
+    Parameters
+    ----------
+    check : callable
+        returns (done, status, result)
+    name : str
+        what is polled, for the log messages
+    delay : float
+        seconds before the second call
+    max_delay : float
+    timeout : float
+    sleep : callable
+        time.sleep, replaced when testing
+
+    Returns
+    -------
+    result
+        the result of the last call of check
+
+    Raises
+    ------
+    TimeoutError
+        if check does not report done within timeout seconds
+
+    """
+    waited = 0
+    while True:
+        done, status, result = check()
+        if done:
+            return result
+        if waited >= timeout:
+            raise TimeoutError(f"{name} still {status} after {waited:.0f}s")
+        logger.info(f"{name} is {status}... Please, wait...")
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+
+def wait_for_cluster(
+    client, cluster_id="sparkify-redshift-cluster-1", status="available", sleep=time.sleep, **options
+):
+    """
+    Poll the status of a cluster until it reaches the given one
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    cluster_id : str
+    status : str or None
+        status to wait for, None waits for the cluster to be deleted
+    sleep : callable
+        time.sleep, replaced when testing
+    options
+        delay, max_delay and timeout of poll
+
+    Returns
+    -------
+    (cluster_id, cluster_status, endpoint, vpcId) : tuple
+
+    """
+
+    def check():
+        cluster = check_cluster(client, cluster_id, deleted=status is None) or (
+            cluster_id,
+            None,
+            None,
+            None,
+        )
+        return cluster[1] == status, cluster[1], cluster
+
+    return poll(check, cluster_id, sleep=sleep, **options)
+
+
+def wait_for_snapshot(client, snapshot_id, sleep=time.sleep, **options):
+    """
+    Poll the status of a manual snapshot until it is available
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    snapshot_id : str
+    sleep : callable
+    options
+        delay, max_delay and timeout of poll
+
+    """
+
+    def check():
+        response = client.describe_cluster_snapshots(SnapshotIdentifier=snapshot_id)
+        status = response["Snapshots"][0]["Status"]
+        return status == "available", status, None
+
+    poll(check, snapshot_id, sleep=sleep, **options)
+
+
+def wait_for_resize(client, cluster_id, nodes, sleep=time.sleep, **options):
+    """
+    Poll a cluster until it is available with the given nodes, since right after the resize
+    request it may still be reported available with the previous ones
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    cluster_id : str
+    nodes : int
+    sleep : callable
+    options
+        delay, max_delay and timeout of poll
+
+    """
+
+    def check():
+        cluster = client.describe_clusters(ClusterIdentifier=cluster_id)["Clusters"][0]
+        done = cluster["ClusterStatus"] == "available" and cluster["NumberOfNodes"] == nodes
+        return done, f"{cluster['ClusterStatus']} with {cluster['NumberOfNodes']} nodes", None
+
+    poll(check, cluster_id, sleep=sleep, **options)
+
+
+def restore_redshift_cluster(
+    client,
+    role_arn,
+    snapshot_id,
+    cluster_id="sparkify-redshift-cluster-1",
+    security_group_ids=(),
+    parameter_group=None,
+):
+    """
+    Restore a Redshift cluster from a snapshot, with the data loaded when the snapshot was taken
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    role_arn : str
+    snapshot_id : str
+    cluster_id : str
+    security_group_ids : iterable of str
+    parameter_group : str
+
+    Returns
+    -------
+    success : bool
+
+    """
+    try:
+        options = {}
+        if parameter_group:
+            options["ClusterParameterGroupName"] = parameter_group
+        client.restore_from_cluster_snapshot(
+            ClusterIdentifier=cluster_id,
+            SnapshotIdentifier=snapshot_id,
+            IamRoles=[role_arn],
+            VpcSecurityGroupIds=list(security_group_ids),
+            **options,
+        )
+        logger.info(f"{cluster_id} restore from {snapshot_id} started...")
+        return True
+
+    except ClientError:
+        logger.exception("Issue while restoring the cluster (see below)")
+        return False
+
+
+def get_default_vpc(client):
+    """
+    Get the id of the default VPC, where the cluster is created when no subnet group is given
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+
+    Returns
+    -------
+    vpc_id : str
+        None if the account has no default VPC
+
+    """
+    response = client.describe_vpcs(Filters=[{"Name": "isDefault", "Values": ["true"]}])
+    if not response["Vpcs"]:
+        logger.error("No default VPC found, create one or restore it to create the cluster")
+        return None
+    return response["Vpcs"][0]["VpcId"]
+
+
+class StepTimer:
+    """
+    Measure the duration of the provisioning steps, which may run in different threads
+
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.started = time.perf_counter()
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Run a step and record its duration
+
+        Parameters
+        ----------
+        name : str
+        func : callable
+        args, kwargs
+            arguments of func
+
+        Returns
+        -------
+        result
+            whatever func returns
+
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def log(self):
+        for name, seconds in self.timings.items():
+            logger.info(f"Step {name}: {seconds:.1f}s")
+        logger.info(f"Total: {time.perf_counter() - self.started:.1f}s")
+
+
 def create_security_group(client, vpc_id, ip, port_from, port_to):
     """
     Create a new security group for the redshift cluster
@@ -205,6 +462,89 @@ def create_iam_role(
         logger.exception("Issue while creating the Role (see below)")
 
 
+def wlm_configuration(config):
+    """
+    Build the manual WLM configuration of the WLM section: a queue for the ETL query group, one
+    for the analysts and the default queue with the memory left, plus short query acceleration
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    queues : list of dict
+        value of the wlm_json_configuration parameter
+
+    """
+    etl_memory = config.getint("WLM", "ETL_MEMORY_PCT", fallback=60)
+    analyst_memory = config.getint("WLM", "ANALYST_MEMORY_PCT", fallback=30)
+    if etl_memory + analyst_memory >= 100:
+        raise ValueError("ETL_MEMORY_PCT and ANALYST_MEMORY_PCT must leave memory to the default queue")
+    return [
+        {
+            "query_group": [config.get("WLM", "QUERY_GROUP", fallback="etl")],
+            "query_concurrency": config.getint("WLM", "ETL_CONCURRENCY", fallback=3),
+            "memory_percent_to_use": etl_memory,
+        },
+        {
+            "query_group": [config.get("WLM", "ANALYST_QUERY_GROUP", fallback="analyst")],
+            "query_concurrency": config.getint("WLM", "ANALYST_CONCURRENCY", fallback=5),
+            "memory_percent_to_use": analyst_memory,
+        },
+        {
+            "query_concurrency": config.getint("WLM", "DEFAULT_CONCURRENCY", fallback=2),
+            "memory_percent_to_use": 100 - etl_memory - analyst_memory,
+        },
+        {"short_query_queue": True},
+    ]
+
+
+def create_wlm_parameter_group(client, name, queues):
+    """
+    Create the cluster parameter group holding the WLM queues, or update it if it already exists
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    name : str
+    queues : list of dict
+        see wlm_configuration
+
+    Returns
+    -------
+    name : str
+        None if the parameter group could not be created
+
+    """
+    try:
+        try:
+            client.create_cluster_parameter_group(
+                ParameterGroupName=name,
+                ParameterGroupFamily="redshift-1.0",
+                Description="Sparkify WLM queues: ETL, analysts and default",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ClusterParameterGroupAlreadyExists":
+                raise
+        client.modify_cluster_parameter_group(
+            ParameterGroupName=name,
+            Parameters=[
+                {
+                    "ParameterName": "wlm_json_configuration",
+                    "ParameterValue": json.dumps(queues),
+                    "ApplyType": "static",
+                }
+            ],
+        )
+        logger.info(f"Parameter group {name} ready with {len(queues)} WLM queues")
+        return name
+
+    except ClientError:
+        logger.exception("Issue while creating the parameter group (see below)")
+        return None
+
+
 def get_my_ip():
     """
     Get client's ip to create stricter security rules, i.e. avoiding 0.0.0.0/0
@@ -221,71 +561,152 @@ def get_my_ip():
         logger.exception("Unable to retrieve your IP (see below).")
 
 
-def free_resources():
+def free_resources(iam=None, redshift=None, ec2=None, sleep=time.sleep):
     """
-    Delete all the resources created to run the Redshift cluster
+    Delete all the resources created to run the Redshift cluster.
+    The IAM role is deleted while the cluster is shutting down, the security group only
+    once the cluster is deleted because it stays in use until then
 
     Parameters
     ----------
-    redshift_client : boto3.session.Session.client
-    iam_client : boto3.session.Session.client
-    ec2_client : boto3.session.Session.client
+    iam : boto3.session.Session.client, optional
+    redshift : boto3.session.Session.client, optional
+    ec2 : boto3.session.Session.client, optional
+        clients to use instead of the default ones, e.g. stubbed when testing
+    sleep : callable
+        time.sleep, replaced when testing
 
     """
 
-    iam = boto3.client("iam")
-    redshift = boto3.client("redshift")
-    ec2 = boto3.client("ec2")
+    iam = iam or boto3.client("iam")
+    redshift = redshift or boto3.client("redshift")
+    ec2 = ec2 or boto3.client("ec2")
+    timer = StepTimer()
 
-    # get cluster_id, role_name, security_group_id from the config file
+    # get cluster_id, role_name, security_group_id from the config file, a failed
+    # create_resources records only the resources it created
     try:
-        resources_config = configparser.ConfigParser()
-        resources_config.read("resources.cfg")
-        role_name = resources_config["RESOURCES"]["ROLE_NAME"]
-        cluster_id = resources_config["RESOURCES"]["ClusterIdentifier"]
-        security_group_id = resources_config["RESOURCES"]["SecurityGroupId"]
+        resources_config = read_resources()
+        role_name = resources_config["RESOURCES"].get("ROLE_NAME")
+        cluster_id = resources_config["RESOURCES"].get("ClusterIdentifier")
+        security_group_id = resources_config["RESOURCES"].get("SecurityGroupId")
 
         # delete the cluster and skip the final snapshot
-        redshift.delete_cluster(
-            ClusterIdentifier=cluster_id, SkipFinalClusterSnapshot=True
-        )
-
-        _, cluster_status, _, _ = check_cluster(redshift, deleted=True)
-
-        while cluster_status != None:
-            logger.info("Cluster is being deleted... Please, wait...")
-            _, cluster_status, _, _ = check_cluster(redshift, deleted=True)
-            time.sleep(50)
-
-        logger.info("Cluster deleted successfully")
-
-        # detach the policy first
-        iam.detach_role_policy(
-            RoleName=role_name,
-            PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess",
-        )
-        # then delete the role
-        iam.delete_role(RoleName=role_name)
+        if cluster_id:
+            timer.run(
+                "delete_cluster",
+                redshift.delete_cluster,
+                ClusterIdentifier=cluster_id,
+                SkipFinalClusterSnapshot=True,
+            )
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            role_deleted = None
+            if role_name:
+                role_deleted = executor.submit(timer.run, "delete_role", delete_iam_role, iam, role_name)
+            if cluster_id:
+                timer.run(
+                    "wait_cluster_deleted",
+                    wait_for_cluster,
+                    redshift,
+                    cluster_id,
+                    status=None,
+                    sleep=sleep,
+                )
+                logger.info("Cluster deleted successfully")
+            if role_deleted:
+                role_deleted.result()
 
         # delete the security group by id
-        ec2.delete_security_group(GroupId=security_group_id)
-
-        logger.info(
-            f"Resources {cluster_id}, {role_name}, {security_group_id} deleted successfully"
-        )
+        if security_group_id:
+            timer.run("delete_security_group", ec2.delete_security_group, GroupId=security_group_id)
+        # the parameter group, like the security group, is in use until the cluster is deleted
+        parameter_group_name = resources_config["RESOURCES"].get("ParameterGroupName")
+        if parameter_group_name:
+            timer.run(
+                "delete_parameter_group",
+                redshift.delete_cluster_parameter_group,
+                ParameterGroupName=parameter_group_name,
+            )
+        set_resources("RESOURCES", ClusterState="deleted")
+
+        deleted = [name for name in (cluster_id, role_name, security_group_id) if name]
+        logger.info(f"Resources {', '.join(deleted)} deleted successfully")
 
     except ClientError:
         logger.exception("Issue while deleting the resources (see below)")
 
+    except TimeoutError:
+        logger.exception("Issue while waiting for the cluster (see below)")
+
     except Exception:
         logger.exception("Unable to locate resources.cfg")
 
+    timer.log()
+
+
+def delete_iam_role(
+    client, role_name, policy_arn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+):
+    """
+    Detach the policy of the role, then delete the role
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    role_name : str
+    policy_arn : str
+
+    """
+    client.detach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    client.delete_role(RoleName=role_name)
+
 
-def create_resources():
+def prepare_security_group(client, ip, port):
+    """
+    Create the security group of the cluster in the default VPC
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    ip : concurrent.futures.Future
+        client's ip, looked up concurrently
+    port : int
+
+    Returns
+    -------
+    security_group_id : str
+        None if the security group could not be created
+
+    """
+    vpc_id = get_default_vpc(client)
+    if vpc_id is None:
+        return None
+    return create_security_group(client, vpc_id, ip.result(), port, port)
+
+
+def create_resources(
+    iam=None, redshift=None, ec2=None, get_ip=get_my_ip, sleep=time.sleep, snapshot_id=None
+):
     """
     Create a Redshift cluster with all the resources needed and write 
-    cluster info and IAM Role to dwh.cfg file
+    cluster info and IAM Role to dwh.cfg file.
+    The IAM role, the ip lookup and the security group are prepared concurrently, then the cluster
+    is created (or restored from a snapshot) with the security group already attached
     
+    Parameters
+    ----------
+    iam : boto3.session.Session.client, optional
+    redshift : boto3.session.Session.client, optional
+    ec2 : boto3.session.Session.client, optional
+        clients to use instead of the default ones, e.g. stubbed when testing
+    get_ip : callable
+        returns the client's ip, replaced when testing
+    sleep : callable
+        time.sleep, replaced when testing
+    snapshot_id : str, optional
+        snapshot to restore the cluster from, e.g. taken by snapshot_resources
+
     """
 
     # boto3 automatically looks for key, secret, and region in these vars
@@ -294,39 +715,113 @@ def create_resources():
     # ROLE_NAME AND DB_NAME to consider in the config file
     ROLE_NAME = "sparkifydbRole"
     DB_NAME = "sparkifydb"
+    CLUSTER_ID = "sparkify-redshift-cluster-1"
 
-    iam = boto3.client("iam")
-    redshift = boto3.client("redshift")
-    ec2 = boto3.client("ec2")
+    iam = iam or boto3.client("iam")
+    redshift = redshift or boto3.client("redshift")
+    ec2 = ec2 or boto3.client("ec2")
+    timer = StepTimer()
 
     dwh_config = configparser.ConfigParser()
-    resources_config = configparser.ConfigParser()
     # preserve case, i.e. avoid default conversion to lowercase
     dwh_config.optionxform = str
     dwh_config.read("dwh.cfg")
 
-    # preserve case, i.e. avoid default conversion to lowercase
-    resources_config.optionxform = str
+    # the snapshots taken before are kept
+    resources_config = read_resources()
     # create a new section to keep track of the resources for later deletion
     resources_config["RESOURCES"] = {}
+    # the load recorded belongs to the previous cluster
+    resources_config.remove_section("LOAD")
+
+    port = int(dwh_config["CLUSTER"].get("DB_PORT") or 5439)
+    parameter_group_name = dwh_config.get("WLM", "PARAMETER_GROUP", fallback="")
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        ip = executor.submit(timer.run, "get_ip", get_ip)
+        role = executor.submit(timer.run, "create_role", create_iam_role, iam, ROLE_NAME)
+        security_group = executor.submit(
+            timer.run, "create_security_group", prepare_security_group, ec2, ip, port
+        )
+        # a restored cluster keeps the nodes of its snapshot
+        nodes = None if snapshot_id else executor.submit(timer.run, "sizing", cluster_nodes, dwh_config)
+        parameter_group = None
+        if parameter_group_name:
+            parameter_group = executor.submit(
+                timer.run,
+                "create_parameter_group",
+                create_wlm_parameter_group,
+                redshift,
+                parameter_group_name,
+                wlm_configuration(dwh_config),
+            )
+        role_arn = role.result()
+        security_group_id = security_group.result()
+        number_of_nodes = nodes.result() if nodes else None
+        parameter_group_name = parameter_group.result() if parameter_group else None
+
+    if dwh_config.get("WLM", "PARAMETER_GROUP", fallback="") and parameter_group_name is None:
+        logger.warning("WLM parameter group not created, the cluster uses the default WLM queue")
+
+    # record the resources as soon as they exist, so that free_resources deletes them
+    # even if a later step fails
+    if role_arn:
+        resources_config["RESOURCES"]["ROLE_NAME"] = ROLE_NAME
+    if security_group_id:
+        resources_config["RESOURCES"]["SecurityGroupId"] = security_group_id
+    if parameter_group_name:
+        resources_config["RESOURCES"]["ParameterGroupName"] = parameter_group_name
+    write_resources(resources_config)
+
+    if role_arn is None or security_group_id is None:
+        logger.error("IAM role or security group not created, the cluster is not created")
+        timer.log()
+        return
 
-    role_arn = create_iam_role(iam, role_name=ROLE_NAME)
     dwh_config["IAM_ROLE"]["ARN"] = role_arn
 
-    # create a redshift cluster using the default identifier
-    create_redshift_cluster(
-        redshift,
-        role_arn,
-        dwh_config["CLUSTER"]["DB_USER"],
-        dwh_config["CLUSTER"]["DB_PASSWORD"],
-    )
+    if snapshot_id:
+        created = timer.run(
+            "restore_cluster",
+            restore_redshift_cluster,
+            redshift,
+            role_arn,
+            snapshot_id,
+            cluster_id=CLUSTER_ID,
+            security_group_ids=[security_group_id],
+            parameter_group=parameter_group_name,
+        )
+    else:
+        # create a redshift cluster using the default identifier
+        created = timer.run(
+            "create_cluster",
+            create_redshift_cluster,
+            redshift,
+            role_arn,
+            dwh_config["CLUSTER"]["DB_USER"],
+            dwh_config["CLUSTER"]["DB_PASSWORD"],
+            cluster_id=CLUSTER_ID,
+            security_group_ids=[security_group_id],
+            node_type=dwh_config["HW"]["NODE_TYPE"],
+            number_of_nodes=number_of_nodes,
+            parameter_group=parameter_group_name,
+        )
+        dwh_config["HW"]["NUMBER_OF_NODES"] = str(number_of_nodes)
+    if not created:
+        timer.log()
+        return
 
-    cluster_id, cluster_status, endpoint, vpc_id = check_cluster(redshift)
+    resources_config["RESOURCES"]["ClusterIdentifier"] = CLUSTER_ID
+    resources_config["RESOURCES"]["ClusterState"] = "creating"
+    write_resources(resources_config)
 
-    while cluster_status != "available":
-        logger.info("Cluster is being created... Please, wait...")
-        cluster_id, cluster_status, endpoint, vpc_id = check_cluster(redshift)
-        time.sleep(60)
+    try:
+        _, _, endpoint, _ = timer.run(
+            "wait_cluster_available", wait_for_cluster, redshift, CLUSTER_ID, sleep=sleep
+        )
+    except TimeoutError:
+        logger.exception("Issue while waiting for the cluster (see below)")
+        timer.log()
+        return
 
     logger.info("Cluster created successfully.")
 
@@ -335,21 +830,17 @@ def create_resources():
     dwh_config["CLUSTER"]["DB_PORT"] = str(endpoint["Port"])
     dwh_config["CLUSTER"]["DB_NAME"] = DB_NAME
 
-    # create a security group for the cluster (using the default name)
-    security_group_id = create_security_group(
-        ec2, vpc_id, get_my_ip(), endpoint["Port"], endpoint["Port"]
-    )
-
-    # replace default security group attached to the cluster
-    replace_security_group(redshift, cluster_id, security_group_id)
+    resources_config["RESOURCES"]["ClusterState"] = "available"
 
-    # keep track of the resources created: ROLE_NAME, cluster_id, security_group_id
-    resources_config["RESOURCES"]["ROLE_NAME"] = ROLE_NAME
-    resources_config["RESOURCES"]["ClusterIdentifier"] = cluster_id
-    resources_config["RESOURCES"]["SecurityGroupId"] = security_group_id
+    # a new cluster is empty, a restored one holds the data loaded before the snapshot
+    if snapshot_id:
+        resources_config["RESOURCES"]["RestoredFrom"] = snapshot_id
+        if resources_config.get("SNAPSHOT", "SnapshotIdentifier", fallback=None) == snapshot_id:
+            loaded_at = resources_config.get("SNAPSHOT", "LoadedAt", fallback=None)
+            if loaded_at:
+                resources_config["LOAD"] = {"LoadedAt": loaded_at}
 
-    with open("resources.cfg", "w") as res_file:
-        resources_config.write(res_file)
+    write_resources(resources_config)
 
     with open("dwh.cfg", "w") as dwh_file:
         dwh_config.write(dwh_file)
@@ -357,13 +848,175 @@ def create_resources():
     logger.info(
         "Resources created successfully and information written to dwh.cfg and resources.cfg"
     )
+    timer.log()
+
+
+def pause_resources(redshift=None, sleep=time.sleep):
+    """
+    Pause the cluster: its data is kept and only its storage is billed until it is resumed
+
+    Parameters
+    ----------
+    redshift : boto3.session.Session.client, optional
+    sleep : callable
+        time.sleep, replaced when testing
+
+    """
+    redshift = redshift or boto3.client("redshift")
+    try:
+        cluster_id = read_resources()["RESOURCES"]["ClusterIdentifier"]
+        redshift.pause_cluster(ClusterIdentifier=cluster_id)
+        wait_for_cluster(redshift, cluster_id, status="paused", sleep=sleep)
+        set_resources("RESOURCES", ClusterState="paused")
+        logger.info(f"{cluster_id} paused")
+
+    except ClientError:
+        logger.exception("Issue while pausing the cluster (see below)")
+
+    except TimeoutError:
+        logger.exception("Issue while waiting for the cluster (see below)")
+
+    except KeyError:
+        logger.exception("Unable to locate the cluster in resources.cfg")
+
+
+def resume_resources(redshift=None, sleep=time.sleep):
+    """
+    Resume a paused cluster, with the data it held when paused
+
+    Parameters
+    ----------
+    redshift : boto3.session.Session.client, optional
+    sleep : callable
+        time.sleep, replaced when testing
+
+    """
+    redshift = redshift or boto3.client("redshift")
+    try:
+        cluster_id = read_resources()["RESOURCES"]["ClusterIdentifier"]
+        redshift.resume_cluster(ClusterIdentifier=cluster_id)
+        wait_for_cluster(redshift, cluster_id, sleep=sleep)
+        set_resources("RESOURCES", ClusterState="available")
+        logger.info(f"{cluster_id} resumed")
+
+    except ClientError:
+        logger.exception("Issue while resuming the cluster (see below)")
+
+    except TimeoutError:
+        logger.exception("Issue while waiting for the cluster (see below)")
+
+    except KeyError:
+        logger.exception("Unable to locate the cluster in resources.cfg")
+
+
+def snapshot_resources(redshift=None, sleep=time.sleep):
+    """
+    Take a manual snapshot of the cluster and record it in resources.cfg, together with the last
+    load of etl.py it holds, so that a cluster restored from it is not loaded again
+
+    Parameters
+    ----------
+    redshift : boto3.session.Session.client, optional
+    sleep : callable
+        time.sleep, replaced when testing
+
+    Returns
+    -------
+    snapshot_id : str
+
+    """
+    redshift = redshift or boto3.client("redshift")
+    try:
+        resources_config = read_resources()
+        cluster_id = resources_config["RESOURCES"]["ClusterIdentifier"]
+        snapshot_id = f"{cluster_id}-{time.strftime('%Y%m%d%H%M%S')}"
+        redshift.create_cluster_snapshot(
+            SnapshotIdentifier=snapshot_id, ClusterIdentifier=cluster_id
+        )
+        wait_for_snapshot(redshift, snapshot_id, sleep=sleep)
+        set_resources(
+            "SNAPSHOT",
+            SnapshotIdentifier=snapshot_id,
+            LoadedAt=resources_config.get("LOAD", "LoadedAt", fallback=None),
+        )
+        logger.info(f"Snapshot {snapshot_id} of {cluster_id} taken")
+        return snapshot_id
+
+    except ClientError:
+        logger.exception("Issue while taking the snapshot (see below)")
+
+    except TimeoutError:
+        logger.exception("Issue while waiting for the snapshot (see below)")
+
+    except KeyError:
+        logger.exception("Unable to locate the cluster in resources.cfg")
+
+
+def resize_resources(nodes, redshift=None, sleep=time.sleep):
+    """
+    Elastic resize of the cluster to the given nodes, bounded to what a single elastic resize supports
+
+    Parameters
+    ----------
+    nodes : int
+    redshift : boto3.session.Session.client, optional
+    sleep : callable
+        time.sleep, replaced when testing
+
+    Returns
+    -------
+    previous : int
+        nodes before the resize, None if the cluster was not resized
+
+    """
+    redshift = redshift or boto3.client("redshift")
+    try:
+        cluster_id = read_resources()["RESOURCES"]["ClusterIdentifier"]
+        response = redshift.describe_clusters(ClusterIdentifier=cluster_id)
+        previous = response["Clusters"][0]["NumberOfNodes"]
+        target = elastic_target(previous, nodes)
+        if target != nodes:
+            logger.warning(f"{nodes} nodes out of the elastic resize range, resizing to {target}")
+        if target == previous:
+            return None
+
+        redshift.resize_cluster(ClusterIdentifier=cluster_id, NumberOfNodes=target, Classic=False)
+        wait_for_resize(redshift, cluster_id, target, sleep=sleep)
+        logger.info(f"{cluster_id} resized from {previous} to {target} nodes")
+        return previous
+
+    except ClientError:
+        logger.exception("Issue while resizing the cluster (see below)")
+
+    except TimeoutError:
+        logger.exception("Issue while waiting for the cluster (see below)")
+
+    except KeyError:
+        logger.exception("Unable to locate the cluster in resources.cfg")
+
+
+def restore_resources(snapshot_id=None):
+    """
+    Create the resources again, restoring the cluster from a snapshot (by default the last one
+    recorded in resources.cfg) instead of creating an empty one
+
+    Parameters
+    ----------
+    snapshot_id : str, optional
+
+    """
+    snapshot_id = snapshot_id or read_resources().get("SNAPSHOT", "SnapshotIdentifier", fallback=None)
+    if not snapshot_id:
+        logger.error("No snapshot recorded in resources.cfg, take one with: manage_cluster.py snapshot")
+        return
+    create_resources(snapshot_id=snapshot_id)
 
 
 if __name__ == "__main__":
-    # only one argument, using argparse or click seems overkilling
+    # only one action (plus the snapshot to restore), using argparse or click seems overkilling
     if len(sys.argv) < 2:
         print("Usage: manage_cluster.py action.")
-        print("Where action may be either create or delete")
+        print("Where action may be create, delete, pause, resume, snapshot or restore [snapshot_id]")
         sys.exit(1)
 
     if sys.argv[1] == "create":
@@ -372,6 +1025,18 @@ if __name__ == "__main__":
     elif sys.argv[1] == "delete":
         free_resources()
 
+    elif sys.argv[1] == "pause":
+        pause_resources()
+
+    elif sys.argv[1] == "resume":
+        resume_resources()
+
+    elif sys.argv[1] == "snapshot":
+        snapshot_resources()
+
+    elif sys.argv[1] == "restore":
+        restore_resources(sys.argv[2] if len(sys.argv) > 2 else None)
+
     else:
         print(f"Unrecognized argument: {sys.argv[1]}")
         sys.exit(1)
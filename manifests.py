@@ -0,0 +1,189 @@
+import argparse
+import configparser
+import json
+import logging
+import boto3
+from s3_utils import list_objects, split_s3_url
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# slices per node of each node type, see
+# https://docs.aws.amazon.com/redshift/latest/mgmt/working-with-clusters.html#rs-node-type-info
+SLICES_PER_NODE = {
+    "dc2.large": 2,
+    "dc2.8xlarge": 16,
+    "ds2.xlarge": 2,
+    "ds2.8xlarge": 16,
+    "ra3.xlplus": 2,
+    "ra3.4xlarge": 4,
+    "ra3.16xlarge": 16,
+}
+
+# extensions of the chunks written by compaction.py for each codec
+EXTENSIONS = {"gzip": ".json.gz", "zstd": ".json.zst"}
+
+# below this average size the per-file overhead of COPY dominates, see compaction
+SMALL_FILE_BYTES = 1024 * 1024
+
+# above this ratio of the average size, a file keeps its slice loading long after the others are done
+SKEWED_FILE_RATIO = 2
+
+
+def slice_count(node_type, nodes):
+    """
+    Return the number of slices of a cluster
+
+    Parameters
+    ----------
+    node_type : str
+    nodes : int
+
+    Returns
+    -------
+    slices : int
+
+    """
+    if node_type not in SLICES_PER_NODE:
+        raise ValueError(f"Unknown node type {node_type}")
+    return SLICES_PER_NODE[node_type] * nodes
+
+
+def build_manifest(bucket, objects):
+    """
+    Build a COPY manifest listing the objects
+
+    Parameters
+    ----------
+    bucket : str
+    objects : list of (key, size) tuples
+
+    Returns
+    -------
+    manifest : dict
+
+    """
+    return {
+        "entries": [
+            {
+                "url": f"s3://{bucket}/{key}",
+                "mandatory": True,
+                "meta": {"content_length": size},
+            }
+            for key, size in objects
+        ]
+    }
+
+
+def write_manifest(client, url, manifest):
+    """
+    Upload a manifest to S3
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    url : str
+    manifest : dict
+
+    """
+    bucket, key = split_s3_url(url)
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+    logger.info(f"Manifest with {len(manifest['entries'])} entries written to {url}")
+
+
+def generate_manifest(client, source_url, manifest_url, slices, suffix=None):
+    """
+    List the objects under a source prefix and write a COPY manifest for them. COPY assigns the files
+    to the slices itself, whatever their order in the manifest: the load is only balanced when the number
+    of files is a multiple of the slices and the files have similar sizes, which the report tells
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    source_url : str
+    manifest_url : str
+    slices : int
+    suffix : str
+        only list the keys ending with it, e.g. .json
+
+    Returns
+    -------
+    report : dict
+        files, bytes, largest file, slices and files per slice of the manifest
+
+    """
+    bucket, _ = split_s3_url(source_url)
+    objects = [
+        (key, size)
+        for key, size in list_objects(client, source_url)
+        if suffix is None or key.endswith(suffix)
+    ]
+    write_manifest(client, manifest_url, build_manifest(bucket, sorted(objects)))
+
+    total = sum(size for _, size in objects)
+    report = {
+        "source": source_url,
+        "manifest": manifest_url,
+        "files": len(objects),
+        "bytes": total,
+        "largest_bytes": max((size for _, size in objects), default=0),
+        "slices": slices,
+        "files_per_slice": len(objects) / slices,
+        "remainder": len(objects) % slices,
+    }
+    if objects and report["remainder"]:
+        logger.warning(
+            f"{len(objects)} files are not a multiple of {slices} slices: "
+            f"{report['remainder']} slices get one more file than the others"
+        )
+    if objects and report["largest_bytes"] > SKEWED_FILE_RATIO * total / len(objects):
+        logger.warning(
+            f"The largest file of {source_url} is {report['largest_bytes']} bytes, more than {SKEWED_FILE_RATIO} times "
+            "the average: the slice loading it finishes last, consider compacting the files into chunks of similar size"
+        )
+    if objects and total / len(objects) < SMALL_FILE_BYTES:
+        logger.warning(
+            f"Average file size of {source_url} is {total / len(objects):.0f} bytes, "
+            "consider compacting the files before loading them"
+        )
+    return report
+
+
+def main(argv=None):
+    """
+    Write the COPY manifests of log_data and song_data (or of their compacted chunks) to the
+    urls LOG_MANIFEST and SONG_MANIFEST of the S3 section, for the cluster described in the HW section
+
+    """
+    parser = argparse.ArgumentParser(description="Generate COPY manifests")
+    parser.add_argument("--config", default="dwh.cfg")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    slices = slice_count(
+        config.get("HW", "NODE_TYPE", fallback="dc2.large"),
+        config.getint("HW", "NUMBER_OF_NODES", fallback=4),
+    )
+
+    client = boto3.client("s3")
+    sources = (
+        ("LOG_DATA", "LOG_MANIFEST", "LOG_TARGET"),
+        ("SONG_DATA", "SONG_MANIFEST", "SONG_TARGET"),
+    )
+    for source, manifest, target in sources:
+        if not config["S3"].get(manifest):
+            logger.info(f"{manifest} not set, skipping {source}")
+            continue
+        # list the compacted chunks when the files have been compacted (see compaction.py)
+        source_url, suffix = config["S3"][source], ".json"
+        if config.get("COMPACTION", target, fallback=""):
+            source_url = config["COMPACTION"][target]
+            suffix = EXTENSIONS[config.get("COMPACTION", "CODEC", fallback="gzip").lower()]
+        report = generate_manifest(client, source_url, config["S3"][manifest], slices, suffix=suffix)
+        logger.info(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
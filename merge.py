@@ -0,0 +1,135 @@
+import logging
+from instrumentation import execute
+from sql_queries import (
+    merge_stage_template,
+    merge_changed_template,
+    merge_newer_template,
+    merge_count_template,
+    merge_delete_template,
+    merge_insert_template,
+    merge_drop_template,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def changed_condition(columns, new, old):
+    """
+    Build the condition matching rows where at least one of the columns changed
+
+    Parameters
+    ----------
+    columns : list of str
+    new : str
+        alias (or table name) of the staged rows
+    old : str
+        alias (or table name) of the rows of the dimension
+
+    Returns
+    -------
+    condition : str
+
+    """
+    return " OR ".join(
+        merge_changed_template.format(new=new, old=old, column=column)
+        for column in columns
+    )
+
+
+def replace_condition(merge, new, old):
+    """
+    Build the condition matching the rows of the dimension to replace with the staged rows: rows
+    whose values changed or, for a dimension with a version column, rows older than the staged ones
+
+    Parameters
+    ----------
+    merge : dict
+        see merge_queries
+    new : str
+        alias (or table name) of the staged rows
+    old : str
+        alias (or table name) of the rows of the dimension
+
+    Returns
+    -------
+    condition : str
+
+    """
+    if merge.get("version"):
+        return merge_newer_template.format(new=new, old=old, column=merge["version"])
+    return changed_condition(merge["columns"], new, old)
+
+
+def merge_queries(merge):
+    """
+    Build the queries merging a dimension: stage, count, delete, insert and drop
+
+    Parameters
+    ----------
+    merge : dict
+        table, key, columns and select of the dimension, and optionally its version column, e.g. the
+        ts of the event a row was taken from (see sql_queries.user_table_merge)
+
+    Returns
+    -------
+    queries : dict
+        query name -> query
+
+    """
+    table, key, columns = merge["table"], merge["key"], merge["columns"]
+    updated = changed_condition(columns, "s", "t")
+    if merge.get("version"):
+        # rows only refreshing their version are replaced but not counted as updated
+        updated = f"({updated}) AND {replace_condition(merge, 's', 't')}"
+        columns = columns + [merge["version"]]
+    return {
+        "stage": merge_stage_template.format(table=table, select=merge["select"]),
+        "count": merge_count_template.format(table=table, key=key, changed=updated),
+        "delete": merge_delete_template.format(
+            table=table, key=key, changed=replace_condition(merge, "s", table)
+        ),
+        "insert": merge_insert_template.format(
+            table=table,
+            key=key,
+            columns=", ".join(columns),
+            source_columns=", ".join(f"s.{column}" for column in columns),
+        ),
+        "drop": merge_drop_template.format(table=table),
+    }
+
+
+def merge_dimension(cur, merge, stage="insert"):
+    """
+    Merge the rows returned by the SELECT of a dimension into the dimension table, i.e. insert
+    the new keys, replace the rows whose values changed (or the older versions) and leave the others untouched.
+    The caller is in charge of committing
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    merge : dict
+        table, key, columns and select of the dimension (see sql_queries.user_table_merge)
+    stage : str
+        stage of the run the queries are recorded in (see instrumentation.py)
+
+    Returns
+    -------
+    counts : dict
+        number of rows inserted, updated and unchanged
+
+    """
+    queries = merge_queries(merge)
+
+    logger.info(f"Executing query {queries['stage']}")
+    execute(cur, queries["stage"], stage)
+    execute(cur, queries["count"], stage)
+    inserted, updated, unchanged = (value or 0 for value in cur.fetchone())
+    execute(cur, queries["delete"], stage)
+    execute(cur, queries["insert"], stage)
+    execute(cur, queries["drop"], stage)
+
+    counts = {"inserted": inserted, "updated": updated, "unchanged": unchanged}
+    logger.info(
+        f"{merge['table']} merged: {inserted} inserted, {updated} updated, {unchanged} unchanged"
+    )
+    return counts
@@ -0,0 +1,279 @@
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+from db import WorkerConnections, check_slots, slot_count
+from instrumentation import execute
+from merge import merge_dimension
+from aggregates import refresh_aggregates
+from physical_design import TABLE_PATTERN, apply_profile
+from query_client import bump_load_generation
+import incremental
+from sql_queries import (
+    staging_events_table_create,
+    nextsong_events_table_create,
+    staging_events_copy_template,
+    staging_events_clear,
+    nextsong_events_clear,
+    nextsong_events_insert,
+    event_table_merges,
+    songplay_table_merge_delete,
+    songplay_table_insert,
+    unmatched_events_insert,
+    match_rate_insert,
+    temp_table_template,
+    checkpoint_insert,
+    checkpoint_update,
+    last_checkpoint_run_select,
+    incomplete_partitions_select,
+)
+
+logger = logging.getLogger(__name__)
+
+# tables every worker session holds as temporary tables
+SESSION_TABLES = [staging_events_table_create, nextsong_events_table_create]
+
+
+def month_partitions(partitions):
+    """
+    Group the daily log_data partitions by month, the unit of work of the partitioned load
+
+    Parameters
+    ----------
+    partitions : list of (date, url) tuples
+        see incremental.list_log_partitions
+
+    Returns
+    -------
+    months : OrderedDict
+        month (e.g. 2018-11) -> (S3 prefix of the month, last date of the month), sorted by month
+
+    """
+    months = OrderedDict()
+    for date, url in sorted(partitions):
+        # log_data/2018/11/2018-11-04-events.json -> log_data/2018/11/
+        months[date[:7]] = (url.rsplit("/", 1)[0] + "/", date)
+    return months
+
+
+def resume_run(cur):
+    """
+    Return the last partitioned run and its partitions not completed
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+
+    Returns
+    -------
+    (run_id, partitions) : tuple
+        None and an empty list if no run has been recorded
+
+    """
+    execute(cur, last_checkpoint_run_select, "partitioned")
+    row = cur.fetchone()
+    if row is None:
+        return None, []
+    execute(cur, incomplete_partitions_select, "partitioned", (row[0],))
+    return row[0], [partition for partition, in cur.fetchall()]
+
+
+def set_checkpoint(cur, run_id, partition, status):
+    execute(cur, checkpoint_update, "partitioned", (status, run_id, partition))
+
+
+def create_session_tables(cur, profile):
+    """
+    Create the temporary staging_events and nextsong_events of the session, which take
+    precedence over the permanent ones in all the following queries of the session
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    profile : dict
+        physical design profile
+
+    """
+    for create_query in SESSION_TABLES:
+        query = apply_profile(create_query, profile)
+        table = TABLE_PATTERN.search(query).group(1)
+        execute(
+            cur,
+            TABLE_PATTERN.sub(temp_table_template.format(table=table), query, count=1),
+            "partitioned",
+        )
+
+
+class PartitionLoader:
+    """
+    Load the months of a run on a bounded pool of connections. Each worker session copies and
+    transforms its month into its own temporary tables in parallel with the others, then merges
+    it into the final tables in date order, one month at a time, waiting for the previous months
+    to be merged (or to fail), and commits the merge together with the checkpoint of the month
+    """
+
+    def __init__(self, config, run_id, profile, partitions=()):
+        self.run_id = run_id
+        self.profile = profile
+        self.connections = WorkerConnections(config)
+        self._sessions = threading.local()
+        self._order = sorted(partitions)
+        self._done = set()
+        self._turn = threading.Condition()
+
+    def _previous_done(self, partition):
+        """Whether the months before partition in the run are merged or failed"""
+        if partition not in self._order:
+            return True
+        return all(month in self._done for month in self._order[: self._order.index(partition)])
+
+    def _finish(self, partition):
+        """Let the next month merge"""
+        with self._turn:
+            self._done.add(partition)
+            self._turn.notify_all()
+
+    def load(self, partition, prefix):
+        """
+        Load a month, marking its checkpoint completed, or failed if any query fails.
+        The months must be submitted in date order, so that the months waited for are running
+
+        Parameters
+        ----------
+        partition : str
+            month, e.g. 2018-11
+        prefix : str
+            S3 prefix of the month
+
+        Returns
+        -------
+        success : bool
+
+        """
+        try:
+            return self._load(partition, prefix)
+        finally:
+            self._finish(partition)
+
+    def _load(self, partition, prefix):
+        conn = self.connections.get()
+        try:
+            with conn.cursor() as cur:
+                if not getattr(self._sessions, "ready", False):
+                    create_session_tables(cur, self.profile)
+                    conn.commit()
+                    self._sessions.ready = True
+
+                execute(cur, staging_events_clear, "partitioned")
+                execute(
+                    cur,
+                    staging_events_copy_template.format(source=prefix, options=""),
+                    "partitioned",
+                )
+                execute(cur, nextsong_events_clear, "partitioned")
+                execute(cur, nextsong_events_insert, "partitioned")
+
+                with self._turn:
+                    self._turn.wait_for(lambda: self._previous_done(partition))
+                    for merge in event_table_merges:
+                        merge_dimension(cur, merge, "partitioned")
+                    execute(cur, songplay_table_merge_delete, "partitioned")
+                    execute(cur, songplay_table_insert, "partitioned")
+                    refresh_aggregates(cur)
+                    execute(cur, unmatched_events_insert, "partitioned")
+                    execute(cur, match_rate_insert, "partitioned")
+                    set_checkpoint(cur, self.run_id, partition, "completed")
+                    bump_load_generation(cur)
+                    conn.commit()
+            logger.info(f"Partition {partition} loaded")
+            return True
+
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception(f"Issue while loading partition {partition}")
+            try:
+                with conn.cursor() as cur:
+                    set_checkpoint(cur, self.run_id, partition, "failed")
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                logger.exception(f"Issue while recording the failure of partition {partition}")
+            return False
+
+    def close(self):
+        self.connections.close()
+
+
+def load_partitioned(config, cur, conn, client, log_data, profile, resume=False):
+    """
+    Load log_data one month per task on PARTITION_WORKERS connections, checkpointing every month
+    in etl_checkpoints. With resume, only the months of the last run not completed are loaded
+    again, e.g. after a failure or an interrupted run. Loading twice the same month is idempotent.
+    The watermark is moved to the last date loaded once all the months of the run are completed
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    client : boto3.session.Session.client
+        S3 client
+    log_data : str
+        S3 url of the log_data prefix
+    profile : dict
+        physical design profile of the temporary tables
+    resume : bool
+
+    Returns
+    -------
+    (loaded, failed) : tuple
+        months loaded and months that failed
+
+    """
+    incremental.load_songs(
+        cur, conn, client, config["S3"]["SONG_DATA"], config["S3"].get("NEW_SONG_MANIFEST") or None
+    )
+    months = month_partitions(incremental.list_log_partitions(client, log_data))
+
+    run_id, partitions = resume_run(cur) if resume else (None, [])
+    if run_id is None:
+        if resume:
+            logger.warning("No partitioned run to resume, starting a new one")
+        run_id = str(uuid.uuid4())
+        partitions = list(months)
+        for partition in partitions:
+            execute(cur, checkpoint_insert, "partitioned", (run_id, partition))
+        conn.commit()
+    else:
+        missing = [partition for partition in partitions if partition not in months]
+        if missing:
+            logger.warning(f"Partitions no longer in log_data: {', '.join(missing)}")
+        partitions = [partition for partition in partitions if partition in months]
+    # the months are merged in date order, see PartitionLoader
+    partitions = sorted(partitions)
+    logger.info(f"Run {run_id}: {len(partitions)} partitions to load")
+
+    workers = config.getint("ETL", "PARTITION_WORKERS", fallback=4)
+    check_slots(config, "partition", workers, [slot_count(config, "partition") for _ in partitions])
+    loader = PartitionLoader(config, run_id, profile, partitions)
+    loaded, failed = [], []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(loader.load, partition, months[partition][0]): partition
+                for partition in partitions
+            }
+            for future in as_completed(futures):
+                (loaded if future.result() else failed).append(futures[future])
+    finally:
+        loader.close()
+
+    if not failed and months:
+        last_date = max(date for _, date in months.values())
+        watermark = incremental.get_watermark(cur)
+        if watermark is None or last_date > watermark:
+            incremental.set_watermark(cur, last_date)
+        conn.commit()
+    return sorted(loaded), sorted(failed)
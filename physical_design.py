@@ -0,0 +1,276 @@
+import json
+import logging
+import re
+from db import get_backend
+
+logger = logging.getLogger(__name__)
+
+# Physical design of the tables on Redshift: distribution style, distribution key, compound
+# sort key and column encodings. The small dimensions are copied on every node (DISTSTYLE ALL),
+# songs and songplays are distributed on song_id so that their join is co-located, and the
+# NextSong events and keyed songs are distributed on the match key of the event/song join.
+# The staging tables are loaded by COPY before any key is computed, hence distributed evenly.
+# Sort key columns are left uncompressed (RAW) as recommended by AWS
+DEFAULT_PROFILE = {
+    "staging_events": {
+        "diststyle": "EVEN",
+        "encode": {
+            "artist": "ZSTD",
+            "auth": "ZSTD",
+            "first_name": "ZSTD",
+            "gender": "ZSTD",
+            "item_in_session": "AZ64",
+            "last_name": "ZSTD",
+            "length": "AZ64",
+            "level": "ZSTD",
+            "location": "ZSTD",
+            "method": "ZSTD",
+            "page": "ZSTD",
+            "registration": "AZ64",
+            "session_id": "AZ64",
+            "song": "ZSTD",
+            "status": "AZ64",
+            "ts": "AZ64",
+            "user_agent": "ZSTD",
+            "user_id": "ZSTD",
+        },
+    },
+    "nextsong_events": {
+        "diststyle": "KEY",
+        "distkey": "match_key",
+        "sortkey": ["match_key"],
+        "encode": {
+            "ts": "AZ64",
+            "user_id": "ZSTD",
+            "first_name": "ZSTD",
+            "last_name": "ZSTD",
+            "gender": "ZSTD",
+            "level": "ZSTD",
+            "session_id": "AZ64",
+            "location": "ZSTD",
+            "user_agent": "ZSTD",
+            "artist": "ZSTD",
+            "song": "ZSTD",
+            "length": "AZ64",
+            "match_key": "RAW",
+        },
+    },
+    "staging_songs": {
+        "diststyle": "EVEN",
+        "encode": {
+            "num_songs": "AZ64",
+            "artist_id": "ZSTD",
+            "artist_latitude": "AZ64",
+            "artist_longitude": "AZ64",
+            "artist_location": "ZSTD",
+            "artist_name": "ZSTD",
+            "song_id": "ZSTD",
+            "title": "ZSTD",
+            "duration": "AZ64",
+            "year": "AZ64",
+        },
+    },
+    "keyed_songs": {
+        "diststyle": "KEY",
+        "distkey": "match_key",
+        "sortkey": ["match_key"],
+        "encode": {
+            "num_songs": "AZ64",
+            "artist_id": "ZSTD",
+            "artist_latitude": "AZ64",
+            "artist_longitude": "AZ64",
+            "artist_location": "ZSTD",
+            "artist_name": "ZSTD",
+            "song_id": "ZSTD",
+            "title": "ZSTD",
+            "duration": "AZ64",
+            "year": "AZ64",
+            "match_key": "RAW",
+        },
+    },
+    "users": {
+        "diststyle": "ALL",
+        "sortkey": ["user_id"],
+        "encode": {
+            "user_id": "RAW",
+            "first_name": "ZSTD",
+            "last_name": "ZSTD",
+            "gender": "ZSTD",
+            "level": "ZSTD",
+            "last_seen": "AZ64",
+        },
+    },
+    "songs": {
+        "diststyle": "KEY",
+        "distkey": "song_id",
+        "sortkey": ["song_id"],
+        "encode": {
+            "song_id": "RAW",
+            "title": "ZSTD",
+            "artist_id": "ZSTD",
+            "year": "AZ64",
+            "duration": "AZ64",
+        },
+    },
+    "artists": {
+        "diststyle": "ALL",
+        "sortkey": ["artist_id"],
+        "encode": {
+            "artist_id": "RAW",
+            "name": "ZSTD",
+            "location": "ZSTD",
+            "latitude": "AZ64",
+            "longitude": "AZ64",
+        },
+    },
+    "time": {
+        "diststyle": "ALL",
+        "sortkey": ["start_time"],
+        "encode": {
+            "start_time": "RAW",
+            "hour": "AZ64",
+            "day": "AZ64",
+            "week": "AZ64",
+            "month": "AZ64",
+            "year": "AZ64",
+            "weekday": "AZ64",
+        },
+    },
+    "songplays": {
+        "diststyle": "KEY",
+        "distkey": "song_id",
+        "sortkey": ["start_time"],
+        "encode": {
+            "songplay_id": "AZ64",
+            "start_time": "RAW",
+            "user_id": "ZSTD",
+            "level": "ZSTD",
+            "song_id": "ZSTD",
+            "artist_id": "ZSTD",
+            "session_id": "AZ64",
+            "location": "ZSTD",
+            "user_agent": "ZSTD",
+        },
+    },
+    "song_plays_daily": {
+        "diststyle": "KEY",
+        "distkey": "song_id",
+        "sortkey": ["day"],
+        "encode": {"day": "RAW", "song_id": "ZSTD", "plays": "AZ64"},
+    },
+    "active_users_hourly": {
+        "diststyle": "ALL",
+        "sortkey": ["hour"],
+        "encode": {"hour": "RAW", "level": "ZSTD", "active_users": "AZ64"},
+    },
+    "artist_plays_weekly": {
+        "diststyle": "ALL",
+        "sortkey": ["week"],
+        "encode": {"week": "RAW", "artist_id": "ZSTD", "plays": "AZ64"},
+    },
+}
+
+# e.g. "    first_name VARCHAR(30)," or "    songplay_id INT IDENTITY(0, 1) PRIMARY KEY, "
+COLUMN_PATTERN = re.compile(
+    r"^(?P<indent>\s*)(?P<column>\w+)\s+"
+    r"(?P<type>\w+(?:\s*\(\s*\d+(?:\s*,\s*\d+)?\s*\))?(?:\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\))?)"
+    r"(?P<rest>.*)$",
+    re.IGNORECASE,
+)
+
+TABLE_PATTERN = re.compile(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+
+CONSTRAINT_KEYWORDS = {"PRIMARY", "FOREIGN", "UNIQUE", "CONSTRAINT", "CHECK"}
+
+
+def load_profile(config):
+    """
+    Read the physical design profile named in the DESIGN section of the configuration:
+    default for DEFAULT_PROFILE, none for no physical design, otherwise the path of a JSON file
+    with the same structure as DEFAULT_PROFILE. The postgres backend has no physical design
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    profile : dict
+        table name -> physical design, empty for no physical design
+
+    """
+    if get_backend(config) == "postgres":
+        return {}
+
+    name = config.get("DESIGN", "PROFILE", fallback="default").strip()
+    if name.lower() == "default":
+        return DEFAULT_PROFILE
+    if name.lower() == "none":
+        return {}
+
+    with open(name) as profile_file:
+        logger.info(f"Using physical design profile {name}")
+        return json.load(profile_file)
+
+
+def table_name(create_query):
+    """
+    Return the name of the table created by a CREATE TABLE query
+
+    Parameters
+    ----------
+    create_query : str
+
+    Returns
+    -------
+    table : str
+
+    """
+    return TABLE_PATTERN.search(create_query).group(1)
+
+
+def apply_profile(create_query, profile):
+    """
+    Add the column encodings and the table attributes (DISTSTYLE, DISTKEY, SORTKEY) of the
+    profile to a CREATE TABLE query. Tables missing from the profile are left unchanged
+
+    Parameters
+    ----------
+    create_query : str
+    profile : dict
+
+    Returns
+    -------
+    create_query : str
+
+    """
+    design = profile.get(table_name(create_query))
+    if not design:
+        return create_query
+
+    encode = design.get("encode", {})
+    lines = create_query.split("\n")
+    # the first line holds CREATE TABLE ... ( and the last one the closing parenthesis
+    for i in range(1, len(lines) - 1):
+        match = COLUMN_PATTERN.match(lines[i])
+        if not match or match.group("column").upper() in CONSTRAINT_KEYWORDS:
+            continue
+        encoding = encode.get(match.group("column").lower())
+        if encoding:
+            lines[i] = (
+                f"{match.group('indent')}{match.group('column')} {match.group('type')} "
+                f"ENCODE {encoding}{match.group('rest')}"
+            )
+
+    attributes = []
+    if design.get("diststyle"):
+        attributes.append(f"DISTSTYLE {design['diststyle']}")
+    if design.get("distkey"):
+        attributes.append(f"DISTKEY({design['distkey']})")
+    if design.get("sortkey"):
+        attributes.append(f"COMPOUND SORTKEY({', '.join(design['sortkey'])})")
+
+    query = "\n".join(lines).rstrip()
+    if query.endswith(";"):
+        query = query[:-1].rstrip()
+    return f"{query}\n{' '.join(attributes)};" if attributes else f"{query};"
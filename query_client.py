@@ -0,0 +1,345 @@
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import psycopg2.extensions
+import psycopg2.pool
+from db import connection_params, get_backend, set_query_group
+from instrumentation import execute
+from sql_queries import load_generation_select, load_generation_bump
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# string literals are kept as they are, whitespace elsewhere is collapsed
+SQL_TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\s+")
+
+QueryResult = collections.namedtuple("QueryResult", ["columns", "rows"])
+
+
+def normalize_sql(query):
+    """
+    Normalize a query for the cache key: whitespace outside of string literals collapsed
+    and trailing semicolon removed, so that differently formatted copies of a query share the entry
+
+    Parameters
+    ----------
+    query : str
+
+    Returns
+    -------
+    query : str
+
+    """
+    query = SQL_TOKEN_PATTERN.sub(
+        lambda match: match.group(0) if match.group(0).startswith("'") else " ", query
+    )
+    return query.strip().rstrip(";").rstrip()
+
+
+def bump_load_generation(cur, conn=None):
+    """
+    Increment the load generation, expiring all the results cached by the clients.
+    Without conn the increment is committed by the caller, in the transaction of the data it loads
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection, optional
+
+    """
+    execute(cur, load_generation_bump, "generation")
+    if conn is not None:
+        conn.commit()
+
+
+def result_bytes(rows):
+    """Rough size in memory of a result set"""
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in rows
+    )
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection of the pool of QueryClient, remembering the query group set on it"""
+
+    query_group = None
+
+
+class ResultCache:
+    """
+    LRU cache of result sets bounded in entries and bytes. Results with more than spill_rows rows
+    are written to Parquet files in spill_dir (when pyarrow is installed) and read back on hit
+    """
+
+    def __init__(
+        self, max_entries=256, max_bytes=256 * 1024 * 1024, spill_dir=None, spill_rows=100000
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if spill_dir and pyarrow is not None else None
+        self.spill_rows = spill_rows
+        if spill_dir and pyarrow is None:
+            logger.warning("Spilling results requires the pyarrow package, large results are not cached")
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "spills": 0}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached result of a key, None on miss
+
+        Parameters
+        ----------
+        key : tuple
+
+        Returns
+        -------
+        result : QueryResult
+
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+        columns, rows, path, _ = entry
+        if path is not None:
+            try:
+                table = pyarrow.parquet.read_table(path)
+            except FileNotFoundError:
+                # evicted meanwhile by another thread
+                return None
+            rows = list(zip(*(table.column(i).to_pylist() for i in range(table.num_columns))))
+        return QueryResult(columns, rows)
+
+    def put(self, key, result):
+        """
+        Cache a result, spilling it to disk if large and evicting the least recently used entries
+
+        Parameters
+        ----------
+        key : tuple
+        result : QueryResult
+
+        """
+        path = None
+        rows = result.rows
+        if len(rows) > self.spill_rows:
+            if self.spill_dir is None:
+                return
+            path = self._spill(result)
+            rows = None
+        size = 0 if path else result_bytes(result.rows)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (result.columns, rows, path, size)
+            self.bytes += size
+            if path:
+                self.stats["spills"] += 1
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def expire(self, generation):
+        """
+        Remove the entries of the load generations older than the given one
+
+        Parameters
+        ----------
+        generation : int
+
+        """
+        with self._lock:
+            for key in [key for key in self.entries if key[2] < generation]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def _spill(self, result):
+        path = os.path.join(self.spill_dir, f"{uuid.uuid4()}.parquet")
+        columns = list(zip(*result.rows))
+        table = pyarrow.table(
+            {name: list(values) for name, values in zip(result.columns, columns)}
+        )
+        pyarrow.parquet.write_table(table, path)
+        return path
+
+    def _remove(self, key):
+        # called holding the lock
+        _, _, path, size = self.entries.pop(key)
+        self.bytes -= size
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+class QueryClient:
+    """
+    Run analytics queries on sparkifydb through a pool of connections opened with the settings
+    of dwh.cfg, caching the results by normalized query, parameters and load generation.
+    The load generation is bumped by etl.py with every commit of data and read again at most every
+    generation_ttl seconds, so the cached results expire at most generation_ttl seconds after the data changes.
+    On Redshift the queries are routed to ANALYST_QUERY_GROUP of the WLM section, away from the ETL queue
+    """
+
+    def __init__(self, config, min_connections=1, max_connections=4, cache=None, generation_ttl=5):
+        dsn, options = connection_params(config)
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            min_connections, max_connections, dsn, connection_factory=PooledConnection, **options
+        )
+        self.cache = cache or ResultCache()
+        self.generation_ttl = generation_ttl
+        self._generation = None
+        self._generation_read_at = 0.0
+        self._lock = threading.Lock()
+        self.query_group = ""
+        if get_backend(config) == "redshift":
+            self.query_group = config.get("WLM", "ANALYST_QUERY_GROUP", fallback="")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a client with the settings of the QUERY_CLIENT section
+
+        Parameters
+        ----------
+        config : configparser.ConfigParser
+
+        Returns
+        -------
+        client : QueryClient
+
+        """
+        section = "QUERY_CLIENT"
+        cache = ResultCache(
+            max_entries=config.getint(section, "CACHE_ENTRIES", fallback=256),
+            max_bytes=config.getint(section, "CACHE_MB", fallback=256) * 1024 * 1024,
+            spill_dir=config.get(section, "SPILL_DIR", fallback="") or None,
+            spill_rows=config.getint(section, "SPILL_ROWS", fallback=100000),
+        )
+        return cls(
+            config,
+            min_connections=config.getint(section, "POOL_MIN", fallback=1),
+            max_connections=config.getint(section, "POOL_MAX", fallback=4),
+            cache=cache,
+            generation_ttl=config.getfloat(section, "GENERATION_TTL", fallback=5),
+        )
+
+    def query(self, query, params=None):
+        """
+        Run a query, or return its cached result if the data did not change since it was cached
+
+        Parameters
+        ----------
+        query : str
+        params : tuple or dict, optional
+
+        Returns
+        -------
+        result : QueryResult
+            column names and rows
+
+        """
+        generation = self.generation()
+        key = (normalize_sql(query), repr(params), generation)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        conn = self._getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                result = QueryResult([column[0] for column in cur.description], cur.fetchall())
+            conn.rollback()
+        finally:
+            self.pool.putconn(conn)
+        self.cache.put(key, result)
+        return result
+
+    def generation(self):
+        """
+        Return the current load generation, expiring the cache entries of the previous ones
+
+        Returns
+        -------
+        generation : int
+
+        """
+        with self._lock:
+            age = time.monotonic() - self._generation_read_at
+            if self._generation is not None and age < self.generation_ttl:
+                return self._generation
+
+            conn = self._getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(load_generation_select)
+                    generation = cur.fetchone()[0]
+                conn.rollback()
+            finally:
+                self.pool.putconn(conn)
+
+            if generation != self._generation:
+                self.cache.expire(generation)
+            self._generation = generation
+            self._generation_read_at = time.monotonic()
+            return generation
+
+    def _getconn(self):
+        # the query group is set once on every connection of the pool, which remembers it
+        conn = self.pool.getconn()
+        if self.query_group and conn.query_group != self.query_group:
+            try:
+                set_query_group(conn, self.query_group)
+            except psycopg2.Error:
+                self.pool.putconn(conn, close=True)
+                raise
+            conn.query_group = self.query_group
+        return conn
+
+    def stats(self):
+        """
+        Return the statistics of the cache
+
+        Returns
+        -------
+        stats : dict
+            hits, misses, evictions, spills, hit_rate, entries and bytes
+
+        """
+        return {
+            **self.cache.stats,
+            "hit_rate": self.cache.hit_rate(),
+            "entries": len(self.cache.entries),
+            "bytes": self.cache.bytes,
+        }
+
+    def close(self):
+        self.cache.clear()
+        self.pool.closeall()
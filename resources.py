@@ -0,0 +1,92 @@
+import configparser
+import datetime
+import os
+
+# written by manage_cluster.py: the AWS resources created, the snapshots taken and the data loaded by etl.py
+RESOURCES_FILE = "resources.cfg"
+
+
+def read_resources(path=RESOURCES_FILE):
+    """
+    Read the resources file, an empty config if it does not exist
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    resources_config : configparser.ConfigParser
+
+    """
+    resources_config = configparser.ConfigParser()
+    # preserve case, i.e. avoid default conversion to lowercase
+    resources_config.optionxform = str
+    resources_config.read(path)
+    return resources_config
+
+
+def write_resources(resources_config, path=RESOURCES_FILE):
+    with open(path, "w") as res_file:
+        resources_config.write(res_file)
+
+
+def set_resources(section, path=RESOURCES_FILE, **values):
+    """
+    Update the options of a section of the resources file, creating it if needed.
+    Options set to None are removed
+
+    Parameters
+    ----------
+    section : str
+    path : str
+    values : str or None
+
+    """
+    resources_config = read_resources(path)
+    if not resources_config.has_section(section):
+        resources_config[section] = {}
+    for option, value in values.items():
+        if value is None:
+            resources_config.remove_option(section, option)
+        else:
+            resources_config[section][option] = value
+    write_resources(resources_config, path)
+
+
+def record_load(path=RESOURCES_FILE):
+    """
+    Record that etl.py loaded the cluster tracked in the resources file, if any.
+    The data loaded is then part of the snapshots taken afterwards
+
+    Parameters
+    ----------
+    path : str
+
+    """
+    if not os.path.exists(path) or not read_resources(path).has_section("RESOURCES"):
+        return
+    set_resources("LOAD", path, LoadedAt=datetime.datetime.now().isoformat(timespec="seconds"))
+    set_resources("RESOURCES", path, RestoredFrom=None)
+
+
+def restored_snapshot(path=RESOURCES_FILE):
+    """
+    Return the snapshot the cluster has been restored from if it holds data loaded by etl.py
+    and nothing has been loaded since
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    snapshot_id : str
+        None if the cluster was not restored or the snapshot holds no load
+
+    """
+    resources_config = read_resources(path)
+    snapshot_id = resources_config.get("RESOURCES", "RestoredFrom", fallback=None)
+    if snapshot_id and resources_config.get("LOAD", "LoadedAt", fallback=None):
+        return snapshot_id
+    return None
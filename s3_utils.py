@@ -0,0 +1,61 @@
+import re
+
+
+def split_s3_url(url):
+    """
+    Split an S3 url, e.g. s3://udacity-dend/log_data, into bucket and key prefix
+
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    (bucket, prefix) : tuple
+
+    """
+    match = re.match(r"s3://([^/]+)/?(.*)", url)
+    if match is None:
+        raise ValueError(f"Not an S3 url: {url}")
+    return match.group(1), match.group(2)
+
+
+def list_objects(client, url):
+    """
+    List all the objects under an S3 url, following the pagination
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    url : str
+
+    Yields
+    ------
+    (key, size) : tuple
+        key of the object and its size in bytes
+
+    """
+    for key, size, _ in list_objects_modified(client, url):
+        yield key, size
+
+
+def list_objects_modified(client, url):
+    """
+    List all the objects under an S3 url with the time they were last modified, following the pagination
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    url : str
+
+    Yields
+    ------
+    (key, size, last_modified) : tuple
+        key of the object, its size in bytes and its last modification (datetime in UTC)
+
+    """
+    bucket, prefix = split_s3_url(url)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"], obj["Size"], obj["LastModified"]
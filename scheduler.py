@@ -0,0 +1,170 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+def build_dependencies(nodes):
+    """
+    Compute the dependencies of each node of the graph from the tables it reads and writes.
+    A node depends on every node declared before it that writes a table it reads or writes,
+    and on every node declared after it that writes a table it reads (but does not write)
+
+    Parameters
+    ----------
+    nodes : list of dict
+        each node has a name, the tables it reads and the tables it writes
+
+    Returns
+    -------
+    dependencies : dict
+        node name -> set of node names that must complete before it
+
+    """
+    dependencies = {node["name"]: set() for node in nodes}
+    for i, node in enumerate(nodes):
+        reads = set(node["reads"]) - set(node["writes"])
+        writes = set(node["writes"])
+        for j, other in enumerate(nodes):
+            if i == j:
+                continue
+            other_writes = set(other["writes"])
+            if other_writes & reads or (j < i and other_writes & writes):
+                dependencies[node["name"]].add(other["name"])
+
+    _check_acyclic(dependencies)
+    return dependencies
+
+
+def _check_acyclic(dependencies):
+    """
+    Raise a ValueError if the dependencies contain a cycle
+
+    Parameters
+    ----------
+    dependencies : dict
+
+    """
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle in the graph: {' -> '.join(path + [name])}")
+        visiting.add(name)
+        for parent in sorted(dependencies[name]):
+            visit(parent, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in dependencies:
+        visit(name, [])
+
+
+def run_dag(nodes, run, workers=4):
+    """
+    Run the nodes of the graph concurrently, starting each node as soon as all its
+    dependencies have succeeded. Nodes depending on a failed node are skipped
+
+    Parameters
+    ----------
+    nodes : list of dict
+    run : callable
+        called with a node, raising an exception if the node fails
+    workers : int
+
+    Returns
+    -------
+    timings : dict
+        node name -> dict with status (succeeded, failed or skipped), start, end,
+        duration (seconds) and error
+
+    """
+    dependencies = build_dependencies(nodes)
+    by_name = {node["name"]: node for node in nodes}
+    pending = [node["name"] for node in nodes]
+    timings = {}
+    running = {}
+    origin = time.monotonic()
+
+    def execute(name):
+        start = time.monotonic()
+        error = None
+        try:
+            run(by_name[name])
+        except Exception as e:
+            error = e
+        return start - origin, time.monotonic() - origin, error
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                statuses = [timings.get(parent, {}).get("status") for parent in dependencies[name]]
+                if any(status in ("failed", "skipped") for status in statuses):
+                    pending.remove(name)
+                    timings[name] = _timing("skipped")
+                    logger.warning(f"Skipping {name}: a dependency did not succeed")
+                elif all(status == "succeeded" for status in statuses):
+                    pending.remove(name)
+                    logger.info(f"Starting {name}")
+                    running[executor.submit(execute, name)] = name
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                start, end, error = future.result()
+                if error is None:
+                    timings[name] = _timing("succeeded", start, end)
+                    logger.info(f"{name} succeeded in {end - start:.2f}s")
+                else:
+                    timings[name] = _timing("failed", start, end, str(error).strip())
+                    logger.error(f"{name} failed after {end - start:.2f}s: {error}")
+
+    return timings
+
+
+def _timing(status, start=None, end=None, error=None):
+    duration = end - start if start is not None else None
+    return {
+        "status": status,
+        "start": start,
+        "end": end,
+        "duration": duration,
+        "error": error,
+    }
+
+
+def critical_path(nodes, timings):
+    """
+    Find the chain of dependent nodes with the largest total duration, i.e. the
+    lower bound of the wall-clock time of the graph whatever the number of workers
+
+    Parameters
+    ----------
+    nodes : list of dict
+    timings : dict
+        as returned by run_dag
+
+    Returns
+    -------
+    (path, duration) : tuple
+        list of node names in execution order and their total duration in seconds
+
+    """
+    dependencies = build_dependencies(nodes)
+    best = {}
+
+    def longest(name):
+        if name not in best:
+            duration = timings.get(name, {}).get("duration") or 0.0
+            parents = [longest(parent) for parent in dependencies[name]]
+            path, total = max(parents, key=lambda p: p[1], default=([], 0.0))
+            best[name] = (path + [name], total + duration)
+        return best[name]
+
+    return max((longest(node["name"]) for node in nodes), key=lambda p: p[1], default=([], 0.0))
@@ -0,0 +1,256 @@
+import logging
+import re
+import psycopg2
+from instrumentation import execute
+from physical_design import apply_profile
+from query_client import bump_load_generation
+from sql_queries import (
+    user_table_create,
+    song_table_create,
+    artist_table_create,
+    time_table_create,
+    songplay_table_create,
+    user_table_insert,
+    song_table_insert,
+    artist_table_insert,
+    time_table_insert,
+    staging_events_clear,
+    staging_songs_clear,
+    shadow_tables_select,
+    table_drop_template,
+    table_rename_template,
+    table_count_template,
+    songplay_shadow_nulls,
+    insert_table_graph,
+)
+
+logger = logging.getLogger(__name__)
+
+# songplays first: it references the dimension tables, so it has to be dropped before them
+FINAL_TABLES = ["songplays", "users", "songs", "artists", "time"]
+
+FINAL_TABLE_CREATES = [
+    user_table_create,
+    song_table_create,
+    artist_table_create,
+    time_table_create,
+    songplay_table_create,
+]
+
+# the shadow tables start empty, hence the dimensions are filled with plain INSERTs instead of merges
+DIMENSION_INSERTS = {
+    "users": user_table_insert,
+    "songs": song_table_insert,
+    "artists": artist_table_insert,
+    "time": time_table_insert,
+}
+
+# e.g. matches "time" and "songs" but not "start_time" and "staging_songs"
+FINAL_TABLE_PATTERN = re.compile(r"\b({})\b".format("|".join(FINAL_TABLES)))
+
+
+def shadow_name(table):
+    return f"{table}_shadow"
+
+
+def previous_name(table):
+    return f"{table}_previous"
+
+
+def retarget(query):
+    """
+    Point a query to the shadow tables instead of the final tables
+
+    Parameters
+    ----------
+    query : str
+
+    Returns
+    -------
+    query : str
+
+    """
+    return FINAL_TABLE_PATTERN.sub(lambda match: shadow_name(match.group(1)), query)
+
+
+def shadow_graph(graph=insert_table_graph):
+    """
+    Build the insert graph filling the shadow tables from insert_table_graph.
+    Tables other than the final ones (e.g. nextsong_events and match_rates) are written as usual
+
+    Parameters
+    ----------
+    graph : list of dict
+        insert graph, see sql_queries.insert_table_graph
+
+    Returns
+    -------
+    graph : list of dict
+
+    """
+    nodes = []
+    for node in graph:
+        if "merge" in node:
+            work = {"query": retarget(DIMENSION_INSERTS[node["merge"]["table"]])}
+        elif "query" in node:
+            work = {"query": retarget(node["query"])}
+        else:
+            work = {"queries": [retarget(query) for query in node["queries"]]}
+        nodes.append(
+            {
+                "name": node["name"],
+                **work,
+                "reads": [retarget(table) for table in node["reads"]],
+                "writes": [retarget(table) for table in node["writes"]],
+            }
+        )
+    return nodes
+
+
+def existing_tables(cur, tables):
+    """
+    Return the tables among the given ones that exist in the current schema
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    tables : list of str
+
+    Returns
+    -------
+    tables : set of str
+
+    """
+    execute(cur, shadow_tables_select, "shadow", (tuple(tables),))
+    return {row[0] for row in cur.fetchall()}
+
+
+def prepare_shadow_tables(cur, conn, profile=None):
+    """
+    Create the empty shadow tables with the physical design of the final tables and empty the staging tables
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    profile : dict, optional
+        physical design profile (see physical_design.py)
+
+    """
+    for table in FINAL_TABLES:
+        execute(cur, table_drop_template.format(table=shadow_name(table)), "shadow")
+    for query in FINAL_TABLE_CREATES:
+        execute(cur, retarget(apply_profile(query, profile or {})), "shadow")
+    execute(cur, staging_events_clear, "shadow")
+    execute(cur, staging_songs_clear, "shadow")
+    conn.commit()
+
+
+def validate_shadow_tables(cur, min_row_ratio=0.9):
+    """
+    Check the shadow tables before swapping them in: none is empty, songplays has no fewer rows than
+    min_row_ratio times the rows of the current songplays and no NULL start_time or user_id
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    min_row_ratio : float
+
+    Returns
+    -------
+    problems : list of str
+        empty if the shadow tables can be swapped in
+
+    """
+    problems = []
+    counts = {}
+    for table in FINAL_TABLES:
+        execute(cur, table_count_template.format(table=shadow_name(table)), "shadow")
+        counts[table] = cur.fetchone()[0]
+        if counts[table] == 0:
+            problems.append(f"{shadow_name(table)} is empty")
+
+    if "songplays" in existing_tables(cur, ["songplays"]):
+        execute(cur, table_count_template.format(table="songplays"), "shadow")
+        current = cur.fetchone()[0]
+        if counts["songplays"] < min_row_ratio * current:
+            problems.append(
+                f"songplays_shadow has {counts['songplays']} rows, "
+                f"fewer than {min_row_ratio:.0%} of the {current} rows of songplays"
+            )
+
+    execute(cur, songplay_shadow_nulls, "shadow")
+    nulls = cur.fetchone()[0]
+    if nulls:
+        problems.append(f"songplays_shadow has {nulls} rows without start_time or user_id")
+
+    return problems
+
+
+def rotate(cur, conn, source, target):
+    """
+    Rename, in one transaction, every final table to target(table) and source(table) to the final table.
+    The tables already named target(table) are dropped and the load generation is bumped
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+    source : callable
+        table -> name of the tables taking the place of the final tables
+    target : callable
+        table -> name the final tables are renamed to
+
+    """
+    try:
+        current = existing_tables(cur, FINAL_TABLES)
+        for table in FINAL_TABLES:
+            execute(cur, table_drop_template.format(table=target(table)), "shadow")
+        for table in FINAL_TABLES:
+            if table in current:
+                execute(cur, table_rename_template.format(table=table, name=target(table)), "shadow")
+            execute(cur, table_rename_template.format(table=source(table), name=table), "shadow")
+        bump_load_generation(cur)
+        conn.commit()
+
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+
+def swap(cur, conn):
+    """
+    Replace the final tables with the shadow tables, keeping the replaced ones as <table>_previous
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    """
+    rotate(cur, conn, shadow_name, previous_name)
+    logger.info("Shadow tables swapped in")
+
+
+def rollback(cur, conn):
+    """
+    Restore the final tables replaced by the last swap, keeping the current ones as <table>_shadow
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    conn : psycopg2 Connection
+
+    Returns
+    -------
+    success : bool
+
+    """
+    previous = [previous_name(table) for table in FINAL_TABLES]
+    missing = set(previous) - existing_tables(cur, previous)
+    if missing:
+        logger.error(f"Nothing to roll back to, missing {', '.join(sorted(missing))}")
+        return False
+    rotate(cur, conn, previous_name, shadow_name)
+    logger.info("Previous tables restored")
+    return True
@@ -0,0 +1,366 @@
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import math
+import os
+import boto3
+from instrumentation import execute
+from s3_utils import list_objects, split_s3_url
+from shadow import FINAL_TABLES
+from sql_queries import table_sizes_select
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# storage per node of each node type, see
+# https://docs.aws.amazon.com/redshift/latest/mgmt/working-with-clusters.html#rs-node-type-info
+# (ra3 nodes use managed storage, their figure is the capacity of the local SSD cache)
+NODE_STORAGE_BYTES = {
+    "dc2.large": 160 * 10 ** 9,
+    "dc2.8xlarge": 2560 * 10 ** 9,
+    "ds2.xlarge": 2 * 10 ** 12,
+    "ds2.8xlarge": 16 * 10 ** 12,
+    "ra3.xlplus": 932 * 10 ** 9,
+    "ra3.4xlarge": 3200 * 10 ** 9,
+    "ra3.16xlarge": 12800 * 10 ** 9,
+}
+
+# svv_table_info reports the size of the tables in 1 MB blocks
+BLOCK_BYTES = 1024 * 1024
+
+
+def manifest_bytes(client, url):
+    """
+    Sum the content_length of the entries of a COPY manifest (see manifests.py)
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+        S3 client
+    url : str
+
+    Returns
+    -------
+    size : int
+        bytes, None if an entry has no content_length
+
+    """
+    bucket, key = split_s3_url(url)
+    manifest = json.loads(client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    sizes = [entry.get("meta", {}).get("content_length") for entry in manifest["entries"]]
+    return None if None in sizes else sum(sizes)
+
+
+def source_bytes(client, config, data, manifest):
+    """
+    Return the size of a source: from its manifest if set, which takes a single request,
+    otherwise by listing its prefix
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+        S3 client
+    config : configparser.ConfigParser
+    data : str
+        option of the S3 section with the raw prefix, e.g. LOG_DATA
+    manifest : str
+        option of the S3 section with the manifest, e.g. LOG_MANIFEST
+
+    Returns
+    -------
+    size : int
+        bytes
+
+    """
+    if config["S3"].get(manifest):
+        size = manifest_bytes(client, config["S3"][manifest])
+        if size is not None:
+            return size
+    return sum(size for _, size in list_objects(client, config["S3"][data]))
+
+
+def input_bytes(client, config):
+    """
+    Sum the size of the objects of log_data and song_data
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+        S3 client
+    config : configparser.ConfigParser
+
+    Returns
+    -------
+    size : int
+        bytes
+
+    """
+    return source_bytes(client, config, "LOG_DATA", "LOG_MANIFEST") + source_bytes(
+        client, config, "SONG_DATA", "SONG_MANIFEST"
+    )
+
+
+def table_bytes(cur, tables=FINAL_TABLES):
+    """
+    Sum the size of the final tables, as reported by svv_table_info. The staging tables and the
+    shadow and previous copies of a shadow load are left out
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    tables : list of str
+
+    Returns
+    -------
+    size : int
+        bytes
+
+    """
+    execute(cur, table_sizes_select, "sizing", (tuple(tables),))
+    return sum(blocks or 0 for _, blocks in cur.fetchall()) * BLOCK_BYTES
+
+
+def read_history(path):
+    """
+    Read the sizes recorded by the previous runs
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    history : list of dict
+        recorded_at, input_bytes and table_bytes of each run, oldest first
+
+    """
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)
+
+
+def record_sizes(path, input_size, table_size):
+    """
+    Append the sizes of a run to the history
+
+    Parameters
+    ----------
+    path : str
+    input_size : int
+    table_size : int
+
+    """
+    history = read_history(path)
+    history.append(
+        {
+            "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "input_bytes": input_size,
+            "table_bytes": table_size,
+        }
+    )
+    with open(path, "w") as history_file:
+        json.dump(history, history_file, indent=2)
+
+
+def recent_input_bytes(history, max_age_hours):
+    """
+    Return the input size recorded by the last run if it is recent enough to be reused
+
+    Parameters
+    ----------
+    history : list of dict
+    max_age_hours : float
+
+    Returns
+    -------
+    size : int
+        bytes, None if no run has been recorded in the last max_age_hours
+
+    """
+    if not history or not history[-1].get("input_bytes"):
+        return None
+    recorded_at = datetime.datetime.fromisoformat(history[-1]["recorded_at"])
+    if datetime.datetime.now() - recorded_at > datetime.timedelta(hours=max_age_hours):
+        return None
+    return history[-1]["input_bytes"]
+
+
+def expansion_ratio(history, default=2.5):
+    """
+    Return the ratio between the size of the tables and the size of the input of the last run,
+    or the default one when no run has been recorded
+
+    Parameters
+    ----------
+    history : list of dict
+    default : float
+
+    Returns
+    -------
+    ratio : float
+
+    """
+    for run in reversed(history):
+        if run.get("input_bytes") and run.get("table_bytes"):
+            return run["table_bytes"] / run["input_bytes"]
+    return default
+
+
+def estimate_nodes(
+    input_size,
+    node_type,
+    history=(),
+    expansion=2.5,
+    target_usage=0.5,
+    min_nodes=2,
+    max_nodes=32,
+):
+    """
+    Estimate the nodes needed to hold the tables loaded from an input of the given size, filling
+    the storage of each node only up to target_usage to leave room for sorts, merges and growth
+
+    Parameters
+    ----------
+    input_size : int
+        bytes of log_data and song_data
+    node_type : str
+    history : list of dict
+        sizes recorded by the previous runs, see read_history
+    expansion : float
+        ratio between tables and input, used when no run has been recorded
+    target_usage : float
+    min_nodes : int
+    max_nodes : int
+
+    Returns
+    -------
+    nodes : int
+
+    """
+    if node_type not in NODE_STORAGE_BYTES:
+        raise ValueError(f"Unknown node type {node_type}")
+    history = list(history)
+    tables = input_size * expansion_ratio(history, expansion)
+    if history and history[-1].get("table_bytes"):
+        # the tables never shrink below the last recorded size, e.g. with incremental loads
+        tables = max(tables, history[-1]["table_bytes"])
+    nodes = math.ceil(tables / (NODE_STORAGE_BYTES[node_type] * target_usage))
+    return min(max(nodes, min_nodes), max_nodes)
+
+
+def elastic_target(current, target):
+    """
+    Bound the target of an elastic resize to the range it supports in one step,
+    i.e. from half to double the current nodes
+
+    Parameters
+    ----------
+    current : int
+    target : int
+
+    Returns
+    -------
+    nodes : int
+
+    """
+    return min(max(target, math.ceil(current / 2)), current * 2)
+
+
+def estimate_from_config(config, input_size):
+    """
+    Estimate the nodes for an input of the given size with the settings of the [SIZING] section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    input_size : int
+
+    Returns
+    -------
+    nodes : int
+
+    """
+    return estimate_nodes(
+        input_size,
+        config["HW"]["NODE_TYPE"],
+        read_history(config.get("SIZING", "HISTORY", fallback="")),
+        expansion=config.getfloat("SIZING", "EXPANSION", fallback=2.5),
+        target_usage=config.getfloat("SIZING", "TARGET_USAGE", fallback=0.5),
+        min_nodes=config.getint("SIZING", "MIN_NODES", fallback=2),
+        max_nodes=config.getint("SIZING", "MAX_NODES", fallback=32),
+    )
+
+
+def cluster_nodes(config, client=None):
+    """
+    Return the nodes of the cluster to create: [SIZING] NODES, or an estimate from the input size
+    and the recorded sizes when it is auto
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    client : boto3.session.Session.client, optional
+        S3 client
+
+    Returns
+    -------
+    nodes : int
+
+    """
+    nodes = config.get("SIZING", "NODES", fallback="auto")
+    if nodes != "auto":
+        return int(nodes)
+
+    size = input_bytes(client or boto3.client("s3"), config)
+    nodes = estimate_from_config(config, size)
+    logger.info(f"Input of {size / 10 ** 9:.2f} GB, {nodes} {config['HW']['NODE_TYPE']} nodes")
+    return nodes
+
+
+def record_run(config, cur, client=None):
+    """
+    Record the input and table sizes of a run in [SIZING] HISTORY, if set.
+    The input size of the last run is reused for INPUT_MAX_AGE_HOURS instead of sizing S3 again
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    cur : psycopg2 Cursor
+    client : boto3.session.Session.client, optional
+        S3 client
+
+    """
+    path = config.get("SIZING", "HISTORY", fallback="")
+    if not path:
+        return
+    max_age = config.getfloat("SIZING", "INPUT_MAX_AGE_HOURS", fallback=24)
+    input_size = recent_input_bytes(read_history(path), max_age)
+    if input_size is None:
+        input_size = input_bytes(client or boto3.client("s3"), config)
+    record_sizes(path, input_size, table_bytes(cur))
+
+
+def main():
+    """
+    Print the nodes estimated for the input in S3, or for the given input size (e.g. a recorded one)
+
+    """
+    parser = argparse.ArgumentParser(description="Estimate the nodes of the Redshift cluster")
+    parser.add_argument("--input-bytes", type=int, help="input size instead of listing S3")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("dwh.cfg")
+
+    size = args.input_bytes
+    if size is None:
+        size = input_bytes(boto3.client("s3"), config)
+    print(estimate_from_config(config, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import configparser
+from aggregate_queries import aggregate_table_create_queries, aggregate_table_drop_queries
 
 # CONFIG
 config = configparser.ConfigParser()
@@ -8,11 +9,16 @@ config.read("dwh.cfg")
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs;"
+nextsong_events_table_drop = "DROP TABLE IF EXISTS nextsong_events;"
+keyed_songs_table_drop = "DROP TABLE IF EXISTS keyed_songs;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
 user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+watermark_table_drop = "DROP TABLE IF EXISTS etl_watermarks;"
+checkpoint_table_drop = "DROP TABLE IF EXISTS etl_checkpoints;"
+# NOTE: unmatched_events, match_rates, etl_run_metrics and etl_load_generations are never dropped, they keep the history of the runs
 
 # CREATE TABLES
 
@@ -50,6 +56,38 @@ staging_songs_table_create = """CREATE TABLE IF NOT EXISTS staging_songs (
     year             SMALLINT
 );"""
 
+# NextSong events only, deduplicated and typed once after the COPY: every final table is filled from here
+nextsong_events_table_create = """CREATE TABLE IF NOT EXISTS nextsong_events (
+    ts TIMESTAMP NOT NULL,
+    user_id VARCHAR NOT NULL,
+    first_name VARCHAR(30),
+    last_name VARCHAR(30),
+    gender VARCHAR(2),
+    level VARCHAR(10),
+    session_id INT,
+    location VARCHAR,
+    user_agent VARCHAR,
+    artist VARCHAR,
+    song VARCHAR,
+    length NUMERIC,
+    match_key CHAR(32)
+);"""
+
+# songs of staging_songs with their match key, computed once after the COPY: songplays and artists join the events on it
+keyed_songs_table_create = """CREATE TABLE IF NOT EXISTS keyed_songs (
+    num_songs        INTEGER,
+    artist_id        VARCHAR,
+    artist_latitude  NUMERIC,
+    artist_longitude NUMERIC,
+    artist_location  VARCHAR,
+    artist_name      VARCHAR,
+    song_id          VARCHAR,
+    title            VARCHAR,
+    duration         NUMERIC,
+    year             SMALLINT,
+    match_key        CHAR(32)
+);"""
+
 time_table_create = """CREATE TABLE IF NOT EXISTS time (
     start_time TIMESTAMP NOT NULL PRIMARY KEY,
     hour SMALLINT NOT NULL,
@@ -60,12 +98,14 @@ time_table_create = """CREATE TABLE IF NOT EXISTS time (
     weekday SMALLINT NOT NULL
 );"""
 
+# last_seen is the ts of the event the row was taken from, a merge only replaces a row with a newer one
 user_table_create = """CREATE TABLE IF NOT EXISTS users (
     user_id VARCHAR NOT NULL PRIMARY KEY,
     first_name VARCHAR(30),
     last_name VARCHAR(30),
     gender VARCHAR(2),
-    level VARCHAR(10)
+    level VARCHAR(10),
+    last_seen TIMESTAMP
 );"""
 
 song_table_create = """CREATE TABLE IF NOT EXISTS songs (
@@ -96,23 +136,192 @@ songplay_table_create = """CREATE TABLE IF NOT EXISTS songplays (
     user_agent VARCHAR
     );"""
 
+# load watermarks of the incremental mode, e.g. the last log_data partition loaded
+watermark_table_create = """CREATE TABLE IF NOT EXISTS etl_watermarks (
+    source VARCHAR NOT NULL PRIMARY KEY,
+    watermark VARCHAR NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+);"""
+
+# partitions of the partitioned loads (see partitioned.py) and their status: pending, completed or failed
+checkpoint_table_create = """CREATE TABLE IF NOT EXISTS etl_checkpoints (
+    run_id VARCHAR(36) NOT NULL,
+    log_partition VARCHAR(30) NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+);"""
+
+# diagnostics of the event/song match: NextSong events without a matching song and match rate of each run
+unmatched_events_table_create = """CREATE TABLE IF NOT EXISTS unmatched_events (
+    run_at TIMESTAMP NOT NULL,
+    ts TIMESTAMP,
+    user_id VARCHAR,
+    session_id INT,
+    artist VARCHAR,
+    song VARCHAR,
+    length NUMERIC,
+    match_key CHAR(32)
+);"""
+
+match_rate_table_create = """CREATE TABLE IF NOT EXISTS match_rates (
+    run_at TIMESTAMP NOT NULL,
+    events BIGINT NOT NULL,
+    matched BIGINT NOT NULL
+);"""
+
+# bumped with every commit of data, so that the results cached by query_client.py expire with the data
+load_generation_table_create = """CREATE TABLE IF NOT EXISTS etl_load_generations (
+    generation BIGINT NOT NULL,
+    loaded_at TIMESTAMP NOT NULL
+);"""
+
+# metrics of every query executed by create_tables.py and etl.py (see instrumentation.py)
+run_metrics_table_create = """CREATE TABLE IF NOT EXISTS etl_run_metrics (
+    run_id VARCHAR(36) NOT NULL,
+    script VARCHAR(30) NOT NULL,
+    stage VARCHAR(30) NOT NULL,
+    name VARCHAR(80) NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL,
+    row_count BIGINT,
+    query_id INT,
+    scanned_bytes BIGINT,
+    returned_bytes BIGINT,
+    status VARCHAR(10) NOT NULL,
+    error VARCHAR(1024)
+);"""
+
 
 # STAGING TABLES
 
-staging_events_copy = """COPY staging_events FROM '{}' 
+staging_events_columns = """artist, auth, first_name, gender, item_in_session, last_name, length, level, 
+location, method, page, registration, session_id, song, status, ts, user_agent, user_id"""
+
+# source and extra options are left as placeholders, e.g. to load a single log_data partition in incremental mode
+staging_events_copy_template = """COPY staging_events ({}) FROM '{{source}}' 
 JSON '{}' 
-CREDENTIALS 'aws_iam_role={}' COMPUPDATE OFF TIMEFORMAT AS 'epochmillisecs' region 'us-west-2';
+CREDENTIALS 'aws_iam_role={}' COMPUPDATE OFF TIMEFORMAT AS 'epochmillisecs' region 'us-west-2'{{options}};
 """.format(
-    config["S3"]["LOG_DATA"], config["S3"]["LOG_JSONPATH"], config["IAM_ROLE"]["ARN"]
+    staging_events_columns, config["S3"]["LOG_JSONPATH"], config["IAM_ROLE"]["ARN"]
 )
 
-staging_songs_copy = """COPY staging_songs FROM '{}'
+staging_songs_columns = """num_songs, artist_id, artist_latitude, artist_longitude, artist_location, 
+artist_name, song_id, title, duration, year"""
+
+staging_songs_copy_template = """COPY staging_songs ({}) FROM '{{source}}'
 JSON 'auto' CREDENTIALS 'aws_iam_role={}' COMPUPDATE OFF 
-region 'us-west-2';
+region 'us-west-2'{{options}};
 """.format(
-    config["S3"]["SONG_DATA"], config["IAM_ROLE"]["ARN"]
+    staging_songs_columns, config["IAM_ROLE"]["ARN"]
 )
 
+
+def copy_source(data, manifest, target):
+    """
+    Choose the source of a COPY query and its extra options: the manifest if set (see manifests.py),
+    otherwise the compacted chunks if set (see compaction.py), otherwise the raw prefix
+
+    Parameters
+    ----------
+    data : str
+        option of the S3 section with the raw prefix, e.g. LOG_DATA
+    manifest : str
+        option of the S3 section with the manifest, e.g. LOG_MANIFEST
+    target : str
+        option of the COMPACTION section with the compacted prefix, e.g. LOG_TARGET
+
+    Returns
+    -------
+    (source, options) : tuple
+
+    """
+    compacted = config.get("COMPACTION", target, fallback="")
+    options = ""
+    if compacted:
+        options += " " + config.get("COMPACTION", "CODEC", fallback="gzip").upper()
+
+    if config["S3"].get(manifest):
+        return config["S3"][manifest], options + " MANIFEST"
+    if compacted:
+        return compacted, options
+    return config["S3"][data], ""
+
+
+staging_events_source, staging_events_options = copy_source("LOG_DATA", "LOG_MANIFEST", "LOG_TARGET")
+staging_events_copy = staging_events_copy_template.format(
+    source=staging_events_source, options=staging_events_options
+)
+
+staging_songs_source, staging_songs_options = copy_source("SONG_DATA", "SONG_MANIFEST", "SONG_TARGET")
+staging_songs_copy = staging_songs_copy_template.format(
+    source=staging_songs_source, options=staging_songs_options
+)
+
+# rows COPY may reject before failing, e.g. the bad records quarantined by validate.py
+maxerror_option_template = " MAXERROR {maxerror}"
+
+# rows rejected by the COPY queries started after a given time
+load_errors_select = """SELECT TRIM(p.name), TRIM(e.filename), e.line_number, TRIM(e.colname), 
+TRIM(e.raw_field_value), e.err_code, TRIM(e.err_reason) 
+FROM stl_load_errors e 
+LEFT JOIN (SELECT DISTINCT id, name FROM stv_tbl_perm) p ON e.tbl = p.id 
+WHERE e.starttime >= %s 
+ORDER BY e.starttime, e.line_number;"""
+
+# MATCH KEY
+# events and songs are matched on a single hashed column instead of title, artist name and duration:
+# artist and title are trimmed and lower-cased, the duration is rounded to the second.
+# A NULL in any of them gives a NULL key, which matches nothing as the equality did
+
+
+def match_key_expression(artist, title, duration):
+    """
+    Build the SQL expression of the match key from the columns holding artist, title and duration
+
+    Parameters
+    ----------
+    artist : str
+    title : str
+    duration : str
+
+    Returns
+    -------
+    expression : str
+
+    """
+    return (
+        f"MD5(LOWER(TRIM({artist})) || '|' || LOWER(TRIM({title})) || '|' "
+        f"|| CAST(CAST(ROUND({duration}) AS BIGINT) AS VARCHAR))"
+    )
+
+
+nextsong_events_clear = "DELETE FROM nextsong_events;"
+
+nextsong_events_insert = """INSERT INTO nextsong_events (
+    ts, user_id, first_name, last_name, gender, level, session_id, location, user_agent, artist, song, length, match_key
+) 
+SELECT DISTINCT se.ts, se.user_id, se.first_name, se.last_name, se.gender, se.level, se.session_id, 
+se.location, se.user_agent, se.artist, se.song, se.length, {} 
+FROM staging_events se 
+WHERE se.page = 'NextSong' AND se.ts IS NOT NULL AND se.user_id IS NOT NULL AND se.user_id != '';""".format(
+    match_key_expression("se.artist", "se.song", "se.length")
+)
+
+keyed_songs_clear = "DELETE FROM keyed_songs;"
+
+# the key is computed while inserting rather than updating staging_songs after the COPY: the rows are
+# distributed on it as they are written, and no row is rewritten
+keyed_songs_insert_template = """INSERT INTO keyed_songs (
+    num_songs, artist_id, artist_latitude, artist_longitude, artist_location, artist_name, song_id, title, duration, year, match_key
+) 
+SELECT num_songs, artist_id, artist_latitude, artist_longitude, artist_location, artist_name, song_id, title, duration, year, {} 
+FROM {{table}};""".format(
+    match_key_expression("artist_name", "title", "duration")
+)
+
+keyed_songs_insert = keyed_songs_insert_template.format(table="staging_songs")
+
 # FINAL TABLES
 
 songplay_table_insert = """INSERT INTO songplays(
@@ -125,28 +334,71 @@ songplay_table_insert = """INSERT INTO songplays(
     location,
     user_agent
 ) 
-SELECT ts AS start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM staging_events se
+SELECT ts AS start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM nextsong_events ne
 JOIN 
-staging_songs ss ON se.song = ss.title AND se.artist = ss.artist_name AND se.length = ss.duration 
-WHERE se.page='NextSong';"""
+keyed_songs ks ON ne.match_key = ks.match_key;"""
+
+# the dimension tables are loaded from SELECTs returning one row per key, keeping the latest
+# row (by event ts) when the staging tables hold several versions, e.g. a user moving from free to paid
 
-user_table_insert = """INSERT INTO users(user_id, first_name, last_name, gender, level) 
-SELECT se.user_id, se.first_name, se.last_name, se.gender, se.level
-FROM staging_events se;
-"""
+user_table_select = """SELECT user_id, first_name, last_name, gender, level, last_seen FROM (
+    SELECT ne.user_id, ne.first_name, ne.last_name, ne.gender, ne.level, ne.ts AS last_seen,
+    ROW_NUMBER() OVER (PARTITION BY ne.user_id ORDER BY ne.ts DESC) AS row_rank
+    FROM nextsong_events ne
+) latest
+WHERE row_rank = 1"""
+
+user_table_insert = """INSERT INTO users(user_id, first_name, last_name, gender, level, last_seen) 
+{};
+""".format(
+    user_table_select
+)
 
 # NOTE: CHOOSING NULLs to avoid losing more than 4000 rows and in absence of more detailed information
+song_table_select = """SELECT song_id, title, artist_id, year, duration FROM (
+    SELECT song_id, title, artist_id, 
+    CASE WHEN ss.year != 0 
+    THEN ss.year ELSE NULL 
+    END AS year, 
+    duration,
+    ROW_NUMBER() OVER (PARTITION BY ss.song_id ORDER BY ss.year DESC, ss.title) AS row_rank
+    FROM staging_songs ss
+) latest
+WHERE row_rank = 1"""
+
 song_table_insert = """INSERT INTO songs (song_id, title, artist_id, year, duration) 
-SELECT song_id, title, artist_id, 
-CASE WHEN ss.year != 0 
-THEN ss.year ELSE NULL 
-END AS year, 
-duration FROM staging_songs ss;
-"""
+{};
+""".format(
+    song_table_select
+)
+
+artist_table_select = """SELECT artist_id, name, location, latitude, longitude FROM (
+    SELECT ks.artist_id, ne.artist AS name, ks.artist_location AS location, 
+    ks.artist_latitude AS latitude, ks.artist_longitude AS longitude,
+    ROW_NUMBER() OVER (PARTITION BY ks.artist_id ORDER BY ne.ts DESC) AS row_rank
+    FROM nextsong_events ne 
+    JOIN keyed_songs ks ON ne.match_key = ks.match_key
+) latest
+WHERE row_rank = 1"""
 
 artist_table_insert = """INSERT INTO artists(artist_id, name, location, latitude, longitude) 
-SELECT artist_id, artist, artist_location, artist_latitude, artist_longitude FROM staging_events se 
-JOIN staging_songs ss ON se.song = ss.title AND se.artist = ss.artist_name;"""
+{};""".format(
+    artist_table_select
+)
+
+time_table_select = """SELECT 
+    ts AS start_time,
+    EXTRACT(hour FROM ts) AS hour,
+    EXTRACT(day FROM ts) AS day,
+    EXTRACT(week FROM ts) AS week,
+    EXTRACT(month FROM ts) AS month,
+    EXTRACT(year FROM ts) AS year,
+    EXTRACT(dow FROM ts) AS weekday
+FROM (
+  SELECT 
+  DISTINCT ne.ts
+  from nextsong_events ne
+) timestamps"""
 
 time_table_insert = """INSERT INTO time(
     start_time,
@@ -157,46 +409,429 @@ time_table_insert = """INSERT INTO time(
     year,
     weekday
 )
-SELECT 
-    ts AS start_time,
-    EXTRACT(hour FROM start_time) AS hour,
-    EXTRACT(day FROM start_time) AS day,
-    EXTRACT(week FROM start_time) AS week,
-    EXTRACT(month FROM start_time) AS month,
-    EXTRACT(year FROM start_time) AS year,
-    EXTRACT(dow FROM start_time) AS weekday
-FROM (
-  SELECT 
-  DISTINCT se.ts
-  from staging_events se
-);
-"""
+{};
+""".format(
+    time_table_select
+)
+
+unmatched_events_insert = """INSERT INTO unmatched_events (run_at, ts, user_id, session_id, artist, song, length, match_key) 
+SELECT GETDATE(), ne.ts, ne.user_id, ne.session_id, ne.artist, ne.song, ne.length, ne.match_key 
+FROM nextsong_events ne 
+LEFT JOIN (SELECT DISTINCT match_key FROM keyed_songs) ks ON ne.match_key = ks.match_key 
+WHERE ks.match_key IS NULL;"""
+
+match_rate_insert = """INSERT INTO match_rates (run_at, events, matched) 
+SELECT GETDATE(), COUNT(*), COUNT(ks.match_key) 
+FROM nextsong_events ne 
+LEFT JOIN (SELECT DISTINCT match_key FROM keyed_songs) ks ON ne.match_key = ks.match_key;"""
+
+# DIMENSION MERGES
+# the rows returned by the SELECT of a dimension are staged in a temporary table, then the rows
+# whose values changed are deleted from the dimension and the new and changed rows are inserted.
+# Redshift does not enforce PRIMARY KEYs, so this is what keeps one row per key.
+# With a version column, a row is only replaced by a newer version, whatever the order the batches are merged in
+
+user_table_merge = {
+    "table": "users",
+    "key": "user_id",
+    "columns": ["first_name", "last_name", "gender", "level"],
+    "version": "last_seen",
+    "select": user_table_select,
+}
+
+song_table_merge = {
+    "table": "songs",
+    "key": "song_id",
+    "columns": ["title", "artist_id", "year", "duration"],
+    "select": song_table_select,
+}
+
+artist_table_merge = {
+    "table": "artists",
+    "key": "artist_id",
+    "columns": ["name", "location", "latitude", "longitude"],
+    "select": artist_table_select,
+}
+
+time_table_merge = {
+    "table": "time",
+    "key": "start_time",
+    "columns": ["hour", "day", "week", "month", "year", "weekday"],
+    "select": time_table_select,
+}
+
+merge_stage_template = "CREATE TEMP TABLE {table}_merge AS {select};"
+
+# a column changed if the values differ or exactly one of them is NULL
+merge_changed_template = (
+    "COALESCE({new}.{column} != {old}.{column}, ({new}.{column} IS NULL) != ({old}.{column} IS NULL))"
+)
+
+# the staged row is newer, or the row of the dimension has no version
+merge_newer_template = "({new}.{column} > {old}.{column} OR {old}.{column} IS NULL)"
+
+merge_count_template = """SELECT 
+    SUM(CASE WHEN t.{key} IS NULL THEN 1 ELSE 0 END) AS inserted,
+    SUM(CASE WHEN t.{key} IS NOT NULL AND ({changed}) THEN 1 ELSE 0 END) AS updated,
+    SUM(CASE WHEN t.{key} IS NOT NULL AND NOT ({changed}) THEN 1 ELSE 0 END) AS unchanged
+FROM {table}_merge s 
+LEFT JOIN (SELECT DISTINCT * FROM {table}) t ON s.{key} = t.{key};"""
+
+merge_delete_template = """DELETE FROM {table} 
+USING {table}_merge s 
+WHERE {table}.{key} = s.{key} 
+AND ({changed});"""
+
+merge_insert_template = """INSERT INTO {table} ({key}, {columns}) 
+SELECT s.{key}, {source_columns} FROM {table}_merge s 
+WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = s.{key});"""
+
+merge_drop_template = "DROP TABLE {table}_merge;"
+
+# INCREMENTAL LOAD
+# each partition is loaded into the emptied staging_events table and its NextSong events into
+# nextsong_events, then merged into the dimension tables while the songplays rows it touches are
+# deleted and inserted again, so that loading twice the same partition leaves the final tables unchanged
+
+staging_events_clear = "DELETE FROM staging_events;"
+
+staging_songs_clear = "DELETE FROM staging_songs;"
+
+# song_data files added since the last load are copied into a temporary table, then replace the rows
+# of their songs in staging_songs and keyed_songs, so that copying twice the same file changes nothing
+new_songs_table_create = "CREATE TEMP TABLE new_songs (LIKE staging_songs);"
+
+new_songs_copy_template = """COPY new_songs ({}) FROM '{{source}}'
+JSON 'auto' CREDENTIALS 'aws_iam_role={}' COMPUPDATE OFF 
+region 'us-west-2'{{options}};
+""".format(
+    staging_songs_columns, config["IAM_ROLE"]["ARN"]
+)
+
+staging_songs_replace_delete = """DELETE FROM staging_songs 
+USING new_songs ns 
+WHERE staging_songs.song_id = ns.song_id;"""
+
+staging_songs_replace_insert = "INSERT INTO staging_songs SELECT * FROM new_songs;"
+
+keyed_songs_replace_delete = """DELETE FROM keyed_songs 
+USING new_songs ns 
+WHERE keyed_songs.song_id = ns.song_id;"""
+
+keyed_songs_replace_insert = keyed_songs_insert_template.format(table="new_songs")
+
+new_songs_table_drop = "DROP TABLE new_songs;"
+
+songplay_table_merge_delete = """DELETE FROM songplays 
+USING nextsong_events ne 
+WHERE songplays.start_time = ne.ts 
+AND songplays.user_id = ne.user_id 
+AND songplays.session_id = ne.session_id;"""
+
+watermark_select = "SELECT watermark FROM etl_watermarks WHERE source = %s;"
+
+watermark_delete = "DELETE FROM etl_watermarks WHERE source = %s;"
+
+watermark_insert = """INSERT INTO etl_watermarks (source, watermark, updated_at) 
+VALUES (%s, %s, GETDATE());"""
+
+# day of the last NextSong event loaded, i.e. the last log_data partition after a full load
+nextsong_events_last_date = "SELECT TO_CHAR(MAX(ts), 'YYYY-MM-DD') FROM nextsong_events;"
+
+# SHADOW LOAD
+# a full load can fill <table>_shadow copies of the final tables while the final tables stay
+# queryable, then swap them in one transaction keeping the replaced tables as <table>_previous
+
+shadow_tables_select = """SELECT tablename FROM pg_tables 
+WHERE schemaname = CURRENT_SCHEMA() AND tablename IN %s;"""
+
+table_drop_template = "DROP TABLE IF EXISTS {table};"
+
+table_rename_template = "ALTER TABLE {table} RENAME TO {name};"
+
+table_count_template = "SELECT COUNT(*) FROM {table};"
+
+songplay_shadow_nulls = """SELECT COUNT(*) FROM songplays_shadow 
+WHERE start_time IS NULL OR user_id IS NULL;"""
+
+# PARTITIONED LOAD
+# every worker loads its partitions into session temporary tables named as staging_events and
+# nextsong_events, which take precedence over the permanent ones within the session, so that the
+# transform and merge queries run unchanged on the partition
+
+temp_table_template = "CREATE TEMP TABLE {table}"
+
+checkpoint_insert = """INSERT INTO etl_checkpoints (run_id, log_partition, status, started_at, updated_at) 
+VALUES (%s, %s, 'pending', GETDATE(), GETDATE());"""
+
+checkpoint_update = """UPDATE etl_checkpoints SET status = %s, updated_at = GETDATE() 
+WHERE run_id = %s AND log_partition = %s;"""
+
+last_checkpoint_run_select = """SELECT run_id FROM etl_checkpoints 
+GROUP BY run_id 
+ORDER BY MAX(started_at) DESC 
+LIMIT 1;"""
+
+incomplete_partitions_select = """SELECT log_partition FROM etl_checkpoints 
+WHERE run_id = %s AND status <> 'completed' 
+ORDER BY log_partition;"""
+
+# EXPORT
+# final tables exported to Parquet by export.py, partitioned on the given columns (Hive style, e.g. year=2018/month=11/)
+
+songplay_table_export = {
+    "table": "songplays",
+    "columns": [
+        "songplay_id",
+        "start_time",
+        "user_id",
+        "level",
+        "song_id",
+        "artist_id",
+        "session_id",
+        "location",
+        "user_agent",
+        "year",
+        "month",
+    ],
+    "select": """SELECT sp.songplay_id, sp.start_time, sp.user_id, sp.level, sp.song_id, sp.artist_id, 
+sp.session_id, sp.location, sp.user_agent, t.year, t.month 
+FROM songplays sp 
+JOIN time t ON sp.start_time = t.start_time""",
+    "partition_by": ["year", "month"],
+}
+
+user_table_export = {
+    "table": "users",
+    "columns": ["user_id", "first_name", "last_name", "gender", "level"],
+    "select": "SELECT user_id, first_name, last_name, gender, level FROM users",
+    "partition_by": [],
+}
+
+song_table_export = {
+    "table": "songs",
+    "columns": ["song_id", "title", "artist_id", "year", "duration"],
+    "select": "SELECT song_id, title, artist_id, year, duration FROM songs",
+    "partition_by": [],
+}
+
+artist_table_export = {
+    "table": "artists",
+    "columns": ["artist_id", "name", "location", "latitude", "longitude"],
+    "select": "SELECT artist_id, name, location, latitude, longitude FROM artists",
+    "partition_by": [],
+}
+
+time_table_export = {
+    "table": "time",
+    "columns": ["start_time", "hour", "day", "week", "month", "year", "weekday"],
+    "select": "SELECT start_time, hour, day, week, month, year, weekday FROM time",
+    "partition_by": ["year", "month"],
+}
+
+export_tables = [
+    songplay_table_export,
+    user_table_export,
+    song_table_export,
+    artist_table_export,
+    time_table_export,
+]
+
+# text of a row hashed into its fingerprint, NULLs as empty strings
+export_row_column_template = "COALESCE(CAST({column} AS VARCHAR), '')"
+
+# rows and sum of the row hashes of every partition: a partition is exported again when they change
+export_fingerprint_template = """SELECT {keys}COUNT(*), SUM(STRTOL(SUBSTRING(MD5({row}), 1, 8), 16)) 
+FROM ({select}) exported{group_by};"""
+
+export_select_template = "SELECT * FROM ({select}) exported{where}"
+
+unload_template = """UNLOAD ('{select}') 
+TO '{target}' 
+CREDENTIALS 'aws_iam_role={role}' 
+FORMAT AS PARQUET{partition_by} PARALLEL ON MAXFILESIZE {maxfilesize} MB ALLOWOVERWRITE 
+region 'us-west-2';"""
+
+# PLANS
+
+explain_template = "EXPLAIN {query};"
+
+# RUN METRICS
+
+run_metrics_insert = """INSERT INTO etl_run_metrics (
+    run_id, script, stage, name, started_at, seconds, row_count, query_id, scanned_bytes, returned_bytes, status, error
+) 
+VALUES %s;"""
+
+# one row of run_metrics_insert, the records of a run are written with a single multi-row insert
+run_metrics_template = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, LEFT(%s, 1024))"
+
+# queries of the sessions of a run, in the order they started, to find the query ID of every statement
+session_queries_select = """SELECT pid, query, TRIM(querytxt) 
+FROM stl_query 
+WHERE pid IN %s AND starttime >= %s 
+ORDER BY pid, starttime, query;"""
+
+scanned_bytes_select = "SELECT query, SUM(bytes) FROM stl_scan WHERE query IN %s GROUP BY query;"
+
+returned_bytes_select = "SELECT query, SUM(bytes) FROM stl_return WHERE query IN %s GROUP BY query;"
+
+# service class (WLM queue) of each query and its time waiting in the queue and executing, in microseconds
+wlm_query_select = """SELECT query, service_class, total_queue_time, total_exec_time 
+FROM stl_wlm_query WHERE query IN %s;"""
+
+# WORKLOAD MANAGEMENT
+# queries are routed to the WLM queue of their query group and take the given number of its slots
+
+query_group_set = "SET query_group TO %s;"
+
+slot_count_set = "SET wlm_query_slot_count TO %s;"
+
+# MAINTENANCE
+# stats off, unsorted and deleted (not vacuumed yet) percentages and size in MB of the tables
+
+table_health_select = """SELECT "table", COALESCE(stats_off, 0), COALESCE(unsorted, 0), 
+    CASE WHEN tbl_rows > 0 THEN 100.0 * (tbl_rows - estimated_visible_rows) / tbl_rows ELSE 0 END, 
+    size 
+FROM svv_table_info 
+WHERE "table" IN %s;"""
+
+# PostgreSQL keeps no sort order, the rows changed since the last ANALYZE stand for stats off
+postgres_table_health_select = """SELECT relname, 
+    CASE 
+        WHEN last_analyze IS NULL AND last_autoanalyze IS NULL THEN 100 
+        WHEN n_live_tup > 0 THEN 100.0 * n_mod_since_analyze / n_live_tup 
+        ELSE 0 
+    END, 
+    0, 
+    CASE WHEN n_live_tup + n_dead_tup > 0 THEN 100.0 * n_dead_tup / (n_live_tup + n_dead_tup) ELSE 0 END, 
+    pg_total_relation_size(relid) / 1048576 
+FROM pg_stat_user_tables 
+WHERE relname IN %s;"""
+
+statement_timeout_set = "SET statement_timeout TO %s;"
+
+vacuum_template = "VACUUM {mode} {table};"
+
+analyze_template = "ANALYZE {table};"
+
+# ENCODING ANALYSIS
+
+analyze_compression_template = "ANALYZE COMPRESSION {table} COMPROWS {comprows};"
+
+# LOAD GENERATIONS
+
+load_generation_select = "SELECT COALESCE(MAX(generation), 0) FROM etl_load_generations;"
+
+load_generation_bump = """INSERT INTO etl_load_generations (generation, loaded_at) 
+SELECT COALESCE(MAX(generation), 0) + 1, GETDATE() FROM etl_load_generations;"""
+
+# SIZING
+
+# size in 1 MB blocks
+table_sizes_select = 'SELECT "table", size FROM svv_table_info WHERE "table" IN %s;'
 
 # QUERY LISTS
 
 create_table_queries = [
     staging_events_table_create,
     staging_songs_table_create,
+    nextsong_events_table_create,
+    keyed_songs_table_create,
     user_table_create,
     song_table_create,
     artist_table_create,
     time_table_create,
     songplay_table_create,
-]
+    watermark_table_create,
+    checkpoint_table_create,
+    unmatched_events_table_create,
+    match_rate_table_create,
+    run_metrics_table_create,
+    load_generation_table_create,
+] + aggregate_table_create_queries
 drop_table_queries = [
     staging_events_table_drop,
     staging_songs_table_drop,
+    nextsong_events_table_drop,
+    keyed_songs_table_drop,
     songplay_table_drop,
     user_table_drop,
     song_table_drop,
     artist_table_drop,
     time_table_drop,
-]
+    watermark_table_drop,
+    checkpoint_table_drop,
+] + aggregate_table_drop_queries
 copy_table_queries = [staging_events_copy, staging_songs_copy]
+# queries to run after the COPY into each staging table
+post_copy_queries = {
+    "staging_songs": [keyed_songs_clear, keyed_songs_insert],
+}
 insert_table_queries = [
+    nextsong_events_insert,
     songplay_table_insert,
     user_table_insert,
     song_table_insert,
     artist_table_insert,
     time_table_insert,
 ]
+
+# dimensions filled from nextsong_events and staging_songs respectively
+event_table_merges = [user_table_merge, artist_table_merge, time_table_merge]
+song_table_merges = [song_table_merge]
+
+# INSERT GRAPH
+# tables read and written by each insert query, used to run the independent ones concurrently.
+# songplays references the dimension tables, so it waits for them to be loaded
+
+insert_table_graph = [
+    {
+        "name": "nextsong_events",
+        "queries": [nextsong_events_clear, nextsong_events_insert],
+        "reads": ["staging_events"],
+        "writes": ["nextsong_events"],
+    },
+    {
+        "name": "users",
+        "merge": user_table_merge,
+        "reads": ["nextsong_events"],
+        "writes": ["users"],
+    },
+    {
+        "name": "songs",
+        "merge": song_table_merge,
+        "reads": ["staging_songs"],
+        "writes": ["songs"],
+    },
+    {
+        "name": "artists",
+        "merge": artist_table_merge,
+        "reads": ["nextsong_events", "keyed_songs"],
+        "writes": ["artists"],
+    },
+    {
+        "name": "time",
+        "merge": time_table_merge,
+        "reads": ["nextsong_events"],
+        "writes": ["time"],
+    },
+    {
+        "name": "songplays",
+        "query": songplay_table_insert,
+        "reads": ["nextsong_events", "keyed_songs", "users", "songs", "artists", "time"],
+        "writes": ["songplays"],
+    },
+    {
+        "name": "unmatched_events",
+        "query": unmatched_events_insert,
+        "reads": ["nextsong_events", "keyed_songs"],
+        "writes": ["unmatched_events"],
+    },
+    {
+        "name": "match_rates",
+        "query": match_rate_insert,
+        "reads": ["nextsong_events", "keyed_songs"],
+        "writes": ["match_rates"],
+    },
+]
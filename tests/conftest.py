@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the scripts are top-level modules and sql_queries.py reads dwh.cfg from the working directory
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
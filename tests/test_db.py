@@ -0,0 +1,54 @@
+import configparser
+import db
+from sql_queries import insert_table_graph
+
+WLM_CFG = """
+[ETL]
+BACKEND = redshift
+
+[WLM]
+ETL_CONCURRENCY = 4
+SLOTS = 1
+SLOTS_STAGING = 2
+SLOTS_SONGPLAYS = 2
+"""
+
+
+def config():
+    parser = configparser.ConfigParser()
+    parser.read_string(WLM_CFG)
+    return parser
+
+
+def test_slot_count():
+    assert db.slot_count(config(), "songplays", "insert") == 2
+    assert db.slot_count(config(), "users", "insert") == 1
+    assert db.slot_count(config(), "staging") == 2
+
+    postgres = config()
+    postgres["ETL"]["BACKEND"] = "postgres"
+    assert db.slot_count(postgres, "staging") is None
+
+
+def test_check_slots(caplog):
+    assert db.check_slots(config(), "insert", 3, [1, 2, 1, 1, 1]) == 4
+    assert not caplog.records
+
+    assert db.check_slots(config(), "staging", 3, [2, 2, 2]) == 6
+    assert "more than the 4 of ETL_CONCURRENCY" in caplog.text
+
+    assert db.check_slots(config(), "staging", 2, [None, None]) is None
+
+
+def test_default_configuration_fits_the_etl_queue(caplog):
+    defaults = configparser.ConfigParser()
+    defaults.read("dwh.cfg")
+    concurrency = defaults.getint("WLM", "ETL_CONCURRENCY")
+    workers = defaults.getint("ETL", "INSERT_WORKERS")
+    slots = [db.slot_count(defaults, node["name"], "insert") for node in insert_table_graph]
+    assert db.check_slots(defaults, "insert", workers, slots) <= concurrency
+    workers = defaults.getint("ETL", "STAGING_WORKERS")
+    assert db.check_slots(defaults, "staging", workers, [db.slot_count(defaults, "staging")] * 2) <= concurrency
+    workers = defaults.getint("ETL", "PARTITION_WORKERS")
+    assert db.check_slots(defaults, "partition", workers, [db.slot_count(defaults, "partition")] * 12) <= concurrency
+    assert not caplog.records
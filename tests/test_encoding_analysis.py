@@ -0,0 +1,33 @@
+import encoding_analysis
+from sql_queries import table_sizes_select
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, query, vars=None):
+        self.executed.append((query, vars))
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_table_sizes_of_the_given_tables():
+    cur = FakeCursor([("songplays", 120), ("users", 8)])
+    assert encoding_analysis.table_sizes(cur, ["songplays", "users"]) == {"songplays": 120, "users": 8}
+    assert cur.executed == [(table_sizes_select, (("songplays", "users"),))]
+
+
+def test_table_sizes_without_tables():
+    cur = FakeCursor([])
+    assert encoding_analysis.table_sizes(cur, []) == {}
+    assert cur.executed == []
+
+
+def test_compare_sizes():
+    assert encoding_analysis.compare_sizes({"songs": 200, "users": 8}, {"songs": 150}) == {
+        "songs": {"before_mb": 200, "after_mb": 150, "change_pct": -25.0},
+        "users": {"before_mb": 8, "after_mb": None, "change_pct": None},
+    }
@@ -0,0 +1,73 @@
+import configparser
+import psycopg2
+import pytest
+import etl
+from sql_queries import load_generation_bump
+
+
+class FakeConnection:
+    """Keep the queries of every committed transaction"""
+
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+        self.rollbacks = 0
+
+    def commit(self):
+        self.committed.append(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, vars=None):
+        if "failing" in query:
+            raise psycopg2.Error("INSERT failed")
+        self.conn.pending.append(query)
+
+
+def failing_load(*args, **kwargs):
+    raise psycopg2.Error("COPY failed")
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setattr(etl, "create_tables", lambda cur, conn, profile: None)
+    monkeypatch.setattr(etl.boto3, "client", lambda service: None)
+    parser = configparser.ConfigParser()
+    parser.read_string(
+        "[ETL]\nBACKEND = redshift\n[DESIGN]\nPROFILE = none\n"
+        "[S3]\nLOG_DATA = s3://b/log_data\nSONG_DATA = s3://b/song_data\n"
+    )
+    return parser
+
+
+def test_load_incremental_returns_false_on_song_data_error(monkeypatch, config):
+    monkeypatch.setattr(etl.incremental, "load_incremental", failing_load)
+    conn = FakeConnection()
+    assert etl.load_incremental(config, None, conn) is False
+    assert conn.rollbacks == 1
+
+
+def test_load_partitioned_returns_false_on_song_data_error(monkeypatch, config):
+    monkeypatch.setattr(etl.partitioned, "load_partitioned", failing_load)
+    conn = FakeConnection()
+    assert etl.load_partitioned(config, None, conn) is False
+    assert conn.rollbacks == 1
+
+
+def test_insert_tables_bumps_generation_with_every_node():
+    conn = FakeConnection()
+    graph = [
+        {"name": "users", "query": "INSERT INTO users"},
+        {"name": "songplays", "query": "INSERT INTO songplays failing"},
+    ]
+    assert etl.insert_tables(FakeCursor(conn), conn, graph) is False
+    assert conn.committed == [["INSERT INTO users", load_generation_bump]]
+    assert conn.rollbacks == 1
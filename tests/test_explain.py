@@ -0,0 +1,141 @@
+import explain
+
+# EXPLAIN of songplay_table_insert on Redshift, nextsong_events and keyed_songs both distributed on match_key
+SONGPLAYS_COLOCATED = """XN Subquery Scan "*SELECT*"  (cost=0.00..41373.08 rows=8056 width=336)
+  ->  XN Hash Left Join DS_DIST_NONE  (cost=0.00..41272.38 rows=8056 width=336)
+        Hash Cond: (("outer".match_key)::bpchar = ("inner".match_key)::bpchar)
+        ->  XN Seq Scan on nextsong_events ne  (cost=0.00..80.56 rows=8056 width=312)
+        ->  XN Hash  (cost=0.00..147.96 rows=14796 width=92)
+              ->  XN Seq Scan on keyed_songs ks  (cost=0.00..147.96 rows=14796 width=92)"""
+
+# the same query once keyed_songs is distributed evenly
+SONGPLAYS_REDISTRIBUTED = """XN Subquery Scan "*SELECT*"  (cost=0.00..1241373.08 rows=8056 width=336)
+  ->  XN Hash Left Join DS_DIST_INNER  (cost=0.00..1241272.38 rows=8056 width=336)
+        Hash Cond: (("outer".match_key)::bpchar = ("inner".match_key)::bpchar)
+        ->  XN Seq Scan on nextsong_events ne  (cost=0.00..80.56 rows=8056 width=312)
+        ->  XN Hash  (cost=0.00..147.96 rows=14796 width=92)
+              ->  XN Seq Scan on keyed_songs ks  (cost=0.00..147.96 rows=14796 width=92)"""
+
+# a join without equality condition
+NESTED_LOOP = """XN Nested Loop DS_BCAST_INNER  (cost=0.00..5000009.50 rows=100 width=40)
+  Join Filter: ("inner".ts > "outer".start_time)
+  ->  XN Seq Scan on time t  (cost=0.00..0.80 rows=80 width=8)
+  ->  XN Seq Scan on nextsong_events ne  (cost=0.00..80.56 rows=8056 width=32)"""
+
+
+def summary(plan):
+    return explain.summarize_plan(explain.parse_plan(plan))
+
+
+def test_parse_plan():
+    steps = explain.parse_plan(SONGPLAYS_COLOCATED)
+    assert [step["operator"] for step in steps] == [
+        'Subquery Scan "*SELECT*"',
+        "Hash Left Join",
+        "Seq Scan",
+        "Hash",
+        "Seq Scan",
+    ]
+    assert steps[1]["distribution"] == "DS_DIST_NONE"
+    assert steps[1]["details"] == ['Hash Cond: (("outer".match_key)::bpchar = ("inner".match_key)::bpchar)']
+    assert [step["table"] for step in steps] == [None, None, "nextsong_events", None, "keyed_songs"]
+    assert steps[0]["total_cost"] == 41373.08
+    assert steps[2]["rows"] == 8056
+    assert steps[4]["depth"] > steps[3]["depth"] > steps[1]["depth"] > steps[0]["depth"]
+
+
+def test_summarize_plan_flags():
+    assert summary(SONGPLAYS_COLOCATED) == {
+        "cost": 41373.08,
+        "distributions": ["DS_DIST_NONE"],
+        "flags": [],
+    }
+    assert summary(SONGPLAYS_REDISTRIBUTED)["flags"] == ["DS_DIST_INNER"]
+    assert summary(NESTED_LOOP)["flags"] == ["DS_BCAST_INNER", "Nested Loop"]
+
+
+def test_compare_plans_reports_distribution_change():
+    regressions = explain.compare_plans(
+        {"songplays": summary(SONGPLAYS_COLOCATED)},
+        {"songplays": summary(SONGPLAYS_REDISTRIBUTED)},
+        max_cost_ratio=100,
+    )
+    assert regressions == {
+        "songplays": ["new DS_DIST_INNER", "distributions DS_DIST_NONE -> DS_DIST_INNER"]
+    }
+
+
+def test_compare_plans_reports_unflagged_distribution_change():
+    before = {"artists": {"cost": 10.0, "distributions": ["DS_DIST_NONE"], "flags": []}}
+    after = {"artists": {"cost": 10.0, "distributions": ["DS_DIST_ALL_NONE"], "flags": []}}
+    assert explain.compare_plans(before, after) == {
+        "artists": ["distributions DS_DIST_NONE -> DS_DIST_ALL_NONE"]
+    }
+
+
+def test_compare_plans_cost_and_missing_baseline():
+    plans = {"songplays": summary(SONGPLAYS_COLOCATED)}
+    assert explain.compare_plans(plans, plans) == {}
+
+    doubled = dict(plans["songplays"], cost=plans["songplays"]["cost"] * 3)
+    assert explain.compare_plans(plans, {"songplays": doubled}) == {
+        "songplays": ["cost 41373.08 -> 124119.24"]
+    }
+    assert explain.compare_plans({}, {"time": summary(NESTED_LOOP)}) == {
+        "time": ["DS_BCAST_INNER (no baseline)", "Nested Loop (no baseline)"]
+    }
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+    def rollback(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, executed):
+        self.executed = executed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        self.executed.append(query)
+
+    def fetchall(self):
+        return [(line,) for line in NESTED_LOOP.splitlines()]
+
+
+def test_explain_queries_names_the_statements_of_the_graph():
+    merge = {"table": "users", "key": "user_id", "columns": ["level"], "select": "SELECT user_id, level FROM e"}
+    graph = [
+        {
+            "name": "nextsong_events",
+            "queries": ["DELETE FROM nextsong_events;", "INSERT INTO nextsong_events SELECT 1;"],
+        },
+        {"name": "users", "merge": merge},
+        {"name": "songplays", "query": "INSERT INTO songplays SELECT 1;"},
+    ]
+    conn = FakeConnection()
+    summaries = explain.explain_queries(conn, graph)
+
+    assert list(summaries) == [
+        "nextsong_events delete",
+        "nextsong_events insert",
+        "users stage",
+        "users delete",
+        "users insert",
+        "songplays",
+    ]
+    stage = explain.merge_queries(merge)["stage"]
+    # the staged rows exist before the DELETE and INSERT of the merge are explained
+    assert conn.executed.index(stage) == conn.executed.index(f"EXPLAIN {stage.rstrip(';')};") + 1
+    assert conn.executed[conn.executed.index(stage) + 1].startswith("EXPLAIN DELETE FROM users")
@@ -0,0 +1,63 @@
+import collections
+import os
+import pytest
+import export
+
+Column = collections.namedtuple("Column", ["name", "type_code"])
+
+SONGPLAYS = {"table": "songplays", "partition_by": ["year", "month"]}
+
+
+class FakeNamedCursor:
+    """Return the rows in batches, as a named cursor"""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+def test_partition_filter():
+    assert export.partition_filter(["year=2018/month=11"]) == " WHERE (year = 2018 AND month = 11)"
+    assert export.partition_filter(["year=2018/month=11", "year=2018/month=12"]) == (
+        " WHERE (year = 2018 AND month = 11) OR (year = 2018 AND month = 12)"
+    )
+    assert export.partition_filter([""]) == ""
+    assert export.partition_filter([]) == ""
+
+
+def test_changed_partitions():
+    previous = {"year=2018/month=10": [3, 1], "year=2018/month=11": [5, 2], "year=2018/month=12": [4, 7]}
+    current = {"year=2018/month=11": [5, 2], "year=2018/month=12": [6, 8], "year=2019/month=1": [1, 9]}
+    assert export.changed_partitions(previous, current) == (
+        ["year=2018/month=12", "year=2019/month=1"],
+        ["year=2018/month=10"],
+    )
+    assert export.changed_partitions({}, {}) == ([], [])
+
+
+def test_write_partitions_one_file_per_partition(tmp_path):
+    pytest.importorskip("pyarrow")
+    description = [Column("year", 23), Column("month", 23), Column("songplay_id", 20), Column("level", 1043)]
+    rows = [(2018, 11, i, "paid") for i in range(5)] + [(2018, 12, i, "free") for i in range(5, 8)]
+    cur = FakeNamedCursor(description, rows)
+
+    # batches of 3 rows split the partitions across row groups
+    assert export.write_partitions(cur, SONGPLAYS, str(tmp_path), batch_rows=3) == 8
+
+    november = tmp_path / "year=2018" / "month=11" / "part-00000.parquet"
+    december = tmp_path / "year=2018" / "month=12" / "part-00000.parquet"
+    assert sorted(os.listdir(tmp_path / "year=2018")) == ["month=11", "month=12"]
+    table = export.pyarrow.parquet.read_table(str(november))
+    assert table.column_names == ["songplay_id", "level"]
+    assert table.column("songplay_id").to_pylist() == [0, 1, 2, 3, 4]
+    assert export.pyarrow.parquet.read_table(str(december)).column("level").to_pylist() == ["free"] * 3
+
+
+def test_write_partitions_without_rows(tmp_path):
+    cur = FakeNamedCursor([Column("year", 23)], [])
+    assert export.write_partitions(cur, SONGPLAYS, str(tmp_path)) == 0
+    assert os.listdir(tmp_path) == []
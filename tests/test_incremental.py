@@ -0,0 +1,61 @@
+import psycopg2
+import pytest
+import incremental
+from sql_queries import load_generation_bump
+
+
+class FakeConnection:
+    """Keep the queries of every committed transaction"""
+
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+
+    def commit(self):
+        self.committed.append(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class FakeCursor:
+    """Fail the queries holding fail_on, the selects return no watermark and no merged rows"""
+
+    def __init__(self, conn, fail_on=None):
+        self.conn = conn
+        self.fail_on = fail_on
+
+    def execute(self, query, vars=None):
+        if self.fail_on and self.fail_on in query:
+            raise psycopg2.Error(f"failed on {self.fail_on}")
+        self.conn.pending.append(query)
+
+    def fetchone(self):
+        return (0, 0, 0)
+
+    def fetchall(self):
+        return []
+
+
+def test_load_partition_bumps_generation_with_its_commit(monkeypatch):
+    monkeypatch.setattr(incremental, "get_watermark", lambda cur, source=None: None)
+    conn = FakeConnection()
+    incremental.load_partition(FakeCursor(conn), conn, "2018-11-01", "s3://b/log_data/2018-11-01")
+
+    assert len(conn.committed) == 1
+    assert load_generation_bump in conn.committed[0]
+
+
+def test_failed_partition_keeps_generation_of_previous_ones(monkeypatch):
+    monkeypatch.setattr(incremental, "get_watermark", lambda cur, source=None: None)
+    conn = FakeConnection()
+    incremental.load_partition(FakeCursor(conn), conn, "2018-11-01", "s3://b/log_data/2018-11-01")
+    with pytest.raises(psycopg2.Error):
+        incremental.load_partition(
+            FakeCursor(conn, fail_on="2018-11-02"), conn, "2018-11-02", "s3://b/log_data/2018-11-02"
+        )
+
+    assert len(conn.committed) == 1
+    assert load_generation_bump in conn.committed[0]
+    assert conn.pending == []
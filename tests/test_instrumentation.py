@@ -0,0 +1,48 @@
+import instrumentation
+from sql_queries import session_queries_select
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, query, vars=None):
+        self.executed.append((query, vars))
+
+    def fetchall(self):
+        return self.rows
+
+
+def record(pid, query, status="succeeded"):
+    record = instrumentation.new_record("insert", instrumentation.describe(query))
+    record["pid"] = pid
+    record["status"] = status
+    return record
+
+
+def test_collect_query_ids_matches_statements_of_each_session():
+    run = instrumentation.RunMetrics("etl.py")
+    run.records = [
+        record(7, "SET query_group TO %s;"),
+        record(7, "COPY staging_events FROM 's3://b/log_data'"),
+        record(8, "INSERT INTO users (user_id)\nSELECT 1;", status="failed"),
+        record(7, "INSERT INTO songplays (songplay_id)\nSELECT 1;"),
+        record(8, "INSERT INTO users (user_id)\nSELECT 1;"),
+        instrumentation.new_record("staging", "COPY staging_events FROM STDIN"),
+    ]
+    cur = FakeCursor(
+        [
+            (7, 100, "padb_fetch_sample: select * from staging_events"),
+            (7, 101, "COPY staging_events FROM 's3://b/log_data'"),
+            (7, 103, "INSERT INTO songplays (songplay_id)\\nSELECT 1;"),
+            (8, 102, "INSERT INTO users (user_id)\\nSELECT 1;"),
+            (8, 104, "INSERT INTO users (user_id)\\nSELECT 1;"),
+        ]
+    )
+    instrumentation.collect_query_ids(cur, run)
+
+    assert [r["query_id"] for r in run.records] == [None, 101, None, 103, 104, None]
+    query, vars = cur.executed[0]
+    assert query == session_queries_select
+    assert set(vars[0]) == {7, 8}
@@ -0,0 +1,168 @@
+import configparser
+import datetime
+import json
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+import manage_cluster
+from resources import read_resources
+
+DWH_CFG = """
+[CLUSTER]
+DB_USER = sparkify
+DB_PASSWORD = Passw0rd
+DB_PORT = 5439
+
+[IAM_ROLE]
+ARN =
+
+[HW]
+NODE_TYPE = dc2.large
+
+[SIZING]
+NODES = 2
+
+[WLM]
+QUERY_GROUP = etl
+ANALYST_QUERY_GROUP = analyst
+PARAMETER_GROUP =
+"""
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/sparkifydbRole"
+
+
+def client(service):
+    return boto3.client(
+        service, region_name="us-west-2", aws_access_key_id="testing", aws_secret_access_key="testing"
+    )
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    (tmp_path / "dwh.cfg").write_text(DWH_CFG)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def stub_role(stubber):
+    stubber.add_response(
+        "create_role",
+        {
+            "Role": {
+                "Path": "/",
+                "RoleName": "sparkifydbRole",
+                "RoleId": "AROAEXAMPLEROLEID1234",
+                "Arn": ROLE_ARN,
+                "CreateDate": datetime.datetime(2020, 1, 1),
+            }
+        },
+    )
+    stubber.add_response("attach_role_policy", {})
+    stubber.add_response(
+        "get_role",
+        {
+            "Role": {
+                "Path": "/",
+                "RoleName": "sparkifydbRole",
+                "RoleId": "AROAEXAMPLEROLEID1234",
+                "Arn": ROLE_ARN,
+                "CreateDate": datetime.datetime(2020, 1, 1),
+            }
+        },
+    )
+
+
+def stub_security_group(stubber):
+    stubber.add_response("describe_vpcs", {"Vpcs": [{"VpcId": "vpc-1"}]})
+    stubber.add_response("create_security_group", {"GroupId": "sg-1"})
+    stubber.add_response("authorize_security_group_ingress", {})
+
+
+def test_get_default_vpc_missing():
+    ec2 = client("ec2")
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_vpcs", {"Vpcs": []})
+        assert manage_cluster.get_default_vpc(ec2) is None
+        stubber.add_response("describe_vpcs", {"Vpcs": []})
+        assert manage_cluster.prepare_security_group(ec2, None, 5439) is None
+
+
+def test_create_resources_records_role_without_security_group(workdir):
+    iam, redshift, ec2 = client("iam"), client("redshift"), client("ec2")
+    with Stubber(iam) as iam_stub, Stubber(redshift), Stubber(ec2) as ec2_stub:
+        stub_role(iam_stub)
+        ec2_stub.add_response("describe_vpcs", {"Vpcs": []})
+        manage_cluster.create_resources(iam, redshift, ec2, get_ip=lambda: "10.0.0.1")
+        iam_stub.assert_no_pending_responses()
+
+    resources = read_resources()["RESOURCES"]
+    assert resources["ROLE_NAME"] == "sparkifydbRole"
+    assert "SecurityGroupId" not in resources
+    assert "ClusterIdentifier" not in resources
+
+
+def test_create_resources_records_role_and_security_group_without_cluster(workdir):
+    iam, redshift, ec2 = client("iam"), client("redshift"), client("ec2")
+    with Stubber(iam) as iam_stub, Stubber(redshift) as redshift_stub, Stubber(ec2) as ec2_stub:
+        stub_role(iam_stub)
+        stub_security_group(ec2_stub)
+        redshift_stub.add_client_error("create_cluster", "ClusterQuotaExceeded")
+        manage_cluster.create_resources(iam, redshift, ec2, get_ip=lambda: "10.0.0.1")
+        redshift_stub.assert_no_pending_responses()
+
+    resources = read_resources()["RESOURCES"]
+    assert resources["ROLE_NAME"] == "sparkifydbRole"
+    assert resources["SecurityGroupId"] == "sg-1"
+    assert "ClusterIdentifier" not in resources
+
+
+def test_free_resources_deletes_partial_resources(workdir):
+    (workdir / "resources.cfg").write_text("[RESOURCES]\nROLE_NAME = sparkifydbRole\n")
+    iam, redshift, ec2 = client("iam"), client("redshift"), client("ec2")
+    with Stubber(iam) as iam_stub, Stubber(redshift), Stubber(ec2):
+        iam_stub.add_response(
+            "detach_role_policy", {}, {"RoleName": "sparkifydbRole", "PolicyArn": ANY}
+        )
+        iam_stub.add_response("delete_role", {}, {"RoleName": "sparkifydbRole"})
+        manage_cluster.free_resources(iam, redshift, ec2, sleep=lambda seconds: None)
+        iam_stub.assert_no_pending_responses()
+
+    assert read_resources()["RESOURCES"]["ClusterState"] == "deleted"
+
+
+def test_wlm_configuration():
+    config = configparser.ConfigParser()
+    config.read_string(DWH_CFG)
+    queues = manage_cluster.wlm_configuration(config)
+    assert [queue.get("query_group") for queue in queues[:2]] == [["etl"], ["analyst"]]
+    assert sum(queue.get("memory_percent_to_use", 0) for queue in queues) == 100
+    assert queues[-1] == {"short_query_queue": True}
+
+    config["WLM"]["ETL_MEMORY_PCT"] = "70"
+    with pytest.raises(ValueError):
+        manage_cluster.wlm_configuration(config)
+
+
+def test_create_wlm_parameter_group_updates_existing_group():
+    queues = [{"query_concurrency": 5, "memory_percent_to_use": 100}]
+    redshift = client("redshift")
+    with Stubber(redshift) as stubber:
+        stubber.add_client_error(
+            "create_cluster_parameter_group", "ClusterParameterGroupAlreadyExists"
+        )
+        stubber.add_response(
+            "modify_cluster_parameter_group",
+            {"ParameterGroupName": "sparkify-wlm", "ParameterGroupStatus": "ok"},
+            {
+                "ParameterGroupName": "sparkify-wlm",
+                "Parameters": [
+                    {
+                        "ParameterName": "wlm_json_configuration",
+                        "ParameterValue": json.dumps(queues),
+                        "ApplyType": "static",
+                    }
+                ],
+            },
+        )
+        assert manage_cluster.create_wlm_parameter_group(redshift, "sparkify-wlm", queues) == "sparkify-wlm"
+        stubber.assert_no_pending_responses()
@@ -0,0 +1,126 @@
+import json
+import boto3
+import pytest
+import compaction
+import manifests
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+BUCKET = "sparkify-test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put_files(client, sizes):
+    for key, size in sizes.items():
+        client.put_object(Bucket=BUCKET, Key=key, Body=b"x" * size)
+
+
+def read_manifest(client, key):
+    return json.loads(client.get_object(Bucket=BUCKET, Key=key)["Body"].read())
+
+
+def test_slice_count():
+    assert manifests.slice_count("dc2.large", 4) == 8
+    assert manifests.slice_count("ra3.4xlarge", 2) == 8
+    with pytest.raises(ValueError):
+        manifests.slice_count("dc1.large", 2)
+
+
+def test_build_manifest():
+    manifest = manifests.build_manifest(BUCKET, [("log_data/a.json", 10)])
+    assert manifest == {
+        "entries": [
+            {"url": f"s3://{BUCKET}/log_data/a.json", "mandatory": True, "meta": {"content_length": 10}}
+        ]
+    }
+
+
+def test_generate_manifest_lists_every_file(s3):
+    put_files(
+        s3,
+        {
+            "log_data/2018/11/2018-11-02-events.json": 30,
+            "log_data/2018/11/2018-11-01-events.json": 10,
+            "log_data/2018/11/notes.txt": 5,
+            "song_data/A/A/A/TRAAAAK.json": 7,
+        },
+    )
+    report = manifests.generate_manifest(
+        s3, f"s3://{BUCKET}/log_data", f"s3://{BUCKET}/manifests/log_data.manifest", 4, suffix=".json"
+    )
+
+    manifest = read_manifest(s3, "manifests/log_data.manifest")
+    assert [entry["url"] for entry in manifest["entries"]] == [
+        f"s3://{BUCKET}/log_data/2018/11/2018-11-01-events.json",
+        f"s3://{BUCKET}/log_data/2018/11/2018-11-02-events.json",
+    ]
+    assert [entry["meta"]["content_length"] for entry in manifest["entries"]] == [10, 30]
+    assert all(entry["mandatory"] for entry in manifest["entries"])
+    assert report["files"] == 2
+    assert report["bytes"] == 40
+    assert report["largest_bytes"] == 30
+    assert report["files_per_slice"] == 0.5
+    assert report["remainder"] == 2
+
+
+def test_generate_manifest_warns_about_the_slices(s3, caplog):
+    put_files(s3, {f"song_data/{i}.json": 100 for i in range(3)})
+    put_files(s3, {"song_data/large.json": 1000})
+    manifests.generate_manifest(s3, f"s3://{BUCKET}/song_data", f"s3://{BUCKET}/song_data.manifest", 2)
+
+    messages = " ".join(record.getMessage() for record in caplog.records)
+    assert "not a multiple of 2 slices" not in messages
+    assert "the slice loading it finishes last" in messages
+    assert "consider compacting the files before loading them" in messages
+
+
+def test_generate_manifest_empty_prefix(s3):
+    report = manifests.generate_manifest(s3, f"s3://{BUCKET}/log_data", f"s3://{BUCKET}/empty.manifest", 4)
+    assert read_manifest(s3, "empty.manifest") == {"entries": []}
+    assert report["files"] == 0
+    assert report["largest_bytes"] == 0
+
+
+def put_songs(client, first, count):
+    for i in range(first, first + count):
+        body = json.dumps({"song_id": f"S{i:04d}", "title": "x" * (i % 7 * 10)})
+        client.put_object(Bucket=BUCKET, Key=f"song_data/{i:04d}.json", Body=body.encode("utf-8"))
+
+
+def test_compacted_chunks_are_a_multiple_of_the_slices(s3):
+    slices = manifests.slice_count("dc2.large", 2)
+    target = f"s3://{BUCKET}/compacted/song_data"
+    put_songs(s3, 0, 37)
+    report = compaction.compact(s3, f"s3://{BUCKET}/song_data", target, 200, slices=slices)
+    assert report["objects"] == 37
+    assert report["records"] == 37
+
+    # an incremental run adds a multiple of the slices too
+    put_songs(s3, 37, 9)
+    compaction.compact(s3, f"s3://{BUCKET}/song_data", target, 200, slices=slices)
+
+    manifests.generate_manifest(s3, target, f"s3://{BUCKET}/song_data.manifest", slices, suffix=".json.gz")
+    entries = read_manifest(s3, "song_data.manifest")["entries"]
+    assert len(entries) % slices == 0
+    assert len(entries) > slices
+
+
+def test_plan_rounds_balances_the_chunks():
+    objects = [("a", 50), ("b", 40), ("c", 30), ("d", 30), ("e", 20), ("f", 10)]
+    rounds = compaction.plan_rounds(objects, 100, 2)
+    assert len(rounds) == 1
+    assert sorted(sorted(chunk) for chunk in rounds[0]) == [["a", "d", "f"], ["b", "c", "e"]]
+
+    assert len(compaction.plan_rounds(objects, 40, 2)) == 3
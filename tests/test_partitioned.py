@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import partitioned
+from sql_queries import checkpoint_update
+
+
+class FakeConnection:
+    def __init__(self, log):
+        self.log = log
+
+    def cursor(self):
+        return FakeCursor(self.log)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    """Copy the months slower the earlier they are, fail the month named in its prefix"""
+
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        if "COPY" in query:
+            if "failing" in query:
+                raise psycopg2.Error("COPY failed")
+            time.sleep(0.05 if "2018-01" in query else 0.01)
+        if query == checkpoint_update:
+            self.log.append(vars[:1] + vars[2:])
+
+    def fetchone(self):
+        return (0, 0, 0)
+
+    def fetchall(self):
+        return []
+
+
+class FakeWorkerConnections:
+    def __init__(self, log):
+        self.local = threading.local()
+        self.log = log
+
+    def get(self):
+        if not hasattr(self.local, "conn"):
+            self.local.conn = FakeConnection(self.log)
+        return self.local.conn
+
+    def close(self):
+        pass
+
+
+def load(monkeypatch, prefixes):
+    log = []
+    monkeypatch.setattr(partitioned, "WorkerConnections", lambda config: FakeWorkerConnections(log))
+    loader = partitioned.PartitionLoader(None, "run", {}, list(prefixes))
+    with ThreadPoolExecutor(max_workers=len(prefixes)) as executor:
+        results = list(executor.map(loader.load, prefixes, prefixes.values()))
+    return results, log
+
+
+def test_months_merged_in_date_order(monkeypatch):
+    prefixes = {month: f"s3://b/log_data/{month}/" for month in ("2018-01", "2018-02", "2018-03")}
+    results, log = load(monkeypatch, prefixes)
+
+    assert results == [True, True, True]
+    assert log == [("completed", "2018-01"), ("completed", "2018-02"), ("completed", "2018-03")]
+
+
+def test_failed_month_lets_the_next_ones_merge(monkeypatch):
+    prefixes = {
+        "2018-01": "s3://b/log_data/2018-01/failing/",
+        "2018-02": "s3://b/log_data/2018-02/",
+        "2018-03": "s3://b/log_data/2018-03/",
+    }
+    results, log = load(monkeypatch, prefixes)
+
+    assert results == [False, True, True]
+    assert log == [("failed", "2018-01"), ("completed", "2018-02"), ("completed", "2018-03")]
@@ -0,0 +1,187 @@
+import os
+import pytest
+import query_client
+from query_client import QueryResult, ResultCache
+from sql_queries import load_generation_select
+
+
+class FakeConnection:
+    query_group = None
+
+
+class FakeDatabase:
+    """Answer the generation read with the current generation and any other query with one row"""
+
+    def __init__(self):
+        self.generation = 1
+        self.executed = []
+
+
+class FakeQueryConnection(FakeConnection):
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeQueryCursor(self.db)
+
+    def rollback(self):
+        pass
+
+
+class FakeQueryCursor:
+    def __init__(self, db):
+        self.db = db
+        self.description = [("level",)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if query != load_generation_select:
+            self.db.executed.append((query, params))
+
+    def fetchone(self):
+        return (self.db.generation,)
+
+    def fetchall(self):
+        return [("paid",)]
+
+
+class FakePool:
+    def __init__(self, conns):
+        self.conns = conns
+
+    def getconn(self):
+        return self.conns.pop(0)
+
+    def putconn(self, conn, close=False):
+        if not close:
+            self.conns.append(conn)
+
+
+def test_query_group_set_once_per_connection(monkeypatch):
+    groups_set = []
+    monkeypatch.setattr(query_client, "set_query_group", lambda conn, group: groups_set.append(conn))
+    first, second = FakeConnection(), FakeConnection()
+    client = object.__new__(query_client.QueryClient)
+    client.pool = FakePool([first, second])
+    client.query_group = "analyst"
+
+    for _ in range(4):
+        client.pool.putconn(client._getconn())
+
+    assert groups_set == [first, second]
+    assert first.query_group == second.query_group == "analyst"
+
+
+def client_of(db, cache=None):
+    client = object.__new__(query_client.QueryClient)
+    client.pool = FakePool([FakeQueryConnection(db)])
+    client.query_group = ""
+    client.cache = cache or ResultCache()
+    client.generation_ttl = 0
+    client._generation = None
+    client._generation_read_at = 0.0
+    client._lock = query_client.threading.Lock()
+    return client
+
+
+def test_normalize_sql():
+    assert query_client.normalize_sql("SELECT  level\n  FROM users ;") == "SELECT level FROM users"
+    assert query_client.normalize_sql("SELECT 'a  b' FROM users;") == "SELECT 'a  b' FROM users"
+    assert query_client.normalize_sql("SELECT 'it''s  ' ,\tlevel") == "SELECT 'it''s  ' , level"
+
+
+def test_results_cached_by_normalized_query_and_params():
+    db = FakeDatabase()
+    client = client_of(db)
+    query = "SELECT level FROM users WHERE user_id = %s;"
+
+    assert client.query(query, (1,)) == QueryResult(["level"], [("paid",)])
+    client.query("SELECT level\n  FROM users\n  WHERE user_id = %s", (1,))
+    client.query(query, (2,))
+
+    assert db.executed == [(query, (1,)), (query, (2,))]
+    assert client.stats()["hits"] == 1
+    assert client.stats()["misses"] == 2
+
+
+def test_generation_bump_expires_the_results():
+    db = FakeDatabase()
+    client = client_of(db)
+    client.query("SELECT level FROM users")
+    db.generation = 2
+    client.query("SELECT level FROM users")
+
+    assert len(db.executed) == 2
+    assert [key[2] for key in client.cache.entries] == [2]
+
+
+def test_generation_read_at_most_every_ttl():
+    db = FakeDatabase()
+    client = client_of(db)
+    client.generation_ttl = 3600
+    client.query("SELECT level FROM users")
+    db.generation = 2
+    client.query("SELECT level FROM users")
+
+    assert len(db.executed) == 1
+    assert client.generation() == 1
+
+
+def test_lru_eviction_by_entries():
+    cache = ResultCache(max_entries=2)
+    result = QueryResult(["level"], [("paid",)])
+    for key in ("a", "b"):
+        cache.put((key, "None", 1), result)
+    cache.get(("a", "None", 1))
+    cache.put(("c", "None", 1), result)
+
+    assert list(cache.entries) == [("a", "None", 1), ("c", "None", 1)]
+    assert cache.stats["evictions"] == 1
+
+
+def test_lru_eviction_by_bytes():
+    result = QueryResult(["level"], [("paid",)] * 10)
+    size = query_client.result_bytes(result.rows)
+    cache = ResultCache(max_bytes=2 * size)
+    for key in ("a", "b", "c"):
+        cache.put((key, "None", 1), result)
+
+    assert list(cache.entries) == [("b", "None", 1), ("c", "None", 1)]
+    assert cache.bytes == 2 * size
+    cache.put(("large", "None", 1), QueryResult(["level"], [("paid",)] * 30))
+    assert ("large", "None", 1) not in cache.entries
+
+
+def test_large_results_not_cached_without_spill_dir():
+    cache = ResultCache(spill_rows=2)
+    cache.put(("a", "None", 1), QueryResult(["level"], [("paid",)] * 3))
+    assert cache.get(("a", "None", 1)) is None
+
+
+def test_spill_and_reload(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = ResultCache(max_entries=1, spill_dir=str(tmp_path), spill_rows=2)
+    result = QueryResult(["user_id", "level"], [(1, "paid"), (2, "free"), (3, "paid")])
+    cache.put(("a", "None", 1), result)
+
+    assert cache.stats["spills"] == 1
+    assert cache.bytes == 0
+    assert len(os.listdir(tmp_path)) == 1
+    assert cache.get(("a", "None", 1)) == result
+
+    cache.put(("b", "None", 1), QueryResult(["level"], [("paid",)]))
+    assert os.listdir(tmp_path) == []
+
+
+def test_hit_rate():
+    cache = ResultCache()
+    assert cache.hit_rate() == 0.0
+    cache.put(("a", "None", 1), QueryResult(["level"], [("paid",)]))
+    for key in ("a", "a", "a", "b"):
+        cache.get((key, "None", 1))
+    assert cache.hit_rate() == 0.75
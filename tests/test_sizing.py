@@ -0,0 +1,96 @@
+import datetime
+import json
+import boto3
+import pytest
+import sizing
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+BUCKET = "sparkify-test"
+GB = 10 ** 9
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_estimate_nodes_default_expansion():
+    # 100 GB of input take 250 GB of tables, a dc2.large node holds 80 GB at 50% usage
+    assert sizing.estimate_nodes(100 * GB, "dc2.large") == 4
+
+
+def test_estimate_nodes_bounds():
+    assert sizing.estimate_nodes(0, "dc2.large") == 2
+    assert sizing.estimate_nodes(10 ** 15, "dc2.large", max_nodes=8) == 8
+    assert sizing.estimate_nodes(GB, "dc2.large", min_nodes=1) == 1
+
+
+def test_estimate_nodes_uses_measured_ratio():
+    history = [{"recorded_at": "2020-01-01T00:00:00", "input_bytes": 100 * GB, "table_bytes": 100 * GB}]
+    # ratio 1: 200 GB of tables on 80 GB per node
+    assert sizing.estimate_nodes(200 * GB, "dc2.large", history) == 3
+
+
+def test_estimate_nodes_never_below_last_table_size():
+    history = [{"recorded_at": "2020-01-01T00:00:00", "input_bytes": 100 * GB, "table_bytes": 800 * GB}]
+    assert sizing.estimate_nodes(GB, "dc2.large", history, max_nodes=32) == 10
+
+
+def test_estimate_nodes_unknown_node_type():
+    with pytest.raises(ValueError):
+        sizing.estimate_nodes(GB, "dc1.large")
+
+
+@pytest.mark.parametrize(
+    "current, target, expected",
+    [(4, 6, 6), (4, 16, 8), (4, 1, 2), (5, 1, 3), (4, 4, 4)],
+)
+def test_elastic_target(current, target, expected):
+    assert sizing.elastic_target(current, target) == expected
+
+
+def test_recent_input_bytes():
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    assert sizing.recent_input_bytes([], 24) is None
+    assert sizing.recent_input_bytes([{"recorded_at": now, "input_bytes": 10}], 24) == 10
+    old = [{"recorded_at": "2020-01-01T00:00:00", "input_bytes": 10}]
+    assert sizing.recent_input_bytes(old, 24) is None
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_table_bytes_only_final_tables():
+    cur = FakeCursor([("songplays", 3), ("users", None)])
+    assert sizing.table_bytes(cur) == 3 * sizing.BLOCK_BYTES
+    query, params = cur.executed[-1]
+    assert "svv_table_info" in query
+    assert set(params[0]) == {"songplays", "users", "songs", "artists", "time"}
+
+
+def test_manifest_bytes(s3):
+    entries = [{"url": "s3://b/a", "meta": {"content_length": 3}}, {"url": "s3://b/c", "meta": {"content_length": 4}}]
+    s3.put_object(Bucket=BUCKET, Key="m.manifest", Body=json.dumps({"entries": entries}).encode("utf-8"))
+    assert sizing.manifest_bytes(s3, f"s3://{BUCKET}/m.manifest") == 7
+
+    entries.append({"url": "s3://b/d"})
+    s3.put_object(Bucket=BUCKET, Key="m.manifest", Body=json.dumps({"entries": entries}).encode("utf-8"))
+    assert sizing.manifest_bytes(s3, f"s3://{BUCKET}/m.manifest") is None
@@ -0,0 +1,562 @@
+import argparse
+import configparser
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import boto3
+from db import get_backend
+from instrumentation import execute
+from local_loader import (
+    EPOCH_MILLISECONDS_COLUMNS,
+    parse_columns,
+    jsonpath_field,
+    load_jsonpaths,
+    iter_json_files,
+)
+from s3_utils import list_objects, split_s3_url
+from sql_queries import (
+    staging_events_table_create,
+    staging_songs_table_create,
+    staging_events_columns,
+    staging_songs_columns,
+    staging_events_copy_template,
+    staging_songs_copy_template,
+    staging_events_source,
+    staging_events_options,
+    staging_songs_source,
+    staging_songs_options,
+    maxerror_option_template,
+    load_errors_select,
+)
+
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# e.g. "    first_name VARCHAR(30)," -> first_name, VARCHAR, 30
+COLUMN_PATTERN = re.compile(r"^\s*(\w+)\s+([A-Za-z]+)(?:\((\d+)\))?")
+
+# VARCHAR and CHAR without a length hold 256 and 1 bytes on Redshift
+DEFAULT_LENGTHS = {"VARCHAR": 256, "CHAR": 1}
+
+INTEGER_RANGES = {
+    "SMALLINT": (-(2 ** 15), 2 ** 15 - 1),
+    "INT": (-(2 ** 31), 2 ** 31 - 1),
+    "INTEGER": (-(2 ** 31), 2 ** 31 - 1),
+    "BIGINT": (-(2 ** 63), 2 ** 63 - 1),
+}
+
+# epochs in milliseconds accepted for the TIMESTAMP columns: 1970-01-01 to 2100-01-01
+EPOCH_MILLISECONDS_RANGE = (0, 4102444800000)
+
+NUMBER_PATTERN = re.compile(r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$")
+
+INTEGER_PATTERN = re.compile(r"^\s*[-+]?\d+\s*$")
+
+# COPY MAXERROR accepts at most 100000 errors
+MAX_MAXERROR = 100000
+
+
+def column_types(create_query, columns):
+    """
+    Read the type and length of the columns from a CREATE TABLE query
+
+    Parameters
+    ----------
+    create_query : str
+    columns : list of str
+
+    Returns
+    -------
+    types : dict
+        column -> (type, length), length None for types without one
+
+    """
+    types = {}
+    for line in create_query.split("\n")[1:]:
+        match = COLUMN_PATTERN.match(line)
+        if match and match.group(1) in columns:
+            column_type = match.group(2).upper()
+            length = match.group(3)
+            types[match.group(1)] = (
+                column_type,
+                int(length) if length else DEFAULT_LENGTHS.get(column_type),
+            )
+    return types
+
+
+def check_value(column, value, column_type, length=None):
+    """
+    Check that a JSON value can be loaded by COPY into a column
+
+    Parameters
+    ----------
+    column : str
+    value : object
+        value decoded from JSON
+    column_type : str
+        e.g. VARCHAR
+    length : int
+        bytes of VARCHAR and CHAR columns
+
+    Returns
+    -------
+    error : str
+        None if the value is valid
+
+    """
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return f"{column}: nested value"
+
+    if column_type in ("VARCHAR", "CHAR"):
+        size = len(str(value).encode("utf-8"))
+        return f"{column}: {size} bytes over {length}" if size > length else None
+
+    if isinstance(value, bool):
+        return f"{column}: boolean {value} for {column_type}"
+
+    if column_type == "TIMESTAMP" and column in EPOCH_MILLISECONDS_COLUMNS:
+        if not isinstance(value, (int, float)):
+            return f"{column}: {value!r} is not an epoch in milliseconds"
+        low, high = EPOCH_MILLISECONDS_RANGE
+        return None if low <= value <= high else f"{column}: epoch {value} out of range"
+
+    if column_type in INTEGER_RANGES:
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, str) and INTEGER_PATTERN.match(value):
+            value = int(value)
+        if not isinstance(value, int):
+            return f"{column}: {value!r} is not an integer"
+        low, high = INTEGER_RANGES[column_type]
+        return None if low <= value <= high else f"{column}: {value} out of {column_type} range"
+
+    if column_type in ("NUMERIC", "DECIMAL", "REAL", "FLOAT", "DOUBLE"):
+        if isinstance(value, (int, float)) or (
+            isinstance(value, str) and NUMBER_PATTERN.match(value)
+        ):
+            return None
+        return f"{column}: {value!r} is not a number"
+
+    return None
+
+
+def new_profile():
+    return {"values": 0, "nulls": 0, "errors": 0, "max_length": 0, "min": None, "max": None}
+
+
+def update_profile(profile, value, error=None):
+    """
+    Add a value to the profile of a field: count, nulls, errors, max length and value range
+
+    Parameters
+    ----------
+    profile : dict
+        see new_profile
+    value : object
+    error : str
+        error of the value, see check_value
+
+    """
+    profile["values"] += 1
+    if value is None:
+        profile["nulls"] += 1
+        return
+    if error:
+        profile["errors"] += 1
+    if isinstance(value, (dict, list)):
+        return
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        profile["min"] = value if profile["min"] is None else min(profile["min"], value)
+        profile["max"] = value if profile["max"] is None else max(profile["max"], value)
+    profile["max_length"] = max(profile["max_length"], len(str(value).encode("utf-8")))
+
+
+def merge_profiles(profile, other):
+    """
+    Merge the profile of a field over a file into its profile over all the files
+
+    Parameters
+    ----------
+    profile : dict
+    other : dict
+
+    """
+    for key in ("values", "nulls", "errors"):
+        profile[key] += other[key]
+    profile["max_length"] = max(profile["max_length"], other["max_length"])
+    for key, pick in (("min", min), ("max", max)):
+        if other[key] is not None:
+            profile[key] = other[key] if profile[key] is None else pick(profile[key], other[key])
+
+
+def iter_source_records(text):
+    """
+    Yield the JSON objects of a file as compaction.iter_records, but go on after a malformed
+    object, skipping to the next line
+
+    Parameters
+    ----------
+    text : str
+
+    Yields
+    ------
+    (line, raw, record, error) : tuple
+        line number, text of the object, object (None if malformed) and parse error (None if well formed)
+
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    line = 1
+    while True:
+        start = position
+        while position < len(text) and text[position].isspace():
+            position += 1
+        line += text.count("\n", start, position)
+        if position == len(text):
+            return
+        start = position
+        try:
+            record, position = decoder.raw_decode(text, position)
+            error = None if isinstance(record, dict) else "not a JSON object"
+            yield line, text[start:position], record if error is None else None, error
+        except json.JSONDecodeError as e:
+            end = text.find("\n", position)
+            position = len(text) if end == -1 else end
+            yield line, text[start:position], None, f"malformed JSON: {e.msg}"
+        line += text.count("\n", start, position)
+
+
+def validate_records(text, fields, types):
+    """
+    Validate and profile the objects of a file against the columns of a staging table
+
+    Parameters
+    ----------
+    text : str
+        content of the file
+    fields : dict
+        column -> JSON field it is loaded from
+    types : dict
+        column -> (type, length), see column_types
+
+    Returns
+    -------
+    (records, profiles, bad) : tuple
+        number of objects, profile of each column and bad objects (line, errors and text of each one)
+
+    """
+    profiles = {column: new_profile() for column in fields}
+    bad = []
+    records = 0
+    for line, raw, record, error in iter_source_records(text):
+        records += 1
+        if record is None:
+            bad.append({"line": line, "errors": [error], "record": raw})
+            continue
+        lowered = {key.lower(): value for key, value in record.items()}
+        errors = []
+        for column, field in fields.items():
+            value = record.get(field, lowered.get(field.lower()))
+            error = check_value(column, value, *types[column])
+            update_profile(profiles[column], value, error)
+            if error:
+                errors.append(error)
+        if errors:
+            bad.append({"line": line, "errors": errors, "record": raw})
+    return records, profiles, bad
+
+
+class Source:
+    """
+    Files of a source, either under an S3 prefix or under a local directory, read one at a time
+    """
+
+    def __init__(self, url, client=None):
+        self.url = url
+        self.client = client
+        self.s3 = url.startswith("s3://")
+
+    def files(self):
+        if self.s3:
+            return [key for key, _ in list_objects(self.client, self.url) if key.endswith(".json")]
+        return list(iter_json_files(self.url))
+
+    def read(self, name):
+        if self.s3:
+            bucket, _ = split_s3_url(self.url)
+            body = self.client.get_object(Bucket=bucket, Key=name)["Body"].read()
+            return body.decode("utf-8")
+        with open(name, encoding="utf-8") as json_file:
+            return json_file.read()
+
+
+def quarantine(client, url, table, name, bad):
+    """
+    Write the bad objects of a source file as line-delimited JSON under the quarantine
+    S3 prefix or local directory, e.g. <url>/staging_events/2018-11-04-events.json
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    url : str
+    table : str
+    name : str
+        key or path of the source file
+    bad : list of dict
+        see validate_records
+
+    Returns
+    -------
+    location : str
+
+    """
+    body = "".join(json.dumps({"source": name, **entry}) + "\n" for entry in bad)
+    filename = os.path.basename(name)
+    if url.startswith("s3://"):
+        bucket, prefix = split_s3_url(url)
+        key = "/".join(part for part in (prefix.rstrip("/"), table, filename) if part)
+        client.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+        return f"s3://{bucket}/{key}"
+
+    directory = os.path.join(url, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    with open(path, "w", encoding="utf-8") as quarantine_file:
+        quarantine_file.write(body)
+    return path
+
+
+def validate_source(source, table, fields, types, workers=8, quarantine_url=None):
+    """
+    Validate the files of a source in parallel, holding one file per worker at a time,
+    and quarantine their bad objects
+
+    Parameters
+    ----------
+    source : Source
+    table : str
+        staging table the source is loaded into
+    fields : dict
+        column -> JSON field
+    types : dict
+        column -> (type, length)
+    workers : int
+    quarantine_url : str
+        S3 prefix or local directory, the bad objects are only counted when not set
+
+    Returns
+    -------
+    summary : dict
+        files, records, bad_records, quarantined files and profile of each column
+
+    """
+    summary = {
+        "files": 0,
+        "records": 0,
+        "bad_records": 0,
+        "quarantined": [],
+        "fields": {column: new_profile() for column in fields},
+    }
+
+    def validate_file(name):
+        records, profiles, bad = validate_records(source.read(name), fields, types)
+        location = None
+        if bad and quarantine_url:
+            location = quarantine(source.client, quarantine_url, table, name, bad)
+        return records, profiles, len(bad), location
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for records, profiles, bad, location in executor.map(validate_file, source.files()):
+            summary["files"] += 1
+            summary["records"] += records
+            summary["bad_records"] += bad
+            if location:
+                summary["quarantined"].append(location)
+            for column, profile in profiles.items():
+                merge_profiles(summary["fields"][column], profile)
+    return summary
+
+
+def read_jsonpaths(client, url):
+    """
+    Read the jsonpaths of log_data from a JSONPaths file on S3 or local, or the default mapping
+
+    Parameters
+    ----------
+    client : boto3.session.Session.client
+    url : str
+
+    Returns
+    -------
+    jsonpaths : list of str
+
+    """
+    if url and url.startswith("s3://"):
+        bucket, key = split_s3_url(url)
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return json.loads(body.decode("utf-8"))["jsonpaths"]
+    return load_jsonpaths(url)
+
+
+def staging_sources(config, client):
+    """
+    Sources, JSON fields and column types of the staging tables: the S3 prefixes of the S3 section
+    or, with the postgres backend, the local directories of the LOCAL section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    client : boto3.session.Session.client
+
+    Returns
+    -------
+    sources : dict
+        staging table -> (Source, fields, types)
+
+    """
+    section = "LOCAL" if get_backend(config) == "postgres" else "S3"
+    events_columns = parse_columns(staging_events_columns)
+    jsonpaths = read_jsonpaths(client, config[section].get("LOG_JSONPATH"))
+    songs_columns = parse_columns(staging_songs_columns)
+    return {
+        "staging_events": (
+            Source(config[section]["LOG_DATA"], client),
+            {
+                column: jsonpath_field(jsonpath)
+                for column, jsonpath in zip(events_columns, jsonpaths)
+            },
+            column_types(staging_events_table_create, events_columns),
+        ),
+        "staging_songs": (
+            Source(config[section]["SONG_DATA"], client),
+            {column: column for column in songs_columns},
+            column_types(staging_songs_table_create, songs_columns),
+        ),
+    }
+
+
+def validate_staging_sources(config, client=None):
+    """
+    Validate the sources of the staging tables with the settings of the VALIDATION section
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    client : boto3.session.Session.client
+        S3 client, created if not given
+
+    Returns
+    -------
+    report : dict
+        staging table -> summary (see validate_source), with the MAXERROR of its COPY
+
+    """
+    client = client or boto3.client("s3")
+    workers = config.getint("VALIDATION", "WORKERS", fallback=8)
+    quarantine_url = config.get("VALIDATION", "QUARANTINE", fallback="") or None
+
+    report = {}
+    for table, (source, fields, types) in staging_sources(config, client).items():
+        summary = validate_source(source, table, fields, types, workers, quarantine_url)
+        summary["maxerror"] = min(summary["bad_records"], MAX_MAXERROR)
+        report[table] = summary
+        logger.info(
+            f"{table}: {summary['files']} files, {summary['records']} records, "
+            f"{summary['bad_records']} bad"
+        )
+        for column, profile in summary["fields"].items():
+            if profile["errors"]:
+                logger.warning(f"{table}.{column}: {profile['errors']} invalid values")
+    return report
+
+
+def bad_ratio(summary):
+    return summary["bad_records"] / summary["records"] if summary["records"] else 0.0
+
+
+def copy_queries(report):
+    """
+    Build the COPY queries of the staging tables tolerating the bad records found by the validation
+
+    Parameters
+    ----------
+    report : dict
+        see validate_staging_sources
+
+    Returns
+    -------
+    queries : list of str
+        same order as sql_queries.copy_table_queries
+
+    """
+    queries = []
+    for table, template, source, options in (
+        ("staging_events", staging_events_copy_template, staging_events_source, staging_events_options),
+        ("staging_songs", staging_songs_copy_template, staging_songs_source, staging_songs_options),
+    ):
+        maxerror = report.get(table, {}).get("maxerror", 0)
+        if maxerror:
+            options += maxerror_option_template.format(maxerror=maxerror)
+        queries.append(template.format(source=source, options=options))
+    return queries
+
+
+def load_errors(cur, since):
+    """
+    Read the rows rejected by the COPY queries from STL_LOAD_ERRORS
+
+    Parameters
+    ----------
+    cur : psycopg2 Cursor
+    since : datetime
+        start of the COPY queries (UTC)
+
+    Returns
+    -------
+    errors : list of dict
+        table, file, line, column, value, code and reason of each rejected row
+
+    """
+    execute(cur, load_errors_select, "validation", (since,))
+    keys = ["table", "file", "line", "column", "value", "code", "reason"]
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def write_report(path, report):
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2, default=str)
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def main(argv=None):
+    """
+    Validate and profile log_data and song_data against the staging tables, writing REPORT of the VALIDATION section
+
+    """
+    parser = argparse.ArgumentParser(description="Validate the source files before COPY")
+    parser.add_argument("--config", default="dwh.cfg")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    report = validate_staging_sources(config)
+    path = config.get("VALIDATION", "REPORT", fallback="validation_report.json")
+    write_report(path, report)
+    logger.info(f"Report written to {path}")
+    max_ratio = config.getfloat("VALIDATION", "MAX_BAD_RATIO", fallback=0.001)
+    if any(bad_ratio(summary) > max_ratio for summary in report.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()